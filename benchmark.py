@@ -0,0 +1,322 @@
+"""Benchmark the bot's hot paths in-process against a stubbed Bot
+
+Synthetic updates are fed through handle_message, filter_command and
+stop_command, and FilterBot.get_reply_for_trigger, add_filter and the storage
+backend's compact are called directly, over a grid of chat counts, filters per chat, message
+lengths and hit ratios. Results are written as JSON; with --baseline the run
+fails when a case got slower than the stored baseline by more than --threshold.
+
+    python benchmark.py --quick --output bench.json
+    python benchmark.py --baseline bench_baseline.json --threshold 0.25
+
+--memory instead compares the memory held by a large synthetic filter set
+loaded as plain dicts (the old in-memory model) and as interned FilterRecords.
+
+    python benchmark.py --memory --chats 20000 --filters-per-chat 50
+"""
+import argparse
+import gc
+import itertools
+import json
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+FULL_GRID = {
+    "chats": [1, 100],
+    "filters_per_chat": [10, 300],
+    "message_length": [20, 200],
+    "hit_ratio": [0.1, 0.9],
+}
+QUICK_GRID = {
+    "chats": [10],
+    "filters_per_chat": [50],
+    "message_length": [60],
+    "hit_ratio": [0.5],
+}
+
+
+class StubBot:
+    """Bot stand-in that answers every send locally with a fresh message id"""
+
+    # Read by telegram.Message.reply_* (PTB's Defaults); the benchmark uses none
+    defaults = None
+
+    def __init__(self):
+        self.username = 'benchmark_bot'
+        self.calls = 0
+
+    def _sent(self, *args, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(message_id=self.calls)
+
+    send_message = send_photo = send_video = send_document = _sent
+    send_audio = send_voice = send_sticker = delete_message = _sent
+
+    def get_chat_administrators(self, chat_id):
+        return []
+
+
+class ImmediateOutbound:
+    """Outbound queue replacement that sends synchronously, without rate limits"""
+
+    def submit(self, chat_id, func, /, *args, priority=0, chat_limited=True, **kwargs):
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+    def pending(self):
+        return 0
+
+    def stop(self, timeout=None):
+        pass
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_message(rng, length, trigger=None):
+    """Random words of roughly `length` characters, optionally containing trigger"""
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(random_word(rng, rng.randint(3, 9)))
+    if trigger is not None:
+        words.insert(rng.randrange(len(words) + 1), trigger)
+    return ' '.join(words)
+
+
+def make_update(bot, update_id, chat_id, user_id, text):
+    """Build a real telegram Update for a group text message"""
+    from telegram import Update
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+    if text.startswith('/'):
+        command = text.split(' ', 1)[0]
+        data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return Update.de_json(data, bot)
+
+
+def summarize(latencies):
+    """Throughput and latency percentiles (microseconds) for one operation"""
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        "count": len(ordered),
+        "ops_per_sec": len(ordered) / total if total else 0.0,
+        "p50_us": ordered[len(ordered) // 2] * 1e6,
+        "p99_us": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1e6,
+        "mean_us": statistics.fmean(ordered) * 1e6,
+    }
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def run_case(bot_module, case, messages, seed):
+    """Run every benchmarked operation for one grid point"""
+    rng = random.Random(seed)
+    # Fresh directory so each case starts from empty filter storage
+    os.chdir(tempfile.mkdtemp(prefix='filterbot-bench-'))
+    bot = StubBot()
+    context = SimpleNamespace(bot=bot, args=[])
+    filter_bot = bot_module.FilterBot()
+    bot_module.bot_instance = filter_bot
+
+    chat_ids = [-1000000000000 - index for index in range(case["chats"])]
+    triggers = {chat_id: [random_word(rng, rng.randint(4, 10)) for _ in range(case["filters_per_chat"])]
+                for chat_id in chat_ids}
+    results = {}
+
+    latencies = []
+    for chat_id in chat_ids:
+        for trigger in triggers[chat_id]:
+            latencies.append(timed(filter_bot.add_filter, chat_id, trigger, f"reply to {trigger}"))
+    results["add_filter"] = summarize(latencies)
+
+    latencies = [timed(filter_bot.storage.compact) for _ in range(5)]
+    results["compact"] = summarize(latencies)
+
+    def make_texts():
+        texts = []
+        for _ in range(messages):
+            chat_id = rng.choice(chat_ids)
+            hit = rng.random() < case["hit_ratio"]
+            trigger = rng.choice(triggers[chat_id]) if hit else None
+            texts.append((chat_id, make_message(rng, case["message_length"], trigger)))
+        return texts
+
+    # Every scenario gets its own messages and an empty match cache, so it
+    # measures matching rather than cache hits on the previous scenario's texts
+    filter_bot.match_cache.clear()
+    latencies = [timed(filter_bot.get_reply_for_trigger, chat_id, text) for chat_id, text in make_texts()]
+    results["get_reply_for_trigger"] = summarize(latencies)
+
+    filter_bot.match_cache.clear()
+    updates = [make_update(bot, index, chat_id, 1000 + index % 50, text)
+               for index, (chat_id, text) in enumerate(make_texts())]
+    latencies = [timed(bot_module.handle_message, update, context) for update in updates]
+    results["handle_message"] = summarize(latencies)
+
+    commands = max(10, messages // 10)
+    new_triggers = [(rng.choice(chat_ids), random_word(rng, 12)) for _ in range(commands)]
+    filter_updates = [make_update(bot, index, chat_id, 1, f"/filter {trigger} benchmark reply")
+                      for index, (chat_id, trigger) in enumerate(new_triggers)]
+    stop_updates = [make_update(bot, index, chat_id, 1, f"/stop {trigger}")
+                    for index, (chat_id, trigger) in enumerate(new_triggers)]
+    results["filter_command"] = summarize([timed(bot_module.filter_command, u, context) for u in filter_updates])
+    results["stop_command"] = summarize([timed(bot_module.stop_command, u, context) for u in stop_updates])
+
+    filter_bot.close()
+    return results
+
+
+def make_filter_snapshot(rng, chats, filters_per_chat, shared_ratio=0.6):
+    """chat_filters.json text where `shared_ratio` of replies reuse popular stickers and texts"""
+    stickers = [f"CAACAgIAAxkBAAE{random_word(rng, 40)}" for _ in range(200)]
+    texts = [make_message(rng, 80) for _ in range(500)]
+    data = {}
+    for index in range(chats):
+        chat_filters = {}
+        for number in range(filters_per_chat):
+            shared = rng.random() < shared_ratio
+            if number % 3 == 0:
+                file_id = rng.choice(stickers) if shared else f"CAACAgIAAxkBAAE{random_word(rng, 40)}"
+                record = {"type": "media", "media_type": "sticker", "file_id": file_id, "caption": ""}
+            else:
+                record = {"type": "text", "content": rng.choice(texts) if shared else make_message(rng, 80)}
+            chat_filters[f"{random_word(rng, 5)}{number}"] = record
+        data[str(-1001000000000 - index)] = chat_filters
+    return json.dumps(data)
+
+
+def measure_memory(load, snapshot_text):
+    """Bytes still allocated after load(snapshot_text), and the seconds it took"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    data = load(snapshot_text)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return held, elapsed
+
+
+def run_memory(args):
+    """Compare the memory of the dict and FilterRecord models of the same filters"""
+    from filter_record import to_records
+
+    rng = random.Random(args.seed)
+    snapshot_text = make_filter_snapshot(rng, args.chats, args.filters_per_chat)
+    models = {
+        "dict": json.loads,
+        "record": lambda text: {sys.intern(chat): to_records(chat_filters)
+                                for chat, chat_filters in json.loads(text).items()},
+    }
+    results = {}
+    for name, load in models.items():
+        held, elapsed = measure_memory(load, snapshot_text)
+        results[name] = {"bytes": held, "load_seconds": elapsed}
+        print(f"{name:<8} {held / 2 ** 20:>9.1f} MiB  load {elapsed:.2f}s")
+    saved = 1 - results["record"]["bytes"] / results["dict"]["bytes"]
+    print(f"{args.chats} chats x {args.filters_per_chat} filters: records use {saved:.0%} less memory")
+    return {"chats": args.chats, "filters_per_chat": args.filters_per_chat, "results": results}
+
+
+def case_key(case):
+    return ",".join(f"{name}={case[name]}" for name in sorted(case))
+
+
+def compare(results, baseline, threshold):
+    """List regressions: p50 latency or throughput worse than baseline by > threshold"""
+    regressions = []
+    for key, operations in results.items():
+        for operation, current in operations.items():
+            previous = baseline.get(key, {}).get(operation)
+            if previous is None:
+                continue
+            if current["p50_us"] > previous["p50_us"] * (1 + threshold):
+                regressions.append(f"{key} {operation}: p50 {previous['p50_us']:.1f}us -> {current['p50_us']:.1f}us")
+            if current["ops_per_sec"] < previous["ops_per_sec"] * (1 - threshold):
+                regressions.append(
+                    f"{key} {operation}: {previous['ops_per_sec']:.0f} -> {current['ops_per_sec']:.0f} ops/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true', help="run a single small grid point")
+    parser.add_argument('--messages', type=int, default=2000, help="messages per grid point")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help="fail if results regress against this file")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument('--memory', action='store_true', help="compare dict and FilterRecord memory instead")
+    parser.add_argument('--chats', type=int, default=20000, help="chats in the --memory dataset")
+    parser.add_argument('--filters-per-chat', type=int, default=50, help="filters per chat for --memory")
+    args = parser.parse_args()
+
+    if args.memory:
+        with open(args.output, 'w') as f:
+            json.dump(run_memory(args), f, indent=2)
+        return
+
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    # The bot module keeps its state files in the working directory
+    os.chdir(tempfile.mkdtemp(prefix='filterbot-bench-'))
+    os.environ.setdefault('CHAT_WORKERS', '0')
+    import telegram_filter_bot as bot_module
+    bot_module.bot_instance.close()
+    bot_module.outbound_queue.stop()
+    bot_module.outbound_queue = ImmediateOutbound()
+
+    grid = QUICK_GRID if args.quick else FULL_GRID
+    results = {}
+    for values in itertools.product(*grid.values()):
+        case = dict(zip(grid.keys(), values))
+        key = case_key(case)
+        results[key] = run_case(bot_module, case, args.messages, args.seed)
+        for operation, summary in results[key].items():
+            print(f"{key:<70} {operation:<22} {summary['ops_per_sec']:>11.0f} ops/s"
+                  f"  p50 {summary['p50_us']:>9.1f}us  p99 {summary['p99_us']:>9.1f}us")
+
+    with open(output, 'w') as f:
+        json.dump({"grid": grid, "messages": args.messages, "results": results}, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == '__main__':
+    main()
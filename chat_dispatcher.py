@@ -0,0 +1,91 @@
+import functools
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ChatPartitionedExecutor:
+    """Fixed pool of worker threads, each owning the chats that hash to it
+
+    Work for one chat always goes to the same worker's FIFO queue, so updates
+    from a chat are handled strictly in order (a /filter is applied before the
+    /stop that follows it) while different chats run in parallel. A slow reply in
+    one chat only delays the chats sharing its worker. With zero workers
+    callbacks run inline on the caller's thread.
+    """
+
+    def __init__(self, workers=8, queue_size=10000):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.busy_seconds = [0.0] * workers
+        self.processed = [0] * workers
+        self._window_start = time.monotonic()
+        self._window_busy = [0.0] * workers
+        self._threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._work, args=(index,), name=f'chat-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def worker_for(self, chat_id):
+        """Index of the worker that owns chat_id"""
+        return hash(chat_id) % len(self.queues)
+
+    def submit(self, chat_id, func, *args):
+        """Queue func(*args) behind earlier work for the same chat"""
+        if not self.queues:
+            func(*args)
+            return
+        self.queues[self.worker_for(chat_id)].put((func, args))
+
+    def wrap(self, callback):
+        """Turn a handler callback into one that runs on its chat's worker"""
+        if not self.queues:
+            return callback
+
+        @functools.wraps(callback)
+        def dispatch(update, context):
+            chat = update.effective_chat
+            self.submit(chat.id if chat else 0, callback, update, context)
+        return dispatch
+
+    def _work(self, index):
+        work_queue = self.queues[index]
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            func, args = item
+            started = time.monotonic()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Error in %s on worker %d", getattr(func, '__name__', func), index)
+            finally:
+                self.busy_seconds[index] += time.monotonic() - started
+                self.processed[index] += 1
+
+    def stats(self):
+        """Queue depth and utilization (busy share since the previous call) per worker"""
+        now = time.monotonic()
+        elapsed = max(now - self._window_start, 1e-9)
+        utilization = [
+            min(1.0, (busy - previous) / elapsed)
+            for busy, previous in zip(self.busy_seconds, self._window_busy)
+        ]
+        self._window_start = now
+        self._window_busy = list(self.busy_seconds)
+        return {
+            "queue_depth": [work_queue.qsize() for work_queue in self.queues],
+            "utilization": utilization,
+            "processed": list(self.processed),
+        }
+
+    def stop(self):
+        """Finish queued work and stop the workers"""
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join()
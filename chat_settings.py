@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from file_watcher import file_version
+
+logger = logging.getLogger(__name__)
+
+
+def _seconds(value):
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not 0 <= value <= 86400:
+        raise ValueError("must be a number of seconds between 0 and 86400")
+    return value
+
+
+def _window(value):
+    if (not isinstance(value, (list, tuple)) or len(value) != 2
+            or not all(isinstance(hour, int) for hour in value) or not 0 <= value[0] < value[1] <= 24):
+        raise ValueError("must be [start hour, end hour] with 0 <= start < end <= 24")
+    return [value[0], value[1]]
+
+
+def _name(value):
+    if not isinstance(value, str) or not value:
+        raise ValueError("must be a non-empty string")
+    return value
+
+
+# Known per-chat settings and the validator of each; a chat without a value
+# uses the caller's default
+SETTINGS = {
+    "self_destruct_time": _seconds,
+    "good_morning_window": _window,
+    "good_morning_timezone": _name,
+    "cooldown_chat": _seconds,
+    "cooldown_trigger": _seconds,
+    "cooldown_duplicate": _seconds,
+}
+
+
+class ChatSettings:
+    """Per-chat settings held in memory and saved to a JSON file in the background
+
+    Reads are plain dict lookups with no lock and no I/O, so the reply path can
+    consult settings on every message. Each chat's settings dict is replaced,
+    never mutated, when it changes. Writes are debounced: the file is written
+    `save_delay` seconds after the last change (but at most `max_delay` after the
+    first unsaved one), so a burst of button presses becomes one write.
+
+    Changes made to the file by someone else are picked up by `reload` (hooked
+    to the file watcher); `on_change` is then called with the changed chat ids.
+    """
+
+    def __init__(self, state_file, save_delay=1.0, max_delay=5.0):
+        self.state_file = state_file
+        self.save_delay = save_delay
+        self.max_delay = max_delay
+        self.on_change = None
+        self.writes = 0
+        self._chats = {}
+        self._cond = threading.Condition()
+        # Chats changed since the last write, and when that write is due
+        self._dirty = set()
+        self._first_dirty = None
+        self._save_at = None
+        self._version = None
+        self._stopping = False
+        self._thread = None
+        self._chats = self._read()
+
+    def _read(self):
+        """Chats from state_file; top-level keys that are not chat ids are ignored"""
+        self._version = file_version(self.state_file)
+        if self._version is None:
+            return {}
+        try:
+            with open(self.state_file, 'r') as f:
+                data = json.load(f)
+        except ValueError as e:
+            logger.warning("Could not read chat settings from %s: %s", self.state_file, e)
+            return {}
+        chats = {}
+        for key, values in data.items():
+            try:
+                chat_id = int(key)
+            except ValueError:
+                # Left over from the old single global settings dict
+                continue
+            if isinstance(values, dict):
+                chats[chat_id] = {name: value for name, value in values.items() if name in SETTINGS}
+        return chats
+
+    def get(self, chat_id, name, default=None):
+        """A chat's value of a setting, or default if the chat has none"""
+        return self._chats.get(chat_id, {}).get(name, default)
+
+    def get_all(self, chat_id):
+        """A copy of every setting a chat has set"""
+        return dict(self._chats.get(chat_id, {}))
+
+    def update(self, chat_id, **values):
+        """Set some of a chat's settings; a value of None removes that setting
+
+        Raises ValueError for unknown settings or invalid values, changing nothing.
+        """
+        checked = {}
+        for name, value in values.items():
+            if name not in SETTINGS:
+                raise ValueError(f"unknown setting {name!r}")
+            try:
+                checked[name] = None if value is None else SETTINGS[name](value)
+            except ValueError as e:
+                raise ValueError(f"{name} {e}") from None
+        with self._cond:
+            chat = dict(self._chats.get(chat_id, {}))
+            for name, value in checked.items():
+                if value is None:
+                    chat.pop(name, None)
+                else:
+                    chat[name] = value
+            if chat == self._chats.get(chat_id, {}):
+                return
+            if chat:
+                self._chats[chat_id] = chat
+            else:
+                self._chats.pop(chat_id, None)
+            self._mark_dirty(chat_id)
+
+    def reset(self, chat_id, *names):
+        """Drop the given settings of a chat (all of them if none are given)"""
+        if names:
+            self.update(chat_id, **dict.fromkeys(names))
+            return
+        with self._cond:
+            if self._chats.pop(chat_id, None) is not None:
+                self._mark_dirty(chat_id)
+
+    def _mark_dirty(self, chat_id):
+        now = time.monotonic()
+        if not self._dirty:
+            self._first_dirty = now
+        self._dirty.add(chat_id)
+        self._save_at = min(now + self.save_delay, self._first_dirty + self.max_delay)
+        self._cond.notify()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='chat-settings', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                if not self._dirty:
+                    self._cond.wait()
+                    continue
+                timeout = self._save_at - time.monotonic()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error("Could not save chat settings: %s", e)
+                time.sleep(self.max_delay)
+
+    def flush(self):
+        """Write pending changes now"""
+        with self._cond:
+            if not self._dirty:
+                return
+            chats = {str(chat_id): chat for chat_id, chat in self._chats.items()}
+            # Written inside the lock so reload() never sees our own write as foreign
+            tmp_path = self.state_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(chats, f, indent=2)
+            os.replace(tmp_path, self.state_file)
+            self._version = file_version(self.state_file)
+            # Only now: a failed write leaves the chats dirty for the next attempt
+            self._dirty.clear()
+            self.writes += 1
+
+    def reload(self, path=None):
+        """Adopt changes made to state_file by others; local unsaved changes win"""
+        with self._cond:
+            if file_version(self.state_file) == self._version:
+                return set()
+            chats = self._read()
+            for chat_id in self._dirty:
+                if chat_id in self._chats:
+                    chats[chat_id] = self._chats[chat_id]
+                else:
+                    chats.pop(chat_id, None)
+            changed = {chat_id for chat_id in set(chats) | set(self._chats)
+                       if chats.get(chat_id) != self._chats.get(chat_id)}
+            self._chats = chats
+        if changed and self.on_change is not None:
+            self.on_change(changed)
+        return changed
+
+    def stop(self):
+        """Stop the writer thread and write what is pending"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DeletionScheduler:
+    """Single background thread that deletes messages when they are due
+
+    Pending deletions live in a heap ordered by due time and are keyed by
+    `(chat_id, message_id)`, so they can be cancelled or rescheduled. Rescheduling
+    leaves the old heap entry behind; it is skipped when popped. Pending entries
+    are written to `state_file` (at most every `save_interval` seconds) and loaded
+    again on start, so deletions survive a restart.
+    """
+
+    def __init__(self, state_file=None, save_interval=5.0):
+        self.state_file = state_file
+        self.save_interval = save_interval
+        self._heap = []
+        self._due = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._dirty = False
+        self._last_save = 0.0
+        self._delete_func = None
+        self._thread = None
+        self._stopping = False
+        self._load()
+
+    def _load(self):
+        """Restore pending deletions saved by a previous run"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                entries = json.load(f)
+        except ValueError as e:
+            logger.warning("Could not read pending deletions from %s: %s", self.state_file, e)
+            return
+        for chat_id, message_id, due in entries:
+            self._push((chat_id, message_id), due)
+
+    def _push(self, key, due):
+        seq = next(self._seq)
+        self._due[key] = (due, seq)
+        heapq.heappush(self._heap, (due, seq, key))
+
+    def start(self, delete_func):
+        """Start the scheduler thread; delete_func(chat_id, message_id) does the deletion"""
+        self._delete_func = delete_func
+        self._thread = threading.Thread(target=self._run, name='self-destruct', daemon=True)
+        self._thread.start()
+
+    def schedule(self, chat_id, message_id, delay_seconds):
+        """Schedule (or reschedule) a deletion delay_seconds from now"""
+        with self._cond:
+            self._push((chat_id, message_id), time.time() + delay_seconds)
+            self._dirty = True
+            self._cond.notify()
+
+    def cancel(self, chat_id, message_id):
+        """Cancel a pending deletion; returns False if none was pending"""
+        with self._cond:
+            if self._due.pop((chat_id, message_id), None) is None:
+                return False
+            self._dirty = True
+            self._cond.notify()
+            return True
+
+    def pending(self):
+        """Number of deletions waiting to run"""
+        return len(self._due)
+
+    def stop(self):
+        """Stop the thread and save what is still pending"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._save()
+
+    def _next_due(self):
+        """Pop stale heap entries and return the first live one, or None"""
+        while self._heap:
+            due, seq, key = self._heap[0]
+            if self._due.get(key) == (due, seq):
+                return self._heap[0]
+            heapq.heappop(self._heap)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = time.time()
+                head = self._next_due()
+                if head is None or head[0] > now:
+                    timeout = None if head is None else head[0] - now
+                    if self._dirty:
+                        save_at = self._last_save + self.save_interval
+                        timeout = save_at - now if timeout is None else min(timeout, save_at - now)
+                    if timeout is None or timeout > 0:
+                        self._cond.wait(timeout)
+                        continue
+                    key = None
+                else:
+                    heapq.heappop(self._heap)
+                    key = head[2]
+                    del self._due[key]
+                    self._dirty = True
+            if key is None:
+                self._save()
+                continue
+            try:
+                self._delete_func(*key)
+            except Exception as e:
+                logger.warning("Could not delete message %s: %s", key[1], e)
+
+    def _save(self):
+        """Atomically write the pending deletions to state_file"""
+        with self._cond:
+            self._last_save = time.time()
+            if not self._dirty or not self.state_file:
+                return
+            self._dirty = False
+            entries = [[chat_id, message_id, due] for (chat_id, message_id), (due, _) in self._due.items()]
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.state_file)
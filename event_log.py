@@ -0,0 +1,98 @@
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+from metrics import REGISTRY
+
+EVENTS_WRITTEN = REGISTRY.counter('bot_log_events_total', 'Structured log events written, by event', ('event',))
+EVENTS_DROPPED = REGISTRY.counter(
+    'bot_log_events_dropped_total', 'Structured log events dropped because the log queue was full', ('event',))
+
+
+def parse_sample_rates(value):
+    """Parse "event=rate,..." (e.g. "handler=0.01,filter_hit=0.1") into a dict"""
+    rates = {}
+    for part in (value or '').split(','):
+        if not part.strip():
+            continue
+        event, _, rate = part.partition('=')
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError(f"sample rate of {event.strip()!r} must be between 0 and 1")
+        rates[event.strip()] = rate
+    return rates
+
+
+class EventLog:
+    """Structured events written as JSON lines by a background thread
+
+    `emit` only puts the event on a bounded queue, so a slow stdout (a pipe or
+    a container log driver) never blocks a handler. When the queue is full the
+    event is dropped and counted instead. Events listed in `sample_rates` are
+    kept with that probability; kept ones carry their "sample_rate" so counts
+    can be scaled back up.
+    """
+
+    def __init__(self, stream=None, queue_size=10000, sample_rates=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.sample_rates = dict(sample_rates or {})
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def emit(self, event, **fields):
+        """Queue an event such as emit("filter_hit", chat_id=1, trigger="hi")"""
+        rate = self.sample_rates.get(event, 1.0)
+        if rate < 1.0:
+            if random.random() >= rate:
+                return
+            fields["sample_rate"] = rate
+        record = {"ts": round(time.time(), 3), "event": event}
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            EVENTS_DROPPED.inc(event=event)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='event-log', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            self._write(record)
+            # Flush once per burst rather than once per line
+            if self._queue.empty():
+                self._flush()
+        self._flush()
+
+    def _write(self, record):
+        try:
+            self.stream.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        except (OSError, ValueError):
+            return
+        EVENTS_WRITTEN.inc(event=record["event"])
+
+    def _flush(self):
+        try:
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def stop(self, timeout=5.0):
+        """Write what is queued, then stop the writer thread"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
@@ -0,0 +1,149 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+_EVENT = struct.Struct('iIII')
+
+
+def file_version(path):
+    """Identity of a file's current contents: (inode, mtime_ns, size), or None if missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _inotify():
+    """libc handle with inotify support, or None on other platforms"""
+    if not hasattr(os, 'O_CLOEXEC'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FileWatcher:
+    """Calls a callback when a watched file is changed, replaced or created
+
+    Uses inotify on the file's directory where available (which also catches
+    editors and tools that replace the file by renaming), and checks every
+    file's (inode, mtime, size) every `interval` seconds as a fallback for
+    platforms and filesystems without inotify. A callback runs only when the
+    file's version actually changed since the last call.
+    """
+
+    def __init__(self, interval=2.0, inotify_interval=30.0):
+        self.interval = interval
+        self.inotify_interval = inotify_interval
+        self._watches = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._libc = _inotify()
+        self._fd = None
+        self._wake = None
+        self._dirs = {}
+        self._thread = None
+
+    def watch(self, path, callback):
+        """Call callback(path) whenever path changes"""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._watches.setdefault(path, []).append(callback)
+            self._versions[path] = file_version(path)
+        if self._fd is not None:
+            self._add_dir(os.path.dirname(path))
+
+    def start(self):
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(os.O_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+                # Written to by stop() to interrupt the blocking select
+                self._wake = os.pipe()
+                for directory in {os.path.dirname(path) for path in self._watches}:
+                    self._add_dir(directory)
+        self._thread = threading.Thread(target=self._run, name='file-watcher', daemon=True)
+        self._thread.start()
+
+    def _add_dir(self, directory):
+        if directory in self._dirs.values():
+            return
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+        if wd >= 0:
+            self._dirs[wd] = directory
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._fd is None:
+                self._stop.wait(self.interval)
+                self.check()
+                continue
+            readable, _, _ = select.select([self._fd, self._wake[0]], [], [], self.inotify_interval)
+            if self._stop.is_set():
+                return
+            if not readable:
+                # Periodic fallback for changes inotify cannot see (e.g. network filesystems)
+                self.check()
+                continue
+            self.check(self._read_events())
+
+    def _read_events(self):
+        """Paths named by the pending inotify events"""
+        data = os.read(self._fd, 64 * 1024)
+        paths = set()
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self._dirs.get(wd)
+            if directory is not None and name:
+                paths.add(os.path.join(directory, os.fsdecode(name)))
+        return paths
+
+    def check(self, paths=None):
+        """Run the callbacks of watched files (all, or `paths`) whose version changed"""
+        with self._lock:
+            candidates = [path for path in (paths if paths is not None else self._watches) if path in self._watches]
+            changed = []
+            for path in candidates:
+                version = file_version(path)
+                if version != self._versions.get(path):
+                    self._versions[path] = version
+                    changed.append((path, list(self._watches[path])))
+        for path, callbacks in changed:
+            for callback in callbacks:
+                try:
+                    callback(path)
+                except Exception:
+                    logger.exception("Reloading %s failed", path)
+
+    def stop(self):
+        self._stop.set()
+        if self._wake is not None:
+            os.write(self._wake[1], b'x')
+        if self._thread is not None:
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            for fd in self._wake:
+                os.close(fd)
+            self._fd = self._wake = None
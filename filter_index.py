@@ -0,0 +1,266 @@
+import logging
+import marshal
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections.abc import MutableMapping
+
+from filter_record import make_record, read_snapshot, to_record
+from trigger_matcher import TriggerMatcher
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'FBIX'
+FORMAT_VERSION = 2
+
+# magic, format version, marshal version, python major/minor, source snapshot
+# (inode, mtime_ns, size), chat count, then a crc32 of everything before it
+_HEADER = struct.Struct('<4sHHBBxxQqQQ')
+_HEADER_CRC = struct.Struct('<I')
+# chat id, blob offset, filters length, matcher length, crc32 of both parts
+_RECORD = struct.Struct('<qQIII')
+_TABLE_START = _HEADER.size + _HEADER_CRC.size
+
+
+def _runtime():
+    # marshal's format depends on the interpreter, so it is part of the header
+    return marshal.version, sys.version_info[0], sys.version_info[1]
+
+
+def write_index(path, snapshot, source_version):
+    """Write a binary index of a filters snapshot (chat id str -> filters)
+
+    Every chat gets a marshalled blob of its filters (trigger -> tuple of
+    RECORD_FIELDS) and of its prebuilt substring matcher, located through a table sorted by chat id. The header
+    records the version of the JSON snapshot it was built from.
+    """
+    chats = sorted((int(chat), chat_filters) for chat, chat_filters in snapshot.items())
+    ino, mtime_ns, size = source_version
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, *_runtime(), ino, mtime_ns, size, len(chats))
+    offset = _TABLE_START + _RECORD.size * len(chats)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header + _HEADER_CRC.pack(zlib.crc32(header)))
+        records = []
+        f.seek(offset)
+        for chat_id, chat_filters in chats:
+            literal = [trigger for trigger, record in chat_filters.items() if not record.get("match")]
+            filters_blob = marshal.dumps(
+                {trigger: to_record(record).to_tuple() for trigger, record in chat_filters.items()})
+            matcher_blob = marshal.dumps(TriggerMatcher(literal).export_state())
+            crc = zlib.crc32(matcher_blob, zlib.crc32(filters_blob))
+            records.append(_RECORD.pack(chat_id, offset, len(filters_blob), len(matcher_blob), crc))
+            f.write(filters_blob)
+            f.write(matcher_blob)
+            offset += len(filters_blob) + len(matcher_blob)
+        f.seek(_TABLE_START)
+        f.write(b''.join(records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class FilterIndex:
+    """Read-only, memory-mapped view of a file written by write_index
+
+    Opening it only checks the header, so it costs the same for ten chats or a
+    million; a chat's blob is located by binary search and checked against its
+    crc32 when it is read. Raises ValueError if the file is not a usable index.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError("index file is empty") from None
+        if len(self._map) < _TABLE_START:
+            raise ValueError("index file is truncated")
+        header = self._map[:_HEADER.size]
+        magic, version, marshal_version, major, minor, ino, mtime_ns, size, count = _HEADER.unpack(header)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("not a filter index of this version")
+        if _HEADER_CRC.unpack_from(self._map, _HEADER.size)[0] != zlib.crc32(header):
+            raise ValueError("index header checksum mismatch")
+        if (marshal_version, major, minor) != _runtime():
+            raise ValueError("index was written by another Python version")
+        if len(self._map) < _TABLE_START + count * _RECORD.size:
+            raise ValueError("index table is truncated")
+        self.source_version = (ino, mtime_ns, size)
+        self.count = count
+
+    def _record(self, chat_id_str):
+        try:
+            chat_id = int(chat_id_str)
+        except ValueError:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = _RECORD.unpack_from(self._map, _TABLE_START + middle * _RECORD.size)
+            if record[0] < chat_id:
+                low = middle + 1
+            elif record[0] > chat_id:
+                high = middle
+            else:
+                return record
+        return None
+
+    def _blobs(self, record):
+        _, offset, filters_length, matcher_length, crc = record
+        filters_blob = self._map[offset:offset + filters_length]
+        matcher_blob = self._map[offset + filters_length:offset + filters_length + matcher_length]
+        if zlib.crc32(matcher_blob, zlib.crc32(filters_blob)) != crc:
+            raise ValueError("chat checksum mismatch")
+        return filters_blob, matcher_blob
+
+    def __contains__(self, chat_id_str):
+        return self._record(chat_id_str) is not None
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield str(_RECORD.unpack_from(self._map, _TABLE_START + position * _RECORD.size)[0])
+
+    def load(self, chat_id_str):
+        """A chat's filters dict, or None if the chat is not in the index"""
+        record = self._record(chat_id_str)
+        if record is None:
+            return None
+        filters = marshal.loads(self._blobs(record)[0])
+        return {sys.intern(trigger): make_record(*fields) for trigger, fields in filters.items()}
+
+    def load_matcher(self, chat_id_str):
+        """A chat's prebuilt TriggerMatcher, or None if the chat is not in the index"""
+        record = self._record(chat_id_str)
+        return TriggerMatcher.from_state(marshal.loads(self._blobs(record)[1])) if record else None
+
+    def close(self):
+        self._map.close()
+
+
+def open_index(path, source_version):
+    """Open the index if it exists and was built from source_version, else None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        index = FilterIndex(path)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring filter index %s: %s", path, e)
+        return None
+    if index.source_version != source_version:
+        logger.info("Filter index %s is stale; loading the JSON snapshot instead", path)
+        index.close()
+        return None
+    return index
+
+
+class LazyChats(MutableMapping):
+    """Filters dict (chat id str -> filters) materialized from a FilterIndex on access
+
+    Chats are unmarshalled the first time they are read and are then held like
+    in a plain dict; writes and deletes never touch the index. If a chat's blob
+    turns out to be corrupt, the JSON snapshot the index was built from is
+    loaded for every chat not materialized yet.
+    """
+
+    def __init__(self, index, snapshot_path):
+        self._index = index
+        self._snapshot_path = snapshot_path
+        self._loaded = {}
+        self._deleted = set()
+
+    def _from_index(self, chat):
+        if self._index is None or chat in self._deleted:
+            return None
+        try:
+            return self._index.load(chat)
+        except ValueError as e:
+            self._fall_back(e)
+            return self._loaded.get(chat)
+
+    def _fall_back(self, error):
+        logger.warning("Filter index is unusable (%s); loading %s", error, self._snapshot_path)
+        data = read_snapshot(self._snapshot_path)
+        for chat, chat_filters in data.items():
+            if chat not in self._loaded and chat not in self._deleted:
+                self._loaded[chat] = chat_filters
+        self._index.close()
+        self._index = None
+
+    def __getitem__(self, chat):
+        chat_filters = self._loaded.get(chat)
+        if chat_filters is None:
+            chat_filters = self._from_index(chat)
+            if chat_filters is None:
+                raise KeyError(chat)
+            self._loaded[chat] = chat_filters
+        return chat_filters
+
+    def __setitem__(self, chat, chat_filters):
+        self._loaded[chat] = chat_filters
+        self._deleted.discard(chat)
+
+    def __delitem__(self, chat):
+        if chat not in self:
+            raise KeyError(chat)
+        self._loaded.pop(chat, None)
+        if self._index is not None:
+            self._deleted.add(chat)
+
+    def __iter__(self):
+        yield from list(self._loaded)
+        if self._index is not None:
+            for chat in self._index:
+                if chat not in self._loaded and chat not in self._deleted:
+                    yield chat
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def peek_items(self):
+        """(chat, filters) pairs without keeping unmaterialized chats in memory"""
+        for chat in self:
+            chat_filters = self._loaded.get(chat)
+            if chat_filters is None:
+                chat_filters = self._from_index(chat)
+            if chat_filters is not None:
+                yield chat, chat_filters
+
+    def release(self, chat):
+        """Forget a materialized chat if it still equals its copy in the index
+
+        A changed chat stays in memory, since the index does not have its
+        changes. Returns whether the chat was released.
+        """
+        chat_filters = self._loaded.get(chat)
+        if chat_filters is None or self._index is None:
+            return False
+        try:
+            if self._index.load(chat) != chat_filters:
+                return False
+        except ValueError:
+            return False
+        del self._loaded[chat]
+        return True
+
+    def copy_loaded(self):
+        """Copies of the materialized chats, the index, and the chats it must not supply
+
+        Call with the lock guarding writes held. Chats that are not
+        materialized never change, so the rest can then be read from the
+        index without that lock; a ValueError from the index means it was
+        found corrupt or closed meanwhile.
+        """
+        loaded = {chat: dict(chat_filters) for chat, chat_filters in self._loaded.items()}
+        return loaded, self._index, set(self._loaded) | self._deleted
+
+    def load_matcher(self, chat):
+        """The chat's prebuilt matcher from the index, or None"""
+        if self._index is None:
+            return None
+        try:
+            return self._index.load_matcher(chat)
+        except ValueError:
+            return None
@@ -0,0 +1,431 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from file_watcher import file_version
+from filter_index import LazyChats, open_index, write_index
+from filter_record import json_default, read_snapshot, to_record, to_records
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PERSISTED_BYTES = REGISTRY.counter(
+    'bot_filter_persisted_bytes_total', 'Bytes written for filters, by journal or snapshot', ('kind',))
+SNAPSHOT_SECONDS = REGISTRY.histogram('bot_filter_snapshot_seconds', 'Time to write a compacted filters snapshot')
+
+
+class FilterJournal:
+    """Append-only journal of filter mutations on top of a JSON snapshot
+
+    Every change is buffered as one JSON line and appended to
+    `<snapshot>.journal` in batches by a background thread, which also fsyncs
+    it. Once enough entries pile up the journal is compacted: the live data is
+    written to a temporary file that atomically replaces the snapshot, and the
+    journal is truncated. Journal operations are idempotent, so replaying
+    entries that already made it into the snapshot is harmless.
+
+    The snapshot may also be changed by someone else (an operator's edit, a
+    standby instance), and other processes may append to the same journal.
+    `check_for_changes` reloads the snapshot with the journal replayed on top,
+    or applies just the journal entries past the offset read so far, and
+    reports the chats that differ to `on_reload`. Compaction is optimistic:
+    the snapshot is only replaced if it is still the version we last read or
+    wrote; otherwise the other writer's changes are merged first. Appends take
+    a shared lock on `<snapshot>.lock` and compaction an exclusive one, under
+    which every writer's journal entries are folded into the new snapshot
+    before the journal is truncated.
+
+    With `index_path` set, every snapshot is also written as a binary index
+    (see filter_index) that the next start memory-maps instead of parsing the
+    JSON, unmarshalling chats only as they are used.
+    """
+
+    def __init__(self, snapshot_path, fsync_interval=1.0, compact_every=500, index_path=None):
+        self.snapshot_path = snapshot_path
+        self.index_path = index_path
+        self.journal_path = snapshot_path + '.journal'
+        self.lock_path = snapshot_path + '.lock'
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        # Held while filters are mutated or copied for compaction
+        self.lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self.data = {}
+        # (inode, mtime, size) of the snapshot we last read or wrote
+        self.version = None
+        # Called with the set of changed chat ids after an external change is loaded
+        self.on_reload = None
+        self.entries_since_compaction = 0
+        self._file = None
+        # Journal lines not yet appended to the file
+        self._pending = []
+        # Bytes of the journal file already reflected in `data`
+        self._journal_offset = 0
+        self._compact_requested = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Load the snapshot, replay the journal tail and return the filters dict"""
+        with _locked(self.lock_path):
+            # Appending after a crash's partial line would corrupt our first entry
+            _trim_torn_tail(self.journal_path)
+        self.version = file_version(self.snapshot_path)
+        index = None
+        if self.index_path and self.version is not None:
+            index = open_index(self.index_path, self.version)
+        with _locked(self.lock_path, shared=True):
+            if index is not None:
+                data = LazyChats(index, self.snapshot_path)
+                replayed = _replay(self.journal_path, data)
+            else:
+                data, replayed = _read_journaled(self.snapshot_path)
+            self._journal_offset = _size(self.journal_path)
+        self.data = data
+        if index is not None:
+            if replayed:
+                # Compacting would unmarshal every chat, so leave it to the background thread
+                self._compact_requested.set()
+        elif replayed:
+            # Start from a clean snapshot so the journal only holds new changes
+            self.compact()
+        elif self.index_path and self.version is not None:
+            # Missing or stale index: the next snapshot writes a fresh one
+            self._compact_requested.set()
+        # Readable too, so _flush can check how the file ends
+        self._file = open(self.journal_path, 'a+', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='filter-journal', daemon=True)
+        self._thread.start()
+        return data
+
+    def record(self, op, chat_id, trigger=None, record=None):
+        """Append one mutation; call with `lock` held after changing `data`"""
+        entry = {"op": op, "chat": str(chat_id)}
+        if trigger is not None:
+            entry["trigger"] = trigger
+        if record is not None:
+            entry["record"] = record
+        line = json.dumps(entry, ensure_ascii=False, default=json_default) + '\n'
+        with self.lock:
+            self._pending.append(line)
+            self.entries_since_compaction += 1
+            if self.entries_since_compaction >= self.compact_every:
+                self._compact_requested.set()
+        PERSISTED_BYTES.inc(len(line.encode('utf-8')), kind='journal')
+
+    def _flush(self):
+        """Append buffered entries to the journal file; returns False if there were none
+
+        Call with `lock_path` locked, so a compaction elsewhere cannot truncate
+        the journal between its read and our append.
+        """
+        with self.lock:
+            if not self._pending or self._file is None:
+                return False
+            lines = ''.join(self._pending)
+            fd = self._file.fileno()
+            size = os.fstat(fd).st_size
+            if size and os.pread(fd, 1, size - 1) != b'\n':
+                # Another writer crashed mid-line; keep our first entry off that line
+                lines = '\n' + lines
+            self._file.write(lines)
+            self._file.flush()
+            self._pending = []
+            end = os.fstat(fd).st_size
+            if size == self._journal_offset and end == size + len(lines.encode('utf-8')):
+                # Nobody else appended before or after us: no need to read our own lines back
+                self._journal_offset = end
+            return True
+
+    def sync(self):
+        """Append buffered journal entries and fsync them"""
+        with _locked(self.lock_path, shared=True):
+            if not self._flush():
+                return
+            fd = self._file.fileno()
+        os.fsync(fd)
+
+    def check_for_changes(self):
+        """Pick up a replaced snapshot or journal entries appended by others; returns the changed chats"""
+        with self._compact_lock:
+            if file_version(self.snapshot_path) == self.version:
+                changed = self._catch_up()
+                if changed is not None:
+                    return changed
+            return self._reload()
+
+    def _catch_up(self):
+        """Apply the journal entries past our offset; None if a full reload is needed instead"""
+        with _locked(self.lock_path, shared=True), self.lock:
+            if file_version(self.snapshot_path) != self.version:
+                return None
+            self._flush()
+            if _size(self.journal_path) < self._journal_offset:
+                return None
+            entries, self._journal_offset = _tail(self.journal_path, self._journal_offset)
+            touched = {entry["chat"] for entry in entries}
+            data = {chat: dict(self.data[chat]) for chat in touched if chat in self.data}
+            for entry in entries:
+                apply_entry(data, entry)
+            return self._adopt(data, touched)
+
+    def _reload(self):
+        """Read the snapshot with our journal replayed on top and adopt the differences"""
+        with _locked(self.lock_path, shared=True), self.lock:
+            self._flush()
+            version = file_version(self.snapshot_path)
+            data, _ = _read_journaled(self.snapshot_path)
+            changed = self._adopt(data, set(data) | set(self.data))
+            self.version = version
+            self._journal_offset = _size(self.journal_path)
+        logger.info("Reloaded %s: %d chats changed on disk", self.snapshot_path, len(changed))
+        return changed
+
+    def _adopt(self, data, chats):
+        """Take over those of `chats` that differ in data; call with `lock` held"""
+        changed = {chat for chat in chats if data.get(chat) != self.data.get(chat)}
+        for chat in changed:
+            if chat in data:
+                self.data[chat] = data[chat]
+            else:
+                del self.data[chat]
+        if changed and self.on_reload is not None:
+            self.on_reload(changed)
+        return changed
+
+    def _adopt_folded(self, folded):
+        """Adopt chats that other writers changed in the journal we just folded
+
+        `folded` maps those chats to their filters in the new snapshot; our
+        journal entries appended since are replayed on top of them.
+        """
+        with _locked(self.lock_path, shared=True), self.lock:
+            if file_version(self.snapshot_path) != self.version:
+                # Replaced again already; the next check_for_changes reloads it all
+                return
+            self._flush()
+            data = {chat: dict(chat_filters) for chat, chat_filters in folded.items() if chat_filters is not None}
+            for entry in _entries(self.journal_path):
+                if entry["chat"] in folded:
+                    apply_entry(data, entry)
+            self._adopt(data, set(folded))
+
+    def compact(self):
+        """Fold the journal into a new snapshot that atomically replaces the old one"""
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        """Write a new snapshot, first merging in changes made on disk by others"""
+        while True:
+            folded = self._write_snapshot()
+            if folded is not None:
+                break
+            # Someone else replaced the snapshot since we last saw it
+            self._reload()
+        if folded:
+            # Other writers' journal entries are in the snapshot now; adopt them
+            self._adopt_folded(folded)
+
+    def _write_snapshot(self):
+        """Copy the filters under the lock, then fold the journal into a new snapshot
+
+        Chats not yet unmarshalled from the index are read after the lock is
+        released. The journal is read, folded in and truncated under the
+        exclusive file lock, so entries appended by other processes end up in
+        the snapshot instead of being dropped. Returns None, leaving the
+        snapshot alone, if it changed on disk; otherwise the chats the journal
+        changed beyond our copy, with their new filters (None if deleted).
+        """
+        index = None
+        with self.lock:
+            if isinstance(self.data, LazyChats):
+                snapshot, index, skip = self.data.copy_loaded()
+            else:
+                snapshot = {chat: dict(chat_filters) for chat, chat_filters in self.data.items()}
+            self.entries_since_compaction = 0
+        started = time.monotonic()
+        if index is not None:
+            try:
+                for chat in index:
+                    if chat not in skip:
+                        snapshot[chat] = index.load(chat)
+            except ValueError:
+                # The index is corrupt (or was just closed for being so); the
+                # slow path falls back to the JSON snapshot
+                with self.lock:
+                    snapshot = {chat: dict(chat_filters) for chat, chat_filters in self.data.peek_items()}
+        tmp_path = self.snapshot_path + '.tmp'
+        with _locked(self.lock_path):
+            if file_version(self.snapshot_path) != self.version:
+                return None
+            self._flush()
+            entries = list(_entries(self.journal_path))
+            touched = {entry["chat"] for entry in entries}
+            before = {chat: dict(snapshot[chat]) for chat in touched if chat in snapshot}
+            for entry in entries:
+                apply_entry(snapshot, entry)
+            folded = {chat: snapshot.get(chat) for chat in touched if snapshot.get(chat) != before.get(chat)}
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f, indent=2, default=json_default)
+                f.flush()
+                os.fsync(f.fileno())
+                written = f.tell()
+            os.replace(tmp_path, self.snapshot_path)
+            if entries:
+                os.truncate(self.journal_path, 0)
+            self._journal_offset = 0
+            self.version = file_version(self.snapshot_path)
+            if self.index_path:
+                write_index(self.index_path, snapshot, self.version)
+        SNAPSHOT_SECONDS.observe(time.monotonic() - started)
+        PERSISTED_BYTES.inc(written, kind='snapshot')
+        return folded
+
+    def _run(self):
+        """Background loop: batch fsyncs and compact when requested"""
+        while not self._closed.wait(self.fsync_interval):
+            try:
+                self.sync()
+                if self._compact_requested.is_set():
+                    self._compact_requested.clear()
+                    self.compact()
+            except Exception:
+                logger.exception("Filter journal maintenance failed")
+
+    def close(self):
+        """Stop the background thread and leave a compacted snapshot behind"""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.compact()
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+@contextlib.contextmanager
+def _locked(lock_path, shared=False):
+    """Inter-process lock on the snapshot and journal (POSIX only)
+
+    Shared for appending to or reading them, exclusive for compaction.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_journaled_snapshot(snapshot_path):
+    """Read a snapshot and replay its journal segments without opening it for writing
+
+    Returns the filters dict (records as FilterRecord) and the number of
+    journal entries replayed.
+    """
+    with _locked(snapshot_path + '.lock', shared=True):
+        return _read_journaled(snapshot_path)
+
+
+def _read_journaled(snapshot_path):
+    # Call with the snapshot's lock file locked
+    data = {}
+    if os.path.exists(snapshot_path):
+        data = read_snapshot(snapshot_path)
+    return data, _replay(snapshot_path + '.journal', data)
+
+
+def _entries(path):
+    """The entries of a journal file, in order"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn write from a crash; later writers start on a new line
+                logger.warning("Ignoring truncated journal entry in %s", path)
+                continue
+            yield entry
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _tail(path, offset):
+    """Complete journal entries after byte `offset`, and the offset just past them"""
+    entries = []
+    if not os.path.exists(path):
+        return entries, 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Still being written; read it next time
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logger.warning("Ignoring truncated journal entry in %s", path)
+    return entries, offset
+
+
+def _trim_torn_tail(path):
+    """Cut a partial last line left by a crash off a journal
+
+    Call with the lock file locked exclusively, so no writer is mid-append.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        content = f.read()
+        if not content or content.endswith(b'\n'):
+            return
+        f.truncate(content.rfind(b'\n') + 1)
+    logger.warning("Dropped a truncated journal entry at the end of %s", path)
+
+
+def _replay(path, data):
+    """Apply the entries of a journal file to data; returns how many there were"""
+    count = 0
+    for entry in _entries(path):
+        apply_entry(data, entry)
+        count += 1
+    return count
+
+
+def apply_entry(data, entry):
+    """Apply a single journal entry to a filters dict"""
+    chat = entry["chat"]
+    op = entry["op"]
+    if op == "set":
+        data.setdefault(chat, {})[sys.intern(entry["trigger"])] = to_record(entry["record"])
+    elif op == "del":
+        data.get(chat, {}).pop(entry["trigger"], None)
+    elif op == "clear":
+        data.pop(chat, None)
+    elif op == "merge":
+        data.setdefault(chat, {}).update(to_records(entry["record"]))
+    elif op == "replace":
+        data[chat] = to_records(entry["record"])
@@ -0,0 +1,114 @@
+import json
+import sys
+
+# Fields of a filter record, in storage order (also the SQLite column order;
+# "match" is the match_mode column there, since MATCH is an SQL keyword)
+RECORD_FIELDS = ("type", "media_type", "file_id", "caption", "content", "match")
+
+
+class FilterRecord:
+    """One stored filter reply: a read-only, dict-like object with __slots__
+
+    Replaces the per-filter dict of `type`/`media_type`/`file_id`/`caption`/
+    `content`/`match`, so a record costs one small object instead of a dict
+    with its own key table. Fields that are None are absent: `record["caption"]`
+    raises KeyError and `keys()` skips them, exactly like the dicts in
+    chat_filters.json. Records may be shared, so they are never changed in
+    place; build a new one instead.
+    """
+
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, type, media_type=None, file_id=None, caption=None, content=None, match=None):
+        self.type = type
+        self.media_type = media_type
+        self.file_id = file_id
+        self.caption = caption
+        self.content = content
+        self.match = match
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in RECORD_FIELDS else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in RECORD_FIELDS else None
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in RECORD_FIELDS and getattr(self, key) is not None
+
+    def keys(self):
+        return [field for field in RECORD_FIELDS if getattr(self, field) is not None]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in RECORD_FIELDS if getattr(self, field) is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_tuple(self):
+        return tuple(getattr(self, field) for field in RECORD_FIELDS)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, FilterRecord):
+            return self.to_tuple() == other.to_tuple()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.to_tuple())
+
+    def __repr__(self):
+        return f"FilterRecord({self.to_dict()!r})"
+
+
+def _intern(value, intern=sys.intern):
+    return value if value is None else intern(value)
+
+
+def make_record(*fields):
+    """A FilterRecord from RECORD_FIELDS values, with its strings interned
+
+    Interning makes every chat that uses the same sticker, photo or reply text
+    share one copy of the string; interned strings are freed again once no
+    record refers to them.
+    """
+    return FilterRecord(*map(_intern, fields))
+
+
+def to_record(record):
+    """A FilterRecord from a stored dict (or another record)"""
+    if isinstance(record, FilterRecord):
+        return record
+    get = record.get
+    return FilterRecord(_intern(get("type")), _intern(get("media_type")), _intern(get("file_id")),
+                        _intern(get("caption")), _intern(get("content")), _intern(get("match")))
+
+
+def to_records(chat_filters):
+    """Convert a chat's trigger -> dict mapping to interned triggers and records"""
+    return {sys.intern(trigger): to_record(record) for trigger, record in chat_filters.items()}
+
+
+def read_snapshot(snapshot_path):
+    """Read a chat_filters.json snapshot with every record as an interned FilterRecord"""
+    with open(snapshot_path, 'r') as f:
+        data = json.load(f)
+    return {sys.intern(chat): to_records(chat_filters) for chat, chat_filters in data.items()}
+
+
+def json_default(value):
+    """`default` for json.dump so records are written as the plain dicts they replace"""
+    if isinstance(value, FilterRecord):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
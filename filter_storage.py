@@ -0,0 +1,263 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from filter_index import LazyChats
+from filter_journal import FilterJournal, read_journaled_snapshot
+from filter_record import RECORD_FIELDS, make_record
+
+logger = logging.getLogger(__name__)
+
+
+class FilterStorage:
+    """Interface FilterBot uses to load and persist filters one chat at a time
+
+    Chat ids are passed as strings and filter records use the same
+    `type`/`media_type`/`file_id`/`caption`/`content`/`match` layout as
+    chat_filters.json.
+    Callers hold `lock` around a mutation and the matching storage call.
+    Changes made by other processes are picked up by `check_for_changes`
+    (called when one of `watch_paths` changes), which passes the ids of the
+    chats that changed to `on_change`.
+    """
+
+    watch_paths = ()
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.on_change = None
+
+    def load_chat(self, chat_id_str):
+        """Return a dict of trigger -> record for one chat"""
+        raise NotImplementedError
+
+    def put_filter(self, chat_id_str, trigger, record):
+        """Insert or replace one filter"""
+        raise NotImplementedError
+
+    def put_filters(self, chat_id_str, filters, replace=False):
+        """Insert or replace many filters at once, dropping the others if `replace`"""
+        raise NotImplementedError
+
+    def delete_filter(self, chat_id_str, trigger):
+        """Delete one filter"""
+        raise NotImplementedError
+
+    def delete_chat(self, chat_id_str):
+        """Delete every filter of a chat"""
+        raise NotImplementedError
+
+    def release_chat(self, chat_id_str):
+        """Drop the store's own in-memory copy of a chat the caller stopped caching"""
+
+    def load_matcher(self, chat_id_str):
+        """A prebuilt TriggerMatcher for the chat's substring triggers, or None
+
+        It may be older than the chat's filters; callers check it before use.
+        """
+        return None
+
+    def check_for_changes(self):
+        """Load changes made by other writers and report the affected chats"""
+
+    def _changed(self, chat_id_strs):
+        if chat_id_strs and self.on_change is not None:
+            self.on_change(chat_id_strs)
+
+    def compact(self):
+        """Fold pending changes into the main store"""
+
+    def close(self):
+        """Flush pending changes and release resources"""
+
+
+class JournalStorage(FilterStorage):
+    """chat_filters.json snapshot plus append-only journal, held in memory
+
+    Chats are loaded lazily from the binary index at `index_path` when it is
+    up to date with the snapshot, and all at once from the JSON otherwise.
+    """
+
+    def __init__(self, snapshot_path, fsync_interval=1.0, compact_every=500, index_path=None):
+        super().__init__()
+        self.journal = FilterJournal(snapshot_path, fsync_interval, compact_every, index_path)
+        self.journal.on_reload = self._changed
+        self.lock = self.journal.lock
+        self.data = self.journal.load()
+        # Other writers either replace the snapshot or append to the journal
+        self.watch_paths = (snapshot_path, snapshot_path + '.journal')
+
+    def load_chat(self, chat_id_str):
+        return self.data.get(chat_id_str, {})
+
+    def put_filter(self, chat_id_str, trigger, record):
+        with self.lock:
+            self.data.setdefault(chat_id_str, {})[trigger] = record
+            self.journal.record("set", chat_id_str, trigger, record)
+
+    def put_filters(self, chat_id_str, filters, replace=False):
+        with self.lock:
+            if replace:
+                self.data[chat_id_str] = dict(filters)
+            else:
+                self.data.setdefault(chat_id_str, {}).update(filters)
+            # One journal line for the whole batch
+            self.journal.record("replace" if replace else "merge", chat_id_str, record=filters)
+
+    def delete_filter(self, chat_id_str, trigger):
+        with self.lock:
+            self.data.get(chat_id_str, {}).pop(trigger, None)
+            self.journal.record("del", chat_id_str, trigger)
+
+    def delete_chat(self, chat_id_str):
+        with self.lock:
+            self.data.pop(chat_id_str, None)
+            self.journal.record("clear", chat_id_str)
+
+    def release_chat(self, chat_id_str):
+        # Only chats unpacked from the index and unchanged since can be freed
+        if isinstance(self.data, LazyChats):
+            with self.lock:
+                self.data.release(chat_id_str)
+
+    def load_matcher(self, chat_id_str):
+        if isinstance(self.data, LazyChats):
+            return self.data.load_matcher(chat_id_str)
+        return None
+
+    def check_for_changes(self):
+        self.journal.check_for_changes()
+
+    def compact(self):
+        self.journal.compact()
+
+    def close(self):
+        self.journal.close()
+
+
+class SQLiteStorage(FilterStorage):
+    """SQLite (WAL mode) filter store; chats are read with one indexed query each"""
+
+    def __init__(self, db_path, migrate_from=None):
+        super().__init__()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS filters ("
+            " chat_id TEXT NOT NULL,"
+            " trigger TEXT NOT NULL,"
+            " type TEXT NOT NULL,"
+            " media_type TEXT,"
+            " file_id TEXT,"
+            " caption TEXT,"
+            " content TEXT,"
+            " match_mode TEXT,"
+            " PRIMARY KEY (chat_id, trigger)"
+            ") WITHOUT ROWID"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(filters)")}
+        if "match_mode" not in columns:
+            # Databases created before match modes existed
+            self.conn.execute("ALTER TABLE filters ADD COLUMN match_mode TEXT")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Per-chat generation, bumped by triggers on every write from any process
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_generations (chat_id TEXT PRIMARY KEY, generation INTEGER NOT NULL)"
+            " WITHOUT ROWID")
+        for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            self.conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS filters_{event.lower()}_generation AFTER {event} ON filters BEGIN"
+                f" INSERT INTO chat_generations VALUES ({row}.chat_id, 1)"
+                " ON CONFLICT(chat_id) DO UPDATE SET generation = generation + 1; END")
+        if migrate_from:
+            self.migrate_from_json(migrate_from)
+        self.watch_paths = (db_path, db_path + '-wal')
+        self._data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self._generations = dict(self.conn.execute("SELECT chat_id, generation FROM chat_generations"))
+
+    def migrate_from_json(self, snapshot_path):
+        """One-shot import of chat_filters.json (and its journal) into the database"""
+        with self.lock:
+            done = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone()
+            if done or not os.path.exists(snapshot_path):
+                return 0
+            data, _ = read_journaled_snapshot(snapshot_path)
+            rows = [
+                (chat_id_str, trigger) + tuple(record.get(field) for field in RECORD_FIELDS)
+                for chat_id_str, chat_filters in data.items()
+                for trigger, record in chat_filters.items()
+            ]
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany("INSERT OR REPLACE INTO filters VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.conn.execute("INSERT INTO meta VALUES ('migrated_from', ?)", (snapshot_path,))
+        logger.info("Migrated %d filters from %s to SQLite", len(rows), snapshot_path)
+        return len(rows)
+
+    def load_chat(self, chat_id_str):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT trigger, type, media_type, file_id, caption, content, match_mode FROM filters WHERE chat_id = ?",
+                (chat_id_str,),
+            ).fetchall()
+        chat_filters = {}
+        for trigger, kind, media_type, file_id, caption, content, match in rows:
+            if kind == "media":
+                record = make_record("media", media_type, file_id, caption or "", None, match or None)
+            else:
+                record = make_record("text", None, None, None, content, match or None)
+            chat_filters[sys.intern(trigger)] = record
+        return chat_filters
+
+    def put_filter(self, chat_id_str, trigger, record):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO filters VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (chat_id_str, trigger) + tuple(record.get(field) for field in RECORD_FIELDS),
+            )
+
+    def put_filters(self, chat_id_str, filters, replace=False):
+        rows = [
+            (chat_id_str, trigger) + tuple(record.get(field) for field in RECORD_FIELDS)
+            for trigger, record in filters.items()
+        ]
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            if replace:
+                self.conn.execute("DELETE FROM filters WHERE chat_id = ?", (chat_id_str,))
+            self.conn.executemany("INSERT OR REPLACE INTO filters VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def delete_filter(self, chat_id_str, trigger):
+        with self.lock:
+            self.conn.execute("DELETE FROM filters WHERE chat_id = ? AND trigger = ?", (chat_id_str, trigger))
+
+    def delete_chat(self, chat_id_str):
+        with self.lock:
+            self.conn.execute("DELETE FROM filters WHERE chat_id = ?", (chat_id_str,))
+
+    def check_for_changes(self):
+        with self.lock:
+            # data_version only moves when another connection commits
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            generations = dict(self.conn.execute("SELECT chat_id, generation FROM chat_generations"))
+            # Includes chats this process wrote since the last check; reloading those is harmless
+            changed = {chat for chat, generation in generations.items() if self._generations.get(chat) != generation}
+            self._generations = generations
+            self._changed(changed)
+        if changed:
+            logger.info("Reloaded %d chats changed in the filters database", len(changed))
+
+    def compact(self):
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        self.compact()
+        with self.lock:
+            self.conn.close()
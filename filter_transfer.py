@@ -0,0 +1,106 @@
+import json
+
+from trigger_matcher import MATCH_MODES
+
+# Media types a filter reply can use, as stored in a record's "media_type"
+MEDIA_TYPES = ("photo", "video", "document", "audio", "voice", "sticker")
+
+# Longest reply text or caption accepted on import (Telegram's message limit)
+MAX_REPLY_LENGTH = 4096
+
+# Longest trigger accepted, so its /filters line always fits on a page
+MAX_TRIGGER_LENGTH = 256
+
+
+def utf16_length(text):
+    """Length of text as Telegram counts it, in UTF-16 code units
+
+    Emoji and other characters outside the Basic Multilingual Plane count
+    twice, so this can be larger than len(text).
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+
+def dump_filters(items):
+    """Serialize (trigger, record) pairs as a JSON list, one filter per line
+
+    Each element is the stored record with its trigger added, e.g.
+    {"trigger": "hi", "type": "text", "content": "Hello!"}.
+    """
+    lines = [json.dumps({"trigger": trigger, **record}, ensure_ascii=False) for trigger, record in items]
+    return ('[\n' + ',\n'.join(lines) + '\n]\n').encode('utf-8')
+
+
+def iter_entries(stream, chunk_size=65536):
+    """Yield the elements of a top-level JSON list read incrementally from stream
+
+    Only one element plus one chunk is held in memory at a time. Raises
+    ValueError when the document is not a JSON list.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = '', 0, False
+    started = False
+
+    def refill():
+        nonlocal buffer, pos, eof
+        chunk = stream.read(chunk_size)
+        buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+
+    while True:
+        # Skip whitespace, and the commas between elements
+        separators = ' \t\r\n,' if started else ' \t\r\n\ufeff'
+        while True:
+            while pos < len(buffer) and buffer[pos] in separators:
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            refill()
+        if pos >= len(buffer):
+            raise ValueError("the document ended before the list was closed")
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError("expected a JSON list of filters")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise ValueError(f"invalid JSON: {e}") from None
+            # The element continues in the next chunk
+            refill()
+            continue
+        pos = end
+        yield value
+
+
+def parse_entry(entry):
+    """Validate one imported element; returns add_filter keyword arguments
+
+    Raises ValueError describing why the entry was rejected.
+    """
+    if not isinstance(entry, dict):
+        raise ValueError("entry is not an object")
+    trigger = entry.get("trigger")
+    if not isinstance(trigger, str):
+        raise ValueError("trigger must be a string")
+    match = entry.get("match")
+    if match is not None and match not in MATCH_MODES:
+        raise ValueError(f"unknown match mode {match!r}")
+    if entry.get("type") == "media":
+        media_type = entry.get("media_type")
+        file_id = entry.get("file_id")
+        if media_type not in MEDIA_TYPES or not isinstance(file_id, str) or not file_id:
+            raise ValueError("media filters need a known media_type and a file_id")
+        reply = entry.get("caption") or ""
+    elif entry.get("type") == "text":
+        media_type = file_id = None
+        reply = entry.get("content")
+    else:
+        raise ValueError("type must be \"text\" or \"media\"")
+    if not isinstance(reply, str) or utf16_length(reply) > MAX_REPLY_LENGTH:
+        raise ValueError(f"reply must be a string of at most {MAX_REPLY_LENGTH} characters")
+    return {"trigger": trigger, "reply": reply, "media_type": media_type, "file_id": file_id, "match": match}
@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+# Installed with python-telegram-bot; APScheduler (behind the JobQueue) only
+# accepts pytz timezones
+import pytz
+
+logger = logging.getLogger(__name__)
+
+
+class GoodMorningScheduler:
+    """Daily good morning job per group chat, run on the bot's JobQueue
+
+    Each chat has a window (hours, local to the chat's timezone) and its message
+    is sent at a fixed point inside that window derived from the chat id, so
+    thousands of groups are spread over the window instead of all firing at its
+    start. The last send time is saved to `state_file`, so a restart neither
+    repeats nor skips a day's greeting. Windows and timezones set per chat are
+    kept in `settings` (a ChatSettings) when given, else in `state_file` too.
+
+    The file is written by a background thread `save_delay` seconds after a
+    change, so enrolling a new chat from the message handler costs no I/O.
+    """
+
+    def __init__(self, state_file, default_window=(6, 10), default_timezone=None, settings=None, save_delay=2.0):
+        self.state_file = state_file
+        self.default_window = default_window
+        self.default_timezone = default_timezone
+        self.settings = settings
+        self.save_delay = save_delay
+        self.lock = threading.Lock()
+        self._chats = {}
+        self._job_queue = None
+        self._send_func = None
+        self._cond = threading.Condition(self.lock)
+        self._dirty = False
+        self._stopping = False
+        self._thread = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                chats = json.load(f)
+        except ValueError as e:
+            logger.warning("Could not read good morning state from %s: %s", self.state_file, e)
+            return
+        self._chats = {int(chat_id): conf for chat_id, conf in chats.items()}
+
+    def _mark_dirty(self):
+        # Called with the lock held
+        self._dirty = True
+        self._cond.notify()
+
+    def flush(self):
+        """Atomically write chat windows and last send times, if anything changed"""
+        with self.lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            chats = {str(chat_id): dict(conf) for chat_id, conf in self._chats.items()}
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(chats, f, indent=2)
+        os.replace(tmp_path, self.state_file)
+
+    def _run_writer(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+            # Let a burst of new chats settle into one write
+            time.sleep(self.save_delay)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error("Could not save good morning state: %s", e)
+                with self.lock:
+                    self._dirty = True
+
+    def start(self, job_queue, send_func):
+        """Schedule every known chat; send_func(bot, chat_id) sends the greeting"""
+        self._job_queue = job_queue
+        self._send_func = send_func
+        self._thread = threading.Thread(target=self._run_writer, name='good-morning-state', daemon=True)
+        self._thread.start()
+        with self.lock:
+            chat_ids = list(self._chats)
+        for chat_id in chat_ids:
+            self._schedule(chat_id)
+
+    def stop(self):
+        """Stop the writer thread and write what is pending"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def register(self, chat_id):
+        """Start greeting a group chat; cheap enough to call on every message"""
+        if chat_id in self._chats:
+            return
+        with self.lock:
+            if chat_id in self._chats:
+                return
+            self._chats[chat_id] = {"last_sent": 0}
+            self._mark_dirty()
+        self._schedule(chat_id)
+
+    def set_window(self, chat_id, start_hour, end_hour, timezone=None):
+        """Change a chat's window (and optionally timezone) and reschedule it"""
+        if not 0 <= start_hour < end_hour <= 24:
+            raise ValueError("window must satisfy 0 <= start < end <= 24")
+        if timezone is not None:
+            self._tzinfo(timezone)
+        if self.settings is not None:
+            values = {"good_morning_window": [start_hour, end_hour]}
+            if timezone is not None:
+                values["good_morning_timezone"] = timezone
+            self.settings.update(chat_id, **values)
+        with self.lock:
+            conf = self._chats.setdefault(chat_id, {"last_sent": 0})
+            if self.settings is None:
+                conf["window"] = [start_hour, end_hour]
+                if timezone is not None:
+                    conf["timezone"] = timezone
+            self._mark_dirty()
+        self._schedule(chat_id)
+
+    def reschedule(self, chat_ids):
+        """Reschedule chats whose window may have changed elsewhere"""
+        for chat_id in chat_ids:
+            if chat_id in self._chats:
+                self._schedule(chat_id)
+
+    def get_window(self, chat_id):
+        """(start_hour, end_hour, timezone name or None) for a chat"""
+        with self.lock:
+            conf = self._chats.get(chat_id, {})
+            window = conf.get("window", self.default_window)
+            timezone = conf.get("timezone", self.default_timezone)
+        if self.settings is not None:
+            window = self.settings.get(chat_id, "good_morning_window", window)
+            timezone = self.settings.get(chat_id, "good_morning_timezone", timezone)
+        start, end = window
+        return start, end, timezone
+
+    def _tzinfo(self, name):
+        if not name:
+            # Server time: its current UTC offset
+            return pytz.FixedOffset(datetime.now().astimezone().utcoffset() // timedelta(minutes=1))
+        try:
+            return pytz.timezone(name)
+        except pytz.UnknownTimeZoneError:
+            raise ValueError(f"unknown timezone {name!r}") from None
+
+    def next_run(self, chat_id, now=None):
+        """Next time the chat should be greeted, as an aware datetime in UTC"""
+        start, end, timezone = self.get_window(chat_id)
+        tz = self._tzinfo(timezone)
+        now = now.astimezone(tz) if now else datetime.now(tz)
+        with self.lock:
+            last_sent = self._chats.get(chat_id, {}).get("last_sent", 0)
+        last_date = datetime.fromtimestamp(last_sent, tz).date() if last_sent else None
+        # Stable position of this chat inside its window, between 0 and 1
+        spread = (zlib.crc32(str(chat_id).encode()) % 10000) / 10000
+        for days in range(3):
+            day = now.date() + timedelta(days=days)
+            if day == last_date:
+                continue
+            # localize() gives each wall-clock hour its own UTC offset (DST)
+            midnight = datetime(day.year, day.month, day.day)
+            window_start = tz.localize(midnight + timedelta(hours=start))
+            window_end = tz.localize(midnight + timedelta(hours=end))
+            fire = window_start + (window_end - window_start) * spread
+            if fire > now:
+                return fire.astimezone(pytz.utc)
+            if now < window_end:
+                # Missed the slot (e.g. restarted mid-window): spread over what is left
+                return (now + (window_end - now) * spread).astimezone(pytz.utc)
+        return None
+
+    def _schedule(self, chat_id):
+        if self._job_queue is None:
+            return
+        name = f"good_morning:{chat_id}"
+        for job in self._job_queue.get_jobs_by_name(name):
+            job.schedule_removal()
+        when = self.next_run(chat_id)
+        if when is not None:
+            self._job_queue.run_once(self._run_job, when, context=chat_id, name=name)
+
+    def _run_job(self, context):
+        chat_id = context.job.context
+        try:
+            self._send_func(context.bot, chat_id)
+        finally:
+            with self.lock:
+                self._chats.setdefault(chat_id, {})["last_sent"] = time.time()
+                self._mark_dirty()
+            self._schedule(chat_id)
@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+
+
+class MatchCache:
+    """Per-chat LRU of message text -> match result, capped across all chats
+
+    Busy groups repeat the same short messages ("hi", "gm", emoji) over and
+    over; a hit returns the stored (trigger, record) without lower-casing or
+    scanning the message. Each chat's entries are tagged with the chat's filter
+    generation, and a lookup with a newer generation discards them, so a
+    result computed before a filter change is never returned after it.
+
+    Only messages of at most `max_text` characters are cached. A chat holds at
+    most `per_chat` entries and all chats together at most `max_entries`;
+    beyond that the least recently used chat is dropped first, so memory stays
+    below roughly `max_entries * max_text` characters plus bookkeeping.
+    """
+
+    def __init__(self, max_entries=50000, per_chat=256, max_text=64):
+        self.max_entries = max_entries
+        self.per_chat = per_chat
+        self.max_text = max_text
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._entries = 0
+        # chat id str -> (generation, OrderedDict of text -> result), least recently used first
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._entries
+
+    def get(self, chat_id_str, generation, text):
+        """The cached result for text, or None if there is none for this generation"""
+        if self.max_entries <= 0 or len(text) > self.max_text:
+            return None
+        with self._lock:
+            cached = self._chats.get(chat_id_str)
+            if cached is not None and cached[0] != generation:
+                # The chat's filters changed since these results were computed
+                self._entries -= len(cached[1])
+                del self._chats[chat_id_str]
+                self.stale += 1
+                cached = None
+            result = cached[1].get(text) if cached is not None else None
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._chats.move_to_end(chat_id_str)
+            cached[1].move_to_end(text)
+            return result
+
+    def put(self, chat_id_str, generation, text, result):
+        """Store the result of matching text against the chat's filters at generation"""
+        if self.max_entries <= 0 or len(text) > self.max_text:
+            return
+        with self._lock:
+            cached = self._chats.get(chat_id_str)
+            if cached is None or cached[0] != generation:
+                if cached is not None:
+                    self._entries -= len(cached[1])
+                cached = self._chats[chat_id_str] = (generation, OrderedDict())
+            results = cached[1]
+            if text not in results:
+                self._entries += 1
+            results[text] = result
+            results.move_to_end(text)
+            self._chats.move_to_end(chat_id_str)
+            if len(results) > self.per_chat:
+                results.popitem(last=False)
+                self._entries -= 1
+            while self._entries > self.max_entries:
+                _, (_, evicted) = self._chats.popitem(last=False)
+                self._entries -= len(evicted)
+
+    def discard(self, chat_id_str):
+        """Drop a chat's entries"""
+        with self._lock:
+            cached = self._chats.pop(chat_id_str, None)
+            if cached is not None:
+                self._entries -= len(cached[1])
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._chats.clear()
+            self._entries = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._entries,
+            "chats": len(self._chats),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
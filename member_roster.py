@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def format_mention(user_id, username, first_name):
+    """Markdown mention for a user: @username when available, else an inline link"""
+    return f"@{username}" if username else f"[{first_name}](tg://user?id={user_id})"
+
+
+class MemberRoster:
+    """Per-chat cache of recently seen members and chat administrators
+
+    Members are learned passively from the messages the bot already receives and
+    kept most-recent-first, capped per chat and in number of chats. Administrators
+    come from get_chat_administrators but are cached for `admin_ttl` seconds; an
+    expired or missing entry is refreshed through `send` (the outbound queue's
+    submit, returning a Future) while callers keep using what is cached, so
+    building a mention list never waits on the API.
+    """
+
+    def __init__(self, send, max_members_per_chat=200, max_chats=10000, admin_ttl=3600):
+        self.send = send
+        self.max_members_per_chat = max_members_per_chat
+        self.max_chats = max_chats
+        self.admin_ttl = admin_ttl
+        self.lock = threading.Lock()
+        self._members = OrderedDict()
+        self._admins = {}
+        self._refreshing = set()
+        self.hits = 0
+        self.misses = 0
+
+    def observe(self, chat_id, user):
+        """Record a message sender as an active member of the chat"""
+        if user is None or user.is_bot:
+            return
+        with self.lock:
+            members = self._members.get(chat_id)
+            if members is None:
+                members = self._members[chat_id] = OrderedDict()
+                while len(self._members) > self.max_chats:
+                    evicted, _ = self._members.popitem(last=False)
+                    self._admins.pop(evicted, None)
+            else:
+                self._members.move_to_end(chat_id)
+            members[user.id] = (user.username, user.first_name)
+            members.move_to_end(user.id)
+            if len(members) > self.max_members_per_chat:
+                members.popitem(last=False)
+
+    def get_admins(self, chat_id, bot=None):
+        """Cached (user_id, username, first_name) admins; refreshes in the background"""
+        with self.lock:
+            cached = self._admins.get(chat_id)
+            if cached is not None and cached[0] > time.time():
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            refresh = bot is not None and chat_id not in self._refreshing
+            if refresh:
+                self._refreshing.add(chat_id)
+            result = cached[1] if cached is not None else []
+        if refresh:
+            # Admin lookups don't count against the chat's message limit
+            future = self.send(chat_id, bot.get_chat_administrators, chat_id, chat_limited=False)
+            future.add_done_callback(lambda done: self._admins_fetched(chat_id, done))
+        return result
+
+    def _admins_fetched(self, chat_id, future):
+        try:
+            chat_admins = future.result()
+            admins = [
+                (admin.user.id, admin.user.username, admin.user.first_name)
+                for admin in chat_admins if not admin.user.is_bot
+            ]
+            with self.lock:
+                self._admins[chat_id] = (time.time() + self.admin_ttl, admins)
+        except Exception as admin_error:
+            logger.warning("Could not get chat administrators: %s", admin_error)
+        finally:
+            with self.lock:
+                self._refreshing.discard(chat_id)
+
+    def mention_list(self, chat_id, bot=None, exclude_user_id=None, limit=8):
+        """Mentions for admins first, then the most recently active members"""
+        admins = self.get_admins(chat_id, bot)
+        with self.lock:
+            members = list(self._members.get(chat_id, {}).items())
+        mentions = []
+        seen = {exclude_user_id}
+        candidates = admins + [(user_id, username, first_name)
+                               for user_id, (username, first_name) in reversed(members)]
+        for user_id, username, first_name in candidates:
+            if user_id in seen:
+                continue
+            seen.add(user_id)
+            mentions.append(format_mention(user_id, username, first_name))
+            if len(mentions) >= limit:
+                break
+        return mentions
+
+    def stats(self):
+        """Admin cache hit/miss counters and roster size"""
+        with self.lock:
+            return {
+                "admin_cache_hits": self.hits,
+                "admin_cache_misses": self.misses,
+                "chats": len(self._members),
+                "members": sum(len(members) for members in self._members.values()),
+            }
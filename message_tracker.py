@@ -0,0 +1,75 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class TrackedMessage:
+    """Who a bot reply was sent to and when; slots keep each record small"""
+    __slots__ = ("user_id", "sent_at")
+
+    def __init__(self, user_id, sent_at):
+        self.user_id = user_id
+        self.sent_at = sent_at
+
+
+class SentMessageTracker:
+    """Bounded record of the bot's replies, keyed by (chat_id, message_id)
+
+    Entries are kept in insertion order; the oldest ones are dropped once there
+    are more than `max_entries` or they are older than `max_age` seconds, so
+    memory stays flat however long the bot runs.
+    """
+
+    def __init__(self, max_entries=10000, max_age=24 * 3600):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, chat_id, message_id, user_id):
+        """Remember that message_id in chat_id was a reply to user_id"""
+        now = time.time()
+        with self.lock:
+            self._entries[(chat_id, message_id)] = TrackedMessage(user_id, now)
+            self._evict(now)
+
+    def get(self, chat_id, message_id):
+        """The TrackedMessage for a reply, or None if unknown or expired"""
+        with self.lock:
+            entry = self._entries.get((chat_id, message_id))
+        if entry is None or time.time() - entry.sent_at > self.max_age:
+            return None
+        return entry
+
+    def _evict(self, now):
+        entries = self._entries
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evicted += 1
+        cutoff = now - self.max_age
+        while entries:
+            oldest = next(iter(entries.values()))
+            if oldest.sent_at >= cutoff:
+                break
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def memory_usage(self):
+        """Approximate bytes held by the tracker (index, keys and records)"""
+        with self.lock:
+            entries = list(self._entries.items())
+            total = sys.getsizeof(self._entries)
+        for key, entry in entries:
+            total += sys.getsizeof(key) + sys.getsizeof(entry)
+        return total
+
+    def stats(self):
+        return {"entries": len(self._entries), "evicted": self.evicted, "bytes": self.memory_usage()}
@@ -0,0 +1,189 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Base for metrics keyed by a tuple of label values"""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) tuples for exposition"""
+        with self.lock:
+            return [('', key, (), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {value}")
+        return '\n'.join(lines)
+
+
+def _function_samples(function):
+    """Samples of a value (or dict of label value(s) -> value) read at scrape time"""
+    value = function()
+    if isinstance(value, dict):
+        return [('', key if isinstance(key, tuple) else (key,), (), item) for key, item in value.items()]
+    return [('', (), (), value)]
+
+
+class Counter(Metric):
+    """Counter incremented explicitly, or read at scrape time from a function
+
+    The function form exports a total some object already keeps (hits, busy
+    seconds); it must only ever go up.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        return _function_samples(self.function)
+
+
+class Gauge(Metric):
+    """Gauge set explicitly, or sampled from a function at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        return _function_samples(self.function)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            states = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        samples = []
+        for key, counts, total, count in states:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', key, (('le', bound),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered together in Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self._register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        blocks = []
+        for metric in metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception:
+                logger.exception("Could not collect metric %s", metric.name)
+        return '\n'.join(blocks) + '\n'
+
+
+# Process-wide registry shared by all modules
+REGISTRY = Registry()
+
+
+def start_http_server(port, addr='127.0.0.1', registry=REGISTRY):
+    """Serve registry.render() at /metrics on a background thread"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info("Metrics available at http://%s:%s/metrics", addr, server.server_address[1])
+    return server
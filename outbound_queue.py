@@ -0,0 +1,255 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+# Lower values are sent first
+PRIORITY_REPLY = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_DELETE = 2
+
+OUTBOUND_CALLS = REGISTRY.counter(
+    'bot_outbound_calls_total', 'Telegram API calls by method and error type ("none" on success)',
+    ('method', 'error'))
+OUTBOUND_SECONDS = REGISTRY.histogram('bot_outbound_call_seconds', 'Telegram API call latency', ('method',))
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, bursts up to `capacity`"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundCall:
+    __slots__ = ("chat_id", "priority", "chat_limited", "func", "args", "kwargs", "future", "attempts", "not_before")
+
+    def __init__(self, chat_id, priority, chat_limited, func, args, kwargs):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.chat_limited = chat_limited
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class OutboundQueue:
+    """Single sender thread for Telegram API calls, paced to Telegram's limits
+
+    Calls are queued per priority and per chat. The sender serves priorities in
+    order (replies before background sends before deletions) and rotates between
+    chats inside a priority, taking a token from a global bucket (~30 calls/s) and
+    from the chat's own bucket (~20/min for groups, ~1/s for private chats). A
+    `RetryAfter` error pauses that chat for the requested time and the call is
+    retried, so bursts slow down instead of being dropped. Up to `senders` calls
+    are in flight at once, but never two for the same chat, so a chat's messages
+    keep their order. Calls submitted with `chat_limited=False` (answers to
+    callback queries, which are not messages) skip the chat queues and buckets
+    and go out ahead of everything else, subject only to the global bucket.
+    """
+
+    def __init__(self, global_rate=30.0, group_per_minute=20, private_rate=1.0, max_retries=5,
+                 senders=4, max_idle_chats=10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate = group_per_minute / 60.0
+        self.group_burst = max(1.0, group_per_minute / 4.0)
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._queues = [OrderedDict() for _ in (PRIORITY_REPLY, PRIORITY_BACKGROUND, PRIORITY_DELETE)]
+        self._unlimited = deque()
+        self._buckets = OrderedDict()
+        self._in_flight = set()
+        self._unlimited_in_flight = 0
+        self._senders = ThreadPoolExecutor(max_workers=senders, thread_name_prefix='outbound-send')
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='outbound', daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id, func, /, *args, priority=PRIORITY_REPLY, chat_limited=True, **kwargs):
+        """Queue func(*args, **kwargs) for chat_id; returns a Future of its result"""
+        call = OutboundCall(chat_id, priority, chat_limited, func, args, kwargs)
+        with self._cond:
+            if chat_limited:
+                self._queues[priority].setdefault(chat_id, deque()).append(call)
+            else:
+                self._unlimited.append(call)
+            self._pending += 1
+            self._cond.notify()
+        return call.future
+
+    def pending(self):
+        """Calls waiting to be sent"""
+        return self._pending
+
+    def stats(self):
+        return {"pending": self._pending, "sent": self.sent, "retried": self.retried, "failed": self.failed}
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, 1.0)
+            self._buckets[chat_id] = bucket
+            if len(self._buckets) > self.max_idle_chats:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    def _next_call(self, now):
+        """Pick the next sendable call and its chat bucket, or how long to wait"""
+        wait = self.global_bucket.wait_time(now)
+        if wait:
+            return None, None, wait
+        wait = None
+        if self._unlimited:
+            if self._unlimited[0].not_before <= now:
+                return self._unlimited.popleft(), None, 0
+            wait = self._unlimited[0].not_before - now
+        for chat_queues in self._queues:
+            for chat_id in list(chat_queues):
+                if chat_id in self._in_flight:
+                    continue
+                bucket = self._bucket(chat_id)
+                chat_wait = bucket.wait_time(now)
+                if chat_wait:
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                    continue
+                calls = chat_queues.pop(chat_id)
+                call = calls.popleft()
+                if calls:
+                    # Back of the rotation so other chats get their turn
+                    chat_queues[chat_id] = calls
+                return call, bucket, 0
+        return None, None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping and not self._pending and not self._in_flight and not self._unlimited_in_flight:
+                        return
+                    call, bucket, wait = self._next_call(time.monotonic())
+                    if call is not None:
+                        break
+                    self._cond.wait(wait)
+                self.global_bucket.take()
+                self._pending -= 1
+                if call.chat_limited:
+                    bucket.take()
+                    self._in_flight.add(call.chat_id)
+                else:
+                    self._unlimited_in_flight += 1
+            try:
+                self._senders.submit(self._send, call)
+            except RuntimeError:
+                # Sender pool already shut down at interpreter exit; send inline
+                self._send(call)
+
+    def _send(self, call):
+        call.attempts += 1
+        method = getattr(call.func, '__name__', 'unknown')
+        started = time.monotonic()
+        try:
+            result = call.func(*call.args, **call.kwargs)
+        except Exception as e:
+            OUTBOUND_SECONDS.observe(time.monotonic() - started, method=method)
+            OUTBOUND_CALLS.inc(method=method, error=type(e).__name__)
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is not None and call.attempts <= self.max_retries:
+                self._retry_later(call, retry_after)
+                return
+            self.failed += 1
+            logger.warning("Could not %s in chat %s: %s", method, call.chat_id, e)
+            self._done(call)
+            call.future.set_exception(e)
+            return
+        OUTBOUND_SECONDS.observe(time.monotonic() - started, method=method)
+        OUTBOUND_CALLS.inc(method=method, error='none')
+        self.sent += 1
+        self._done(call)
+        call.future.set_result(result)
+
+    def _finished(self, call):
+        # Called with the lock held
+        if call.chat_limited:
+            self._in_flight.discard(call.chat_id)
+        else:
+            self._unlimited_in_flight -= 1
+
+    def _done(self, call):
+        with self._cond:
+            self._finished(call)
+            self._cond.notify()
+
+    def _retry_later(self, call, retry_after):
+        """Pause the chat for retry_after seconds and put the call back first in line"""
+        with self._cond:
+            self.retried += 1
+            resume_at = time.monotonic() + float(retry_after)
+            if call.chat_limited:
+                self._bucket(call.chat_id).paused_until = resume_at
+                self._queues[call.priority].setdefault(call.chat_id, deque()).appendleft(call)
+            else:
+                call.not_before = resume_at
+                self._unlimited.appendleft(call)
+            self._pending += 1
+            self._finished(call)
+            self._cond.notify()
+
+    def stop(self, timeout=None):
+        """Send what is still queued for up to `timeout` seconds, then stop
+
+        Calls still queued after the timeout are dropped; calls already being
+        sent are left to finish on their own.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self._senders.shutdown(wait=True)
+            return
+        with self._cond:
+            dropped = self._pending
+            self._unlimited.clear()
+            for chat_queues in self._queues:
+                chat_queues.clear()
+            self._pending = 0
+            self._cond.notify()
+        logger.warning("Outbound queue stopped with %d calls unsent", dropped)
+        self._senders.shutdown(wait=False)
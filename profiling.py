@@ -0,0 +1,119 @@
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerProfiler:
+    """On-demand cProfile of handler calls, aggregated per handler and chat
+
+    A session is switched on for a number of seconds and/or a number of profiled
+    calls. While it runs every wrapped call gets its own cProfile.Profile (the
+    profiler is per thread), and the results are merged per (handler, chat). When
+    the session ends one `.pstats` file plus a readable `.txt` summary is written
+    per pair into `output_dir`. When no session is active a wrapped call costs a
+    single flag check.
+    """
+
+    def __init__(self, output_dir='profiles'):
+        self.output_dir = output_dir
+        self.active = False
+        self.lock = threading.Lock()
+        self._deadline = None
+        self._remaining = None
+        self._stats = {}
+        self._session = None
+        self._timer = None
+
+    def enable(self, seconds=None, updates=None):
+        """Start a session that ends after `seconds` or `updates` profiled calls"""
+        if seconds is None and updates is None:
+            raise ValueError("give a duration, an update count, or both")
+        with self.lock:
+            if self.active:
+                return False
+            self._session = time.strftime('%Y%m%d-%H%M%S')
+            self._deadline = time.monotonic() + seconds if seconds else None
+            self._remaining = updates
+            self._stats = {}
+            self.active = True
+            if seconds:
+                self._timer = threading.Timer(seconds, self.disable)
+                self._timer.daemon = True
+                self._timer.start()
+        logger.info("Profiling session %s started (seconds=%s, updates=%s)", self._session, seconds, updates)
+        return True
+
+    def disable(self):
+        """End the running session and write its profiles; returns the files written"""
+        with self.lock:
+            if not self.active:
+                return []
+            self.active = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            stats, self._stats = self._stats, {}
+            session = self._session
+        return self._write(session, stats)
+
+    def call(self, name, chat_id, func, *args):
+        """Run func(*args), profiling it if a session is active"""
+        if not self.active:
+            return func(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self._collect(name, chat_id, profile)
+
+    def wrap(self, callback):
+        """Profile a handler callback, tagged with its name and the update's chat"""
+        name = callback.__name__
+
+        @functools.wraps(callback)
+        def handler(update, context):
+            if not self.active:
+                return callback(update, context)
+            chat = update.effective_chat
+            return self.call(name, chat.id if chat else None, callback, update, context)
+        return handler
+
+    def _collect(self, name, chat_id, profile):
+        finished = False
+        with self.lock:
+            if not self.active:
+                return
+            key = (name, chat_id)
+            if key in self._stats:
+                self._stats[key].add(profile)
+            else:
+                self._stats[key] = pstats.Stats(profile)
+            if self._remaining is not None:
+                self._remaining -= 1
+                finished = self._remaining <= 0
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                finished = True
+        if finished:
+            self.disable()
+
+    def _write(self, session, stats):
+        os.makedirs(self.output_dir, exist_ok=True)
+        written = []
+        for (name, chat_id), stat in stats.items():
+            base = os.path.join(self.output_dir, f"{session}-{name}-{chat_id}")
+            stat.dump_stats(base + '.pstats')
+            summary = io.StringIO()
+            stat.stream = summary
+            stat.sort_stats('cumulative').print_stats(30)
+            with open(base + '.txt', 'w') as f:
+                f.write(summary.getvalue())
+            written.append(base + '.pstats')
+        logger.info("Profiling session %s finished, wrote %d profiles to %s", session, len(written), self.output_dir)
+        return written
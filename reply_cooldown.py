@@ -0,0 +1,118 @@
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from metrics import REGISTRY
+
+REPLIES_SUPPRESSED = REGISTRY.counter(
+    'bot_replies_suppressed_total', 'Filter replies skipped by a cooldown, by reason', ('reason',))
+
+# Order in which the cooldowns are checked; also the per-chat config keys
+COOLDOWN_KINDS = ("duplicate", "trigger", "chat")
+
+
+class ExpiringSlots:
+    """Bounded map of key -> expiry time with O(1) checks and updates
+
+    Keys are kept in the order they were last set. Expired keys are pruned from
+    the front as new ones are set, and when `max_entries` is reached the oldest
+    key is dropped, so memory stays bounded however many chats flood at once.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._expires = OrderedDict()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def active(self, key, now):
+        """Whether key was set and has not expired yet"""
+        expires = self._expires.get(key)
+        return expires is not None and expires > now
+
+    def set(self, key, seconds, now):
+        """Mark key as active for the next `seconds`"""
+        self._expires[key] = now + seconds
+        self._expires.move_to_end(key)
+        # A couple of front entries per call keeps pruning amortized O(1)
+        for _ in range(2):
+            if not self._expires:
+                break
+            oldest_key, oldest = next(iter(self._expires.items()))
+            if oldest > now:
+                break
+            del self._expires[oldest_key]
+        while len(self._expires) > self.max_entries:
+            self._expires.popitem(last=False)
+
+
+class ReplyCooldown:
+    """Per-chat, per-trigger and duplicate-message cooldowns for filter replies
+
+    After a reply in a chat, further replies in that chat are suppressed for
+    `chat` seconds, and replies to the same trigger for `trigger` seconds. With
+    `duplicate` set, the same message text triggering again within that many
+    seconds is collapsed into the first reply. A value of 0 disables that
+    cooldown. Chats can override the defaults; overrides are kept in `settings`
+    (a ChatSettings) as cooldown_chat, cooldown_trigger and cooldown_duplicate.
+    """
+
+    def __init__(self, settings=None, chat=0.0, trigger=0.0, duplicate=0.0, max_entries=100000):
+        self.settings = settings
+        self.defaults = {"chat": chat, "trigger": trigger, "duplicate": duplicate}
+        self.lock = threading.Lock()
+        self.suppressed = dict.fromkeys(COOLDOWN_KINDS, 0)
+        self._slots = {kind: ExpiringSlots(max_entries) for kind in COOLDOWN_KINDS}
+
+    def get_config(self, chat_id):
+        """Cooldown seconds for a chat: {"chat": ..., "trigger": ..., "duplicate": ...}"""
+        if self.settings is None:
+            return dict(self.defaults)
+        return {kind: self.settings.get(chat_id, f"cooldown_{kind}", default)
+                for kind, default in self.defaults.items()}
+
+    def set_config(self, chat_id, **seconds):
+        """Override some of a chat's cooldowns; with no arguments, reset to defaults"""
+        for kind in seconds:
+            if kind not in COOLDOWN_KINDS:
+                raise ValueError(f"unknown cooldown {kind!r}")
+        if self.settings is None:
+            raise ValueError("per-chat cooldowns are not enabled")
+        if seconds:
+            self.settings.update(chat_id, **{f"cooldown_{kind}": value for kind, value in seconds.items()})
+        else:
+            self.settings.reset(chat_id, *(f"cooldown_{kind}" for kind in COOLDOWN_KINDS))
+
+    def allow(self, chat_id, trigger, text, now=None):
+        """Check and record a reply; returns None if it may be sent, else the reason
+
+        The reason is the cooldown that suppressed it ("duplicate", "trigger" or
+        "chat"). Suppressed replies do not extend any cooldown.
+        """
+        now = time.monotonic() if now is None else now
+        keys = {
+            "chat": chat_id,
+            "trigger": (chat_id, trigger),
+            # A checksum of the text is enough to spot repeats and keeps memory small
+            "duplicate": (chat_id, zlib.crc32(text.encode('utf-8', 'replace'))),
+        }
+        config = self.get_config(chat_id)
+        with self.lock:
+            for kind in COOLDOWN_KINDS:
+                if config[kind] and self._slots[kind].active(keys[kind], now):
+                    self.suppressed[kind] += 1
+                    REPLIES_SUPPRESSED.inc(reason=kind)
+                    return kind
+            for kind in COOLDOWN_KINDS:
+                if config[kind]:
+                    self._slots[kind].set(keys[kind], config[kind], now)
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "suppressed": dict(self.suppressed),
+                "tracked": {kind: len(slots) for kind, slots in self._slots.items()},
+            }
@@ -0,0 +1,390 @@
+"""Sharded deployment: one ingestion process, N bot worker processes
+
+The router fetches updates (long polling, or its own webhook endpoint with
+BOT_MODE=webhook) and forwards each one to the worker that owns its chat,
+`chat_id % BOT_SHARDS`. Workers are ordinary telegram_filter_bot.py processes
+started in webhook mode on 127.0.0.1, each with its own filter, deletion,
+settings and good morning state files, so every chat is served by exactly one process and
+the shards run on separate cores.
+
+    BOT_SHARDS=4 python shard_router.py
+"""
+import glob
+import http.client
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from metrics import REGISTRY, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# Commands that act on process-wide state; they are sent to every shard
+BROADCAST_COMMANDS = {'profile'}
+
+ROUTED_UPDATES = REGISTRY.counter('bot_router_updates_total', 'Updates forwarded per shard', ('shard',))
+FORWARD_RETRIES = REGISTRY.counter('bot_router_forward_retries_total', 'Failed forwards that were retried', ('shard',))
+
+
+def parse_shard(value):
+    """Parse a BOT_SHARD value such as "2/4" into (index, count), or None if unset"""
+    if not value:
+        return None
+    index, count = (int(part) for part in value.split('/'))
+    if not 0 <= index < count:
+        raise ValueError(f"invalid shard {value!r}")
+    return index, count
+
+
+def shard_for(chat_id, count):
+    """Index of the shard that owns chat_id"""
+    return chat_id % count
+
+
+def owns_chat(shard, chat_id):
+    """Whether this process (shard from parse_shard, None if unsharded) owns chat_id"""
+    return shard is None or shard_for(chat_id, shard[1]) == shard[0]
+
+
+def shard_path(path, shard):
+    """Per-shard name of a state file, e.g. chat_filters.shard0of4.json"""
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard[0]}of{shard[1]}{ext}"
+
+
+def update_chat_id(data):
+    """Chat (or, failing that, user) id an update belongs to; 0 if it has neither"""
+    for key, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+    return 0
+
+
+def broadcast_command(data):
+    """Whether an update is a command that must reach every shard"""
+    message = data.get('message') or {}
+    text = message.get('text') or ''
+    if not text.startswith('/'):
+        return False
+    command = text[1:].split(None, 1)[0].split('@', 1)[0].lower() if len(text) > 1 else ''
+    return command in BROADCAST_COMMANDS
+
+
+def _read_filters(path):
+    from filter_journal import read_journaled_snapshot
+    return read_journaled_snapshot(path)[0]
+
+
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+# Per-chat state files every shard keeps its own copy of, with their readers.
+# Each holds either a dict keyed by chat id or a list of entries whose first
+# item is the chat id (pending deletions).
+SHARDED_FILES = (
+    ('chat_filters.json', _read_filters),
+    ('pending_deletions.json', _read_json),
+    ('bot_settings.json', _read_json),
+    ('good_morning.json', _read_json),
+)
+
+
+def _chat_of(element):
+    """Chat id of a dict key or list entry, or None if it does not name a chat"""
+    try:
+        return int(element[0] if isinstance(element, list) else element)
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def _seed_sources(path):
+    """Files to split: the newest existing shard layout of path, or else path itself"""
+    root, ext = os.path.splitext(path)
+    layouts = {}
+    for candidate in glob.glob(f"{glob.escape(root)}.shard*of*{ext}"):
+        found = re.fullmatch(re.escape(root) + r'\.shard(\d+)of(\d+)' + re.escape(ext), candidate)
+        if found:
+            layouts.setdefault(int(found.group(2)), []).append(candidate)
+    if layouts:
+        return max(layouts.values(), key=lambda files: max(os.path.getmtime(f) for f in files))
+    return [path] if os.path.exists(path) else []
+
+
+def seed_shards(path, count, read=_read_json):
+    """Split a per-chat state file into per-shard files on the first start with `count` shards
+
+    The source is the newest existing shard layout (after a change of shard
+    count) or else the unsharded file; `read` parses one of them. Elements
+    that do not belong to a chat (such as old global settings) are dropped.
+    """
+    from filter_record import json_default
+
+    targets = [shard_path(path, (index, count)) for index in range(count)]
+    if any(os.path.exists(target) for target in targets):
+        return
+    sources = _seed_sources(path)
+    data = None
+    for source in sources:
+        part = read(source)
+        if isinstance(part, list):
+            data = (data or []) + part
+        else:
+            data = {**(data or {}), **part}
+    if not data:
+        return
+    chats = set()
+    for index, target in enumerate(targets):
+        if isinstance(data, list):
+            shard_data = [entry for entry in data
+                          if _chat_of(entry) is not None and shard_for(_chat_of(entry), count) == index]
+        else:
+            shard_data = {key: value for key, value in data.items()
+                          if _chat_of(key) is not None and shard_for(_chat_of(key), count) == index}
+        chats.update(_chat_of(element) for element in shard_data)
+        tmp_path = target + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(shard_data, f, indent=2, default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, target)
+    logger.info("Seeded %d shards of %s with %d chats from %s", count, path, len(chats), ', '.join(sorted(sources)))
+
+
+def unsplit_databases(db_path, count):
+    """SQLite filter databases that a start with `count` shards would leave behind
+
+    Databases are not re-split: a worker's database is created from its shard
+    of chat_filters.json only if it does not exist yet. Returns the existing
+    databases of another layout (or the unsharded one) when this layout has
+    none, so the caller can refuse to start instead of losing their filters.
+    """
+    targets = [shard_path(db_path, (index, count)) for index in range(count)]
+    if any(os.path.exists(target) for target in targets):
+        return []
+    return sorted(_seed_sources(db_path))
+
+
+class ShardRouter:
+    """Starts the worker processes and forwards updates to them in order
+
+    Every worker has a bounded queue and one forwarding thread that POSTs to the
+    worker's local webhook over a keep-alive connection, so updates of a chat
+    arrive in the order they were received. Failed forwards (worker starting,
+    restarting or answering 503) are retried; a full queue blocks `route`, which
+    slows ingestion down instead of buffering without limit. Workers that exit
+    are restarted.
+    """
+
+    def __init__(self, script, shards, base_port=8600, metrics_port=0, queue_size=1000):
+        self.script = script
+        self.shards = shards
+        self.base_port = base_port
+        self.metrics_port = metrics_port
+        self.secret = secrets.token_urlsafe(16)
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.processes = [None] * shards
+        self.restarts = 0
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def _worker_env(self, index):
+        env = dict(os.environ)
+        env.pop('WEBHOOK_URL', None)
+        env.update(
+            BOT_SHARD=f"{index}/{self.shards}",
+            BOT_MODE='webhook',
+            WEBHOOK_LISTEN='127.0.0.1',
+            WEBHOOK_PORT=str(self.base_port + index),
+            WEBHOOK_PATH='/telegram',
+            WEBHOOK_SECRET=self.secret,
+            METRICS_PORT=str(self.metrics_port + 1 + index) if self.metrics_port else '0',
+            # Telegram's global limit is per bot token, shared by all workers
+            OUTBOUND_GLOBAL_RATE=str(float(os.getenv('OUTBOUND_GLOBAL_RATE', '30')) / self.shards),
+        )
+        return env
+
+    def _spawn(self, index):
+        # A session of its own, so Ctrl-C reaches the router only and workers
+        # are stopped after the router has drained their queues
+        self.processes[index] = subprocess.Popen(
+            [sys.executable, self.script], env=self._worker_env(index), start_new_session=True)
+
+    def start(self):
+        for index in range(self.shards):
+            self._spawn(index)
+            thread = threading.Thread(target=self._forward, args=(index,), name=f'router-forward-{index}')
+            thread.start()
+            self._threads.append(thread)
+        threading.Thread(target=self._supervise, name='router-supervisor', daemon=True).start()
+        REGISTRY.gauge('bot_router_queue_depth', 'Updates waiting to be forwarded per shard', ('shard',),
+                       function=lambda: {str(index): q.qsize() for index, q in enumerate(self.queues)})
+
+    def route(self, data):
+        """Queue a raw update (dict) for the shard(s) that must handle it"""
+        if broadcast_command(data):
+            targets = range(self.shards)
+        else:
+            targets = (shard_for(update_chat_id(data), self.shards),)
+        body = json.dumps(data).encode('utf-8')
+        for index in targets:
+            self.queues[index].put(body)
+
+    def _forward(self, index):
+        work_queue = self.queues[index]
+        connection = None
+        while True:
+            body = work_queue.get()
+            if body is None:
+                break
+            delay = 0.1
+            while True:
+                try:
+                    if connection is None:
+                        connection = http.client.HTTPConnection('127.0.0.1', self.base_port + index, timeout=30)
+                    connection.request('POST', '/telegram', body, {
+                        'Content-Type': 'application/json',
+                        'X-Telegram-Bot-Api-Secret-Token': self.secret,
+                    })
+                    response = connection.getresponse()
+                    response.read()
+                    if response.status == 200:
+                        ROUTED_UPDATES.inc(shard=str(index))
+                        break
+                    if response.status != 503:
+                        logger.warning("Shard %d rejected an update with HTTP %s; dropping it", index, response.status)
+                        break
+                except (OSError, http.client.HTTPException):
+                    if connection is not None:
+                        connection.close()
+                    connection = None
+                FORWARD_RETRIES.inc(shard=str(index))
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+        if connection is not None:
+            connection.close()
+
+    def _supervise(self):
+        while not self._stopping.wait(1.0):
+            for index, process in enumerate(self.processes):
+                if process.poll() is not None and not self._stopping.is_set():
+                    logger.warning("Shard %d exited with code %s; restarting it", index, process.returncode)
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def stop(self, timeout=30):
+        """Forward what is queued, then stop the workers"""
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._stopping.set()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def poll_updates(token, router, stop_event):
+    """Long-poll getUpdates and route every update; returns once stop_event is set"""
+    from telegram import Bot
+    from telegram.error import NetworkError
+
+    bot = Bot(token, base_url=os.getenv('TELEGRAM_API_BASE_URL') or None)
+    bot.delete_webhook()
+    offset = None
+    while not stop_event.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=10)
+        except NetworkError:
+            continue
+        except Exception as e:
+            logger.warning("getUpdates failed: %s", e)
+            stop_event.wait(1.0)
+            continue
+        for update in updates:
+            router.route(update.to_dict())
+            offset = update.update_id + 1
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    # stdout is shared with the workers' event logs, so messages go to stderr
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s',
+                        level=os.getenv('LOG_LEVEL', 'WARNING').upper())
+
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        logger.error("TELEGRAM_BOT_TOKEN environment variable not set!")
+        return
+
+    shards = int(os.getenv('BOT_SHARDS', str(os.cpu_count() or 1)))
+    metrics_port = int(os.getenv('METRICS_PORT', '9095'))
+    if os.getenv('FILTER_STORAGE', 'json') == 'sqlite':
+        leftover = unsplit_databases(os.getenv('FILTERS_DB', 'chat_filters.db'), shards)
+        if leftover:
+            logger.error("SQLite filter databases are not split between shards, so %s would not be used by "
+                         "%d shards. Start with the BOT_SHARDS they were written with, or run "
+                         "telegram_filter_bot.py directly for an unsharded database.", ', '.join(leftover), shards)
+            return
+    for path, read in SHARDED_FILES:
+        seed_shards(path, shards, read)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_filter_bot.py')
+    router = ShardRouter(script, shards, base_port=int(os.getenv('SHARD_BASE_PORT', '8600')),
+                         metrics_port=metrics_port)
+    if metrics_port:
+        start_http_server(metrics_port, os.getenv('METRICS_ADDR', '127.0.0.1'))
+    router.start()
+    logger.info("Routing updates to %d shard workers...", shards)
+
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        from webhook_server import WebhookServer
+        secret = os.getenv('WEBHOOK_SECRET')
+        server = WebhookServer(
+            router.route,
+            host=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('WEBHOOK_PORT', '8443')),
+            path=os.getenv('WEBHOOK_PATH', '/telegram'),
+            secret=secret,
+            queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000')),
+        )
+        server.start()
+        webhook_url = os.getenv('WEBHOOK_URL')
+        if webhook_url:
+            from telegram import Bot
+            Bot(token).set_webhook(url=webhook_url, api_kwargs={'secret_token': secret} if secret else None)
+        stop_event.wait()
+        server.stop()
+    else:
+        poll_updates(token, router, stop_event)
+
+    router.stop()
+
+
+if __name__ == '__main__':
+    main()
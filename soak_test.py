@@ -0,0 +1,462 @@
+"""Soak test the unmodified bot against a local fake Telegram Bot API server
+
+The fake server implements getUpdates (long polling), sendMessage, sendPhoto,
+sendSticker, deleteMessage and getChatAdministrators, plus the few calls the
+library makes on its own, with configurable latency, injected 5xx errors and
+429 responses carrying retry_after. telegram_filter_bot.py is started as a
+subprocess (its own main(), pointed at the fake server through
+TELEGRAM_API_BASE_URL) in a scratch directory seeded with filters, and a
+driver feeds it synthetic group traffic for --duration seconds.
+
+Every --sample-interval seconds one JSON line is written to --output with
+end-to-end reply latency (update queued -> reply received), throughput, the
+bot's RSS and thread count, and the injected faults; a summary follows at the
+end. RSS and threads are read from /proc, so those columns need Linux.
+
+    python soak_test.py --duration 10800 --rate 20 --chats 200
+    python soak_test.py --duration 300 --error-rate 0.02 --rate-limit-rate 0.01
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Methods whose calls may be slowed down or failed on purpose
+FAULTY_METHODS = {'sendMessage', 'sendPhoto', 'sendSticker', 'deleteMessage', 'getChatAdministrators'}
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Soak", "username": "soak_test_bot"}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def process_status(pid):
+    """(RSS in KiB, thread count) of a process from /proc, or (None, None)"""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                values[name] = value.split()
+    except OSError:
+        return None, None
+    rss = values.get('VmRSS')
+    threads = values.get('Threads')
+    return int(rss[0]) if rss else None, int(threads[0]) if threads else None
+
+
+class FakeBotAPI:
+    """In-memory Telegram Bot API for one bot token, served over local HTTP
+
+    `push` queues an update for getUpdates. Every sent message is reported to
+    `on_send(method, params)`. Calls to FAULTY_METHODS wait `latency` seconds
+    (uniformly jittered by half), then fail with HTTP 500 with probability
+    `error_rate` or with 429 and `retry_after` with probability
+    `rate_limit_rate`.
+    """
+
+    def __init__(self, token, host='127.0.0.1', port=0, latency=0.05, error_rate=0.0,
+                 rate_limit_rate=0.0, retry_after=1, admins=3, on_send=None):
+        self.token = token
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.admins = admins
+        self.on_send = on_send
+        self.calls = {}
+        self.injected = {"error": 0, "rate_limit": 0}
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self.base_url = f"http://{host}:{self.port}/bot"
+        self._thread = None
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._serve()
+
+            def do_POST(self):
+                self._serve()
+
+            def _serve(self):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type', '')
+                try:
+                    if content_type.startswith('application/json') and body:
+                        params.update(json.loads(body))
+                    elif body:
+                        params.update(parse_qsl(body.decode('utf-8')))
+                except ValueError:
+                    return self._send(400, {"ok": False, "error_code": 400, "description": "Bad Request: bad body"})
+                prefix = f'/bot{api.token}/'
+                if not url.path.startswith(prefix):
+                    return self._send(401, {"ok": False, "error_code": 401, "description": "Unauthorized"})
+                status, payload = api.call(url.path[len(prefix):], params)
+                self._send(status, payload)
+
+            def _send(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push(self, update):
+        """Queue an update (dict without update_id) for getUpdates; returns its id"""
+        with self._cond:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append(dict(update, update_id=update_id))
+            self._cond.notify_all()
+        return update_id
+
+    def pending_updates(self):
+        with self._cond:
+            return len(self._updates)
+
+    def call(self, method, params):
+        """Serve one API call; returns (HTTP status, JSON payload)"""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method in FAULTY_METHODS:
+            if self.latency:
+                time.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+            roll = random.random()
+            if roll < self.error_rate:
+                self.injected["error"] += 1
+                return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+            if roll < self.error_rate + self.rate_limit_rate:
+                self.injected["rate_limit"] += 1
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+        handler = getattr(self, f'_api_{method}', None)
+        if handler is None:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        try:
+            return 200, {"ok": True, "result": handler(params)}
+        except (KeyError, ValueError) as e:
+            return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+
+    def _message(self, params, **content):
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        chat_id = int(params["chat_id"])
+        message = {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                   "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private", "title": "soak"}}
+        message.update(content)
+        return message
+
+    def _sent(self, method, params, message):
+        if self.on_send is not None:
+            self.on_send(method, params)
+        return message
+
+    def _api_getMe(self, params):
+        return BOT_USER
+
+    def _api_deleteWebhook(self, params):
+        return True
+
+    def _api_answerCallbackQuery(self, params):
+        return True
+
+    def _api_getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._cond:
+            # Updates below the offset are confirmed by the client
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._updates[:limit]
+
+    def _api_sendMessage(self, params):
+        return self._sent('sendMessage', params, self._message(params, text=params["text"]))
+
+    def _api_sendPhoto(self, params):
+        photo = {"file_id": str(params["photo"]), "file_unique_id": "p", "width": 640, "height": 480}
+        message = self._message(params, photo=[photo])
+        if params.get("caption"):
+            message["caption"] = params["caption"]
+        return self._sent('sendPhoto', params, message)
+
+    def _api_sendSticker(self, params):
+        sticker = {"file_id": str(params["sticker"]), "file_unique_id": "s", "width": 512, "height": 512,
+                   "is_animated": False}
+        return self._sent('sendSticker', params, self._message(params, sticker=sticker))
+
+    def _api_deleteMessage(self, params):
+        return True
+
+    def _api_getChatAdministrators(self, params):
+        members = [{"status": "creator", "is_anonymous": False,
+                    "user": {"id": 1, "is_bot": False, "first_name": "owner"}}]
+        for index in range(self.admins):
+            members.append({
+                "status": "administrator", "is_anonymous": False, "can_be_edited": False,
+                "can_manage_chat": True, "can_delete_messages": True, "can_manage_voice_chats": True,
+                "can_restrict_members": True, "can_promote_members": False, "can_change_info": True,
+                "can_invite_users": True, "can_pin_messages": True,
+                "user": {"id": 2 + index, "is_bot": False, "first_name": f"admin{index}"},
+            })
+        return members
+
+
+def seed_filters(path, chats, filters_per_chat, rng):
+    """Write a chat_filters.json with text, photo and sticker filters; returns triggers per chat"""
+    data = {}
+    triggers = {}
+    for chat_id in chats:
+        chat_filters = {}
+        for index in range(filters_per_chat):
+            trigger = f"{''.join(rng.choice(string.ascii_lowercase) for _ in range(6))}{index}"
+            kind = index % 10
+            if kind == 0:
+                chat_filters[trigger] = {"type": "media", "media_type": "photo", "file_id": f"photo-{trigger}",
+                                         "caption": "photo reply"}
+            elif kind == 1:
+                chat_filters[trigger] = {"type": "media", "media_type": "sticker", "file_id": f"sticker-{trigger}",
+                                         "caption": ""}
+            else:
+                chat_filters[trigger] = {"type": "text", "content": f"reply to {trigger}"}
+        data[str(chat_id)] = chat_filters
+        triggers[chat_id] = list(chat_filters)
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    return triggers
+
+
+class SoakDriver:
+    """Feeds synthetic group traffic to a FakeBotAPI and measures the replies"""
+
+    def __init__(self, api, triggers, rate, hit_ratio, goodmorning_ratio, rng, reply_timeout=60.0):
+        self.api = api
+        self.triggers = triggers
+        self.chats = list(triggers)
+        self.rate = rate
+        self.hit_ratio = hit_ratio
+        self.goodmorning_ratio = goodmorning_ratio
+        self.rng = rng
+        self.reply_timeout = reply_timeout
+        self.lock = threading.Lock()
+        # (chat_id, message_id) -> monotonic time the update was queued
+        self.outstanding = {}
+        self.latencies = []
+        self.sent = 0
+        self.replies = 0
+        self.lost = 0
+        self._message_ids = {}
+        api.on_send = self.on_send
+
+    def on_send(self, method, params):
+        reply_to = params.get("reply_to_message_id")
+        if reply_to is None:
+            return
+        key = (int(params["chat_id"]), int(reply_to))
+        with self.lock:
+            queued = self.outstanding.pop(key, None)
+            if queued is not None:
+                self.latencies.append(time.monotonic() - queued)
+                self.replies += 1
+
+    def _text(self, chat_id):
+        words = [''.join(self.rng.choice(string.ascii_lowercase) for _ in range(self.rng.randint(3, 8)))
+                 for _ in range(self.rng.randint(3, 12))]
+        roll = self.rng.random()
+        if roll < self.goodmorning_ratio:
+            return '/goodmorning', True
+        if roll < self.goodmorning_ratio + self.hit_ratio:
+            words.insert(self.rng.randrange(len(words) + 1), self.rng.choice(self.triggers[chat_id]))
+            return ' '.join(words), True
+        return ' '.join(words), False
+
+    def send_one(self):
+        chat_id = self.rng.choice(self.chats)
+        message_id = self._message_ids.get(chat_id, 0) + 1
+        self._message_ids[chat_id] = message_id
+        user_id = 10000 + self.rng.randrange(50)
+        text, expects_reply = self._text(chat_id)
+        message = {
+            "message_id": message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "supergroup", "title": "soak"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split(' ', 1)[0])}]
+        if expects_reply:
+            with self.lock:
+                self.outstanding[(chat_id, message_id)] = time.monotonic()
+        self.api.push({"message": message})
+        self.sent += 1
+
+    def run(self, duration, stop_event):
+        """Send at `rate` messages per second for `duration` seconds"""
+        started = time.monotonic()
+        interval = 1.0 / self.rate
+        next_at = started
+        while not stop_event.is_set() and time.monotonic() - started < duration:
+            self.send_one()
+            next_at += interval
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                stop_event.wait(delay)
+
+    def take_interval(self):
+        """Latencies since the last call, and replies given up on as lost"""
+        now = time.monotonic()
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            expired = [key for key, queued in self.outstanding.items() if now - queued > self.reply_timeout]
+            for key in expired:
+                del self.outstanding[key]
+            self.lost += len(expired)
+            return sorted(latencies), len(expired)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--duration', type=float, default=600, help="seconds of traffic")
+    parser.add_argument('--rate', type=float, default=20, help="incoming messages per second")
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--filters-per-chat', type=int, default=30)
+    parser.add_argument('--hit-ratio', type=float, default=0.3, help="share of messages containing a trigger")
+    parser.add_argument('--goodmorning-ratio', type=float, default=0.001, help="share of /goodmorning commands")
+    parser.add_argument('--latency', type=float, default=0.05, help="mean fake API latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of calls failing with HTTP 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after of injected 429s")
+    parser.add_argument('--sample-interval', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help="directory for the bot's state files (default: a temporary one)")
+    parser.add_argument('--output', default='soak_results.jsonl')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='soak-')
+    os.makedirs(workdir, exist_ok=True)
+    chats = [-1000000000000 - index for index in range(args.chats)]
+    triggers = seed_filters(os.path.join(workdir, 'chat_filters.json'), chats, args.filters_per_chat, rng)
+
+    token = '123456:soak-test'
+    api = FakeBotAPI(token, latency=args.latency, error_rate=args.error_rate,
+                     rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after)
+    driver = SoakDriver(api, triggers, args.rate, args.hit_ratio, args.goodmorning_ratio, rng)
+    api.start()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_filter_bot.py')
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN=token, TELEGRAM_API_BASE_URL=api.base_url,
+               BOT_MODE='polling', METRICS_PORT='0')
+    env.pop('BOT_SHARD', None)
+    log = open(os.path.join(workdir, 'bot.log'), 'w')
+    bot = subprocess.Popen([sys.executable, script], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    print(f"Bot started (pid {bot.pid}) in {workdir}, fake API on {api.base_url}")
+
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+    traffic = threading.Thread(target=driver.run, args=(args.duration, stop_event), name='soak-driver', daemon=True)
+    traffic.start()
+
+    started = time.monotonic()
+    samples = []
+    with open(args.output, 'w') as out:
+        while traffic.is_alive() and bot.poll() is None:
+            stop_event.wait(args.sample_interval)
+            latencies, lost = driver.take_interval()
+            rss, threads = process_status(bot.pid)
+            sample = {
+                "elapsed": round(time.monotonic() - started, 1),
+                "sent": driver.sent,
+                "replies": driver.replies,
+                "lost": lost,
+                "pending_updates": api.pending_updates(),
+                "p50_ms": round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+                "max_ms": round(latencies[-1] * 1000, 1) if latencies else None,
+                "rss_kb": rss,
+                "threads": threads,
+                "api_calls": dict(api.calls),
+                "injected": dict(api.injected),
+            }
+            samples.append(sample)
+            out.write(json.dumps(sample) + '\n')
+            out.flush()
+            print(json.dumps(sample))
+
+        if bot.poll() is not None:
+            print(f"The bot exited early with code {bot.returncode}; see {workdir}/bot.log")
+        stop_event.set()
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(60)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        api.stop()
+        log.close()
+
+        rss_values = [sample["rss_kb"] for sample in samples if sample["rss_kb"] is not None]
+        summary = {
+            "summary": True,
+            "duration": round(time.monotonic() - started, 1),
+            "sent": driver.sent,
+            "replies": driver.replies,
+            "lost": driver.lost,
+            "rss_start_kb": rss_values[0] if rss_values else None,
+            "rss_end_kb": rss_values[-1] if rss_values else None,
+            "rss_growth_kb": rss_values[-1] - rss_values[0] if rss_values else None,
+            "threads_max": max((s["threads"] for s in samples if s["threads"] is not None), default=None),
+            "p99_ms_max": max((s["p99_ms"] for s in samples if s["p99_ms"] is not None), default=None),
+            "bot_exit_code": bot.returncode,
+        }
+        out.write(json.dumps(summary) + '\n')
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,185 @@
-import json
+import functools
+import io
+import logging
 import os
+import random
+import signal
+import sys
+import tempfile
 import threading
 import time
-import random
+from collections import OrderedDict
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, MessageHandler, CallbackQueryHandler
+from chat_dispatcher import ChatPartitionedExecutor
+from chat_settings import ChatSettings
+from deletion_scheduler import DeletionScheduler
+from event_log import EventLog, parse_sample_rates
+from filter_record import make_record
+from filter_storage import JournalStorage, SQLiteStorage
+from file_watcher import FileWatcher
+from filter_transfer import MAX_TRIGGER_LENGTH, dump_filters, iter_entries, parse_entry, utf16_length
+from good_morning import GoodMorningScheduler
+from match_cache import MatchCache
+from member_roster import MemberRoster
+from message_tracker import SentMessageTracker
+from metrics import REGISTRY, start_http_server
+from profiling import HandlerProfiler
+from reply_cooldown import ReplyCooldown
+from shard_router import owns_chat, parse_shard, shard_path
+from outbound_queue import OutboundQueue, PRIORITY_BACKGROUND, PRIORITY_DELETE, PRIORITY_REPLY
+from webhook_server import WebhookServer
+from trigger_matcher import MATCH_MODES, PatternMatcher, TriggerMatcher, validate_regex
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Set by shard_router.py in worker processes, as "<index>/<count>"; each shard
+# keeps its own state files and only receives updates of the chats it owns
+BOT_SHARD = parse_shard(os.getenv('BOT_SHARD'))
+
 # File to store filters
-FILTERS_FILE = 'chat_filters.json'
+FILTERS_FILE = shard_path('chat_filters.json', BOT_SHARD)
+
+# Filter changes are journaled next to FILTERS_FILE; fsync batching and compaction
+JOURNAL_FSYNC_INTERVAL = float(os.getenv('FILTER_JOURNAL_FSYNC_INTERVAL', '1.0'))
+JOURNAL_COMPACT_EVERY = int(os.getenv('FILTER_JOURNAL_COMPACT_EVERY', '500'))
+
+# Binary index of FILTERS_FILE, memory-mapped at startup so chats load lazily
+# (FILTER_INDEX=0 disables it)
+FILTERS_INDEX = FILTERS_FILE + '.idx' if os.getenv('FILTER_INDEX', '1') != '0' else None
+
+# Storage backend for filters: "json" (FILTERS_FILE + journal) or "sqlite"
+FILTER_STORAGE = os.getenv('FILTER_STORAGE', 'json')
+FILTERS_DB = shard_path(os.getenv('FILTERS_DB', 'chat_filters.db'), BOT_SHARD)
+
+# Maximum number of chats whose filters are kept in memory
+FILTER_CACHE_CHATS = int(os.getenv('FILTER_CACHE_CHATS', '1000'))
+
+# /filters output is split into pages of at most this many filters and characters
+FILTERS_PAGE_SIZE = int(os.getenv('FILTERS_PAGE_SIZE', '40'))
+FILTERS_PAGE_CHARS = 3500
+
+# Limits for /importfilters documents
+MAX_IMPORT_BYTES = int(os.getenv('MAX_IMPORT_BYTES', str(5 * 1024 * 1024)))
+MAX_IMPORT_FILTERS = int(os.getenv('MAX_IMPORT_FILTERS', '5000'))
+
+# Per-message time budget for a chat's word/prefix/regex pattern (milliseconds)
+REGEX_TIME_BUDGET_MS = float(os.getenv('REGEX_TIME_BUDGET_MS', '50'))
+
+# Match results of short repeated messages, per chat and in total (0 disables)
+MATCH_CACHE_ENTRIES = int(os.getenv('MATCH_CACHE_ENTRIES', '50000'))
+MATCH_CACHE_PER_CHAT = int(os.getenv('MATCH_CACHE_PER_CHAT', '256'))
+MATCH_CACHE_MAX_TEXT = int(os.getenv('MATCH_CACHE_MAX_TEXT', '64'))
+
+# Filter files are watched for changes made by other writers (inotify, or
+# polling every FILE_WATCH_INTERVAL seconds where inotify is unavailable)
+file_watcher = FileWatcher(float(os.getenv('FILE_WATCH_INTERVAL', '2.0')))
+
+# Store original message IDs to track edits, capped in size and age
+ORIGINAL_MESSAGES_MAX = int(os.getenv('ORIGINAL_MESSAGES_MAX', '10000'))
+original_messages = SentMessageTracker(ORIGINAL_MESSAGES_MAX)
+
+# Metrics, served in Prometheus text format on METRICS_ADDR:METRICS_PORT
+HANDLER_SECONDS = REGISTRY.histogram('bot_handler_seconds', 'Handler latency', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter('bot_handler_errors_total', 'Handler exceptions by type', ('handler', 'error'))
+FILTER_MATCHES = REGISTRY.counter('bot_filter_matches_total', 'Messages checked against filters', ('result',))
 
-# Store original message IDs to track edits
-original_messages = {}
+# Structured events (JSON lines on stdout) written by a background thread;
+# LOG_SAMPLE_RATES keeps only a fraction of the high-volume ones
+event_log = EventLog(
+    queue_size=int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+    sample_rates=parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', 'handler=0.01,filter_hit=0.1')),
+)
 
-# Store self-destruct timers
-self_destruct_timers = {}
+# On-demand profiling of handlers (/profile or SIGUSR1), written to PROFILE_DIR
+profiler = HandlerProfiler(os.getenv('PROFILE_DIR', 'profiles'))
+PROFILE_DEFAULT_SECONDS = int(os.getenv('PROFILE_DEFAULT_SECONDS', '30'))
 
-# Store last good morning time per chat to prevent spam
-last_good_morning = {}
+# Telegram user ids allowed to run bot-wide admin commands such as /profile
+BOT_ADMIN_IDS = {int(user_id) for user_id in os.getenv('BOT_ADMIN_IDS', '').split(',') if user_id.strip()}
 
-# Settings functionality removed as requested
+# Handlers run on a fixed pool of workers; each chat always uses the same one
+CHAT_WORKERS = int(os.getenv('CHAT_WORKERS', '8'))
+chat_executor = ChatPartitionedExecutor(CHAT_WORKERS)
+
+# Every Bot API call goes through one rate-limited queue (Telegram flood limits)
+outbound_queue = OutboundQueue(
+    global_rate=float(os.getenv('OUTBOUND_GLOBAL_RATE', '30')),
+    group_per_minute=int(os.getenv('OUTBOUND_GROUP_PER_MINUTE', '20')),
+)
+
+# Seconds to keep sending queued calls on shutdown before dropping them
+OUTBOUND_STOP_TIMEOUT = float(os.getenv('OUTBOUND_STOP_TIMEOUT', '10'))
+
+def send(chat_id, func, /, *args, priority=PRIORITY_REPLY, chat_limited=True, **kwargs):
+    """Queue an outbound Bot API call for a chat; returns a Future of its result
+
+    Never wait on the Future in a handler: that blocks the chat's worker (and
+    every chat sharing it) until the rate-limited queue gets to the call. Add a
+    done callback for anything that depends on the result.
+    """
+    return outbound_queue.submit(chat_id, func, *args, priority=priority, chat_limited=chat_limited, **kwargs)
+
+# Pending self-destruct deletions, persisted so they survive restarts
+PENDING_DELETIONS_FILE = shard_path('pending_deletions.json', BOT_SHARD)
+deletion_scheduler = DeletionScheduler(PENDING_DELETIONS_FILE)
+
+# Per-chat settings (self-destruct time, good morning window, cooldowns), kept
+# in memory and written SETTINGS_SAVE_DELAY seconds after the last change
+SETTINGS_FILE = shard_path('bot_settings.json', BOT_SHARD)
+chat_settings = ChatSettings(SETTINGS_FILE, save_delay=float(os.getenv('SETTINGS_SAVE_DELAY', '1.0')))
+
+# Seconds after which filter replies delete themselves in chats that have not
+# set their own time with /settings (0 = never)
+SELF_DESTRUCT_TIME = int(os.getenv('SELF_DESTRUCT_TIME', '0'))
+
+# Daily good morning per group, spread across each chat's window (local hours)
+GOOD_MORNING_FILE = shard_path('good_morning.json', BOT_SHARD)
+GOOD_MORNING_WINDOW = (int(os.getenv('GOOD_MORNING_START_HOUR', '6')), int(os.getenv('GOOD_MORNING_END_HOUR', '10')))
+good_morning_scheduler = GoodMorningScheduler(
+    GOOD_MORNING_FILE, GOOD_MORNING_WINDOW, os.getenv('GOOD_MORNING_TIMEZONE'), settings=chat_settings)
+
+# Reply cooldowns (seconds, 0 = off) per chat, per trigger and for repeated
+# identical messages; chats can override them with /cooldown
+reply_cooldown = ReplyCooldown(
+    chat_settings,
+    chat=float(os.getenv('REPLY_COOLDOWN_CHAT', '0')),
+    trigger=float(os.getenv('REPLY_COOLDOWN_TRIGGER', '0')),
+    duplicate=float(os.getenv('REPLY_COOLDOWN_DUPLICATE', '0')),
+)
+
+# Members seen per chat and cached admins, used for good morning mentions
+member_roster = MemberRoster(send)
 
 def schedule_self_destruct(context, chat_id, message_id, delay_seconds):
     """Schedule a message for self-destruction after a delay"""
-    def delete_message_job():
-        time.sleep(delay_seconds)
-        try:
-            context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-            print(f"Message {message_id} in chat {chat_id} was self-destructed after {delay_seconds} seconds")
-        except Exception as e:
-            print(f"Could not delete message {message_id}: {e}")
-        finally:
-            # Clean up timer reference
-            if message_id in self_destruct_timers:
-                del self_destruct_timers[message_id]
-    
-    # Cancel any existing timer for this message
-    if message_id in self_destruct_timers:
-        try:
-            self_destruct_timers[message_id].cancel()
-        except:
-            pass
+    # Rescheduling an already pending message replaces its old deadline
+    deletion_scheduler.schedule(chat_id, message_id, delay_seconds)
+    event_log.emit("self_destruct_scheduled", chat_id=chat_id, message_id=message_id, delay=delay_seconds)
+
+
+def cancel_self_destruct(chat_id, message_id):
+    """Cancel a pending self-destruct; returns False if none was pending"""
+    return deletion_scheduler.cancel(chat_id, message_id)
+
+
+def start_self_destruct_scheduler(bot):
+    """Start the thread that performs scheduled deletions with the given bot"""
+    def delete_message_job(chat_id, message_id):
+        deleted = send(chat_id, bot.delete_message, chat_id=chat_id, message_id=message_id, priority=PRIORITY_DELETE)
+        
+        def log_deletion(future):
+            error = future.exception()
+            event_log.emit("self_destructed", chat_id=chat_id, message_id=message_id,
+                           error=type(error).__name__ if error else None)
+        
+        deleted.add_done_callback(log_deletion)
     
-    # Create and start new timer
-    timer = threading.Timer(0, delete_message_job)
-    timer.start()
-    self_destruct_timers[message_id] = timer
+    deletion_scheduler.start(delete_message_job)
 
 
 def get_good_morning_shayari():
@@ -91,80 +222,303 @@ def get_good_morning_shayari():
 # Settings functionality removed - using default values
 
 class FilterBot:
-    def __init__(self):
-        self.filters_data = self.load_filters()
+    def __init__(self, storage=None):
+        self.storage = storage or self.create_storage()
+        self.lock = self.storage.lock
+        # Filters of recently active chats, least recently used first
+        self.filters_data = OrderedDict()
+        # Compiled trigger matchers per chat, built lazily on first message:
+        # Aho-Corasick for substring triggers, one regex for the other modes
+        self.matchers = {}
+        self.patterns = {}
+        # Rendered /filters pages per chat, dropped whenever its filters change
+        self.pages = {}
+        # Per-chat generation, bumped on every change (local or reloaded from disk)
+        self.generations = {}
+        # Results of recent messages per chat, valid for one generation
+        self.match_cache = MatchCache(MATCH_CACHE_ENTRIES, MATCH_CACHE_PER_CHAT, MATCH_CACHE_MAX_TEXT)
+        self.storage.on_change = self.reload_chats
+    
+    @staticmethod
+    def create_storage():
+        """Create the storage backend selected by FILTER_STORAGE"""
+        if FILTER_STORAGE == 'sqlite':
+            return SQLiteStorage(FILTERS_DB, migrate_from=FILTERS_FILE)
+        return JournalStorage(FILTERS_FILE, JOURNAL_FSYNC_INTERVAL, JOURNAL_COMPACT_EVERY, FILTERS_INDEX)
+    
+    def get_generation(self, chat_id):
+        """Generation of a chat's filters; changes whenever they change"""
+        return self.generations.get(str(chat_id), 0)
     
-    def load_filters(self):
-        """Load filters from JSON file"""
-        if os.path.exists(FILTERS_FILE):
-            with open(FILTERS_FILE, 'r') as f:
-                return json.load(f)
-        return {}
+    def _bump(self, chat_id_str):
+        self.generations[chat_id_str] = self.generations.get(chat_id_str, 0) + 1
+        self.pages.pop(chat_id_str, None)
+        self.match_cache.discard(chat_id_str)
     
-    def save_filters(self):
-        """Save filters to JSON file"""
-        with open(FILTERS_FILE, 'w') as f:
-            json.dump(self.filters_data, f, indent=2)
+    def reload_chats(self, chat_id_strs):
+        """Drop cached state of chats changed by another writer; reloaded on next use"""
+        with self.lock:
+            for chat_id_str in chat_id_strs:
+                self.filters_data.pop(chat_id_str, None)
+                self.matchers.pop(chat_id_str, None)
+                self.patterns.pop(chat_id_str, None)
+                self._bump(chat_id_str)
+    
+    def check_for_changes(self, path=None):
+        """Pick up filter changes made on disk by others (FileWatcher callback)"""
+        self.storage.check_for_changes()
+    
+    def close(self):
+        """Flush pending changes and stop background persistence"""
+        self.storage.close()
     
     def get_chat_filters(self, chat_id):
-        """Get filters for a specific chat"""
+        """Get filters for a specific chat, loading them on first use"""
         chat_id_str = str(chat_id)
-        if chat_id_str not in self.filters_data:
-            self.filters_data[chat_id_str] = {}
-        return self.filters_data[chat_id_str]
+        with self.lock:
+            chat_filters = self.filters_data.get(chat_id_str)
+            if chat_filters is not None:
+                self.filters_data.move_to_end(chat_id_str)
+                return chat_filters
+            chat_filters = self.storage.load_chat(chat_id_str)
+            self.filters_data[chat_id_str] = chat_filters
+            # Evict idle chats; they are reloaded from storage when needed
+            while len(self.filters_data) > FILTER_CACHE_CHATS:
+                evicted, _ = self.filters_data.popitem(last=False)
+                self.storage.release_chat(evicted)
+                self.matchers.pop(evicted, None)
+                self.patterns.pop(evicted, None)
+                self.pages.pop(evicted, None)
+            return chat_filters
     
-    def add_filter(self, chat_id, trigger, reply, media_type=None, file_id=None):
-        """Add a new filter for a chat"""
-        chat_filters = self.get_chat_filters(chat_id)
+    def get_chat_matcher(self, chat_id):
+        """Get the compiled substring trigger matcher for a chat, building it if needed"""
+        chat_id_str = str(chat_id)
+        with self.lock:
+            matcher = self.matchers.get(chat_id_str)
+            if matcher is None:
+                chat_filters = self.get_chat_filters(chat_id)
+                literal = [t for t, record in chat_filters.items() if not record.get("match")]
+                # The storage may have one prebuilt; it is only used if it has exactly these triggers
+                matcher = self.storage.load_matcher(chat_id_str)
+                if matcher is None or len(matcher) != len(literal) or not all(t in matcher for t in literal):
+                    matcher = TriggerMatcher(literal)
+                self.matchers[chat_id_str] = matcher
+            return matcher
+    
+    def get_chat_patterns(self, chat_id):
+        """Get the combined word/prefix/regex pattern for a chat, building it if needed"""
+        chat_id_str = str(chat_id)
+        with self.lock:
+            patterns = self.patterns.get(chat_id_str)
+            if patterns is None:
+                chat_filters = self.get_chat_filters(chat_id)
+                patterns = PatternMatcher(
+                    [(t, record["match"]) for t, record in chat_filters.items() if record.get("match")],
+                    time_budget=REGEX_TIME_BUDGET_MS / 1000,
+                )
+                self.patterns[chat_id_str] = patterns
+            return patterns
+    
+    @staticmethod
+    def make_filter(trigger, reply, media_type=None, file_id=None, match=None):
+        """Build the stored (trigger, record) pair for a filter
+
+        `match` is None for substring matching or one of MATCH_MODES; regex
+        triggers are validated first and a ValueError explains a rejection.
+        """
+        if match is not None and match not in MATCH_MODES:
+            raise ValueError(f"unknown match mode {match!r}")
+        if match and not trigger:
+            raise ValueError("the trigger is empty")
+        if utf16_length(trigger) > MAX_TRIGGER_LENGTH:
+            raise ValueError(f"the trigger is longer than {MAX_TRIGGER_LENGTH} characters")
+        if match == "regex":
+            validate_regex(trigger)
+        else:
+            trigger = trigger.lower()
         if media_type and file_id:
             # Store media information
-            chat_filters[trigger.lower()] = {
-                "type": "media",
-                "media_type": media_type,
-                "file_id": file_id,
-                "caption": reply
-            }
+            record = make_record("media", media_type, file_id, reply, None, match)
         else:
             # Store text reply
-            chat_filters[trigger.lower()] = {
-                "type": "text",
-                "content": reply
-            }
-        self.save_filters()
+            record = make_record("text", None, None, None, reply, match)
+        return sys.intern(trigger), record
+    
+    def add_filter(self, chat_id, trigger, reply, media_type=None, file_id=None, match=None):
+        """Add a new filter for a chat (see make_filter for the arguments)"""
+        trigger, record = self.make_filter(trigger, reply, media_type, file_id, match)
+        chat_id_str = str(chat_id)
+        with self.lock:
+            chat_filters = self.get_chat_filters(chat_id)
+            previous = chat_filters.get(trigger)
+            chat_filters[trigger] = record
+            matcher = self.matchers.get(chat_id_str)
+            if matcher is not None:
+                if match:
+                    matcher.remove(trigger)
+                else:
+                    matcher.add(trigger)
+            if match or (previous and previous.get("match")):
+                self.patterns.pop(chat_id_str, None)
+            self._bump(chat_id_str)
+            self.storage.put_filter(chat_id_str, trigger, record)
     
     def remove_filter(self, chat_id, trigger):
         """Remove a filter from a chat"""
-        chat_filters = self.get_chat_filters(chat_id)
-        if trigger.lower() in chat_filters:
-            del chat_filters[trigger.lower()]
-            self.save_filters()
-            return True
-        return False
+        chat_id_str = str(chat_id)
+        with self.lock:
+            chat_filters = self.get_chat_filters(chat_id)
+            # Regex triggers keep their case, everything else is stored lower-cased
+            if trigger not in chat_filters:
+                trigger = trigger.lower()
+            if trigger not in chat_filters:
+                return False
+            record = chat_filters.pop(trigger)
+            if record.get("match"):
+                self.patterns.pop(chat_id_str, None)
+            else:
+                matcher = self.matchers.get(chat_id_str)
+                if matcher is not None:
+                    matcher.remove(trigger)
+            self._bump(chat_id_str)
+            self.storage.delete_filter(chat_id_str, trigger)
+        return True
     
     def remove_all_filters(self, chat_id):
         """Remove all filters from a chat"""
         chat_id_str = str(chat_id)
-        if chat_id_str in self.filters_data:
+        with self.lock:
+            if not self.get_chat_filters(chat_id):
+                return False
             del self.filters_data[chat_id_str]
-            self.save_filters()
-            return True
-        return False
+            self.matchers.pop(chat_id_str, None)
+            self.patterns.pop(chat_id_str, None)
+            self._bump(chat_id_str)
+            self.storage.delete_chat(chat_id_str)
+        return True
+    
+    def import_filters(self, chat_id, filters, replace=False):
+        """Apply many (trigger -> record) filters with a single storage write
+
+        Existing filters with the same trigger are overwritten; with `replace`
+        every other filter of the chat is removed. Returns the number of
+        filters added, updated and removed.
+        """
+        chat_id_str = str(chat_id)
+        with self.lock:
+            chat_filters = self.get_chat_filters(chat_id)
+            updated = sum(1 for trigger in filters if trigger in chat_filters)
+            added = len(filters) - updated
+            removed = len(chat_filters) - updated if replace else 0
+            if replace:
+                self.filters_data[chat_id_str] = dict(filters)
+            else:
+                chat_filters.update(filters)
+            # Many triggers changed at once: rebuild matchers on the next message
+            self.matchers.pop(chat_id_str, None)
+            self.patterns.pop(chat_id_str, None)
+            self._bump(chat_id_str)
+            self.storage.put_filters(chat_id_str, filters, replace)
+        return added, updated, removed
+    
+    def get_filter_pages(self, chat_id):
+        """Get the rendered /filters pages for a chat, rendering them if needed"""
+        chat_id_str = str(chat_id)
+        with self.lock:
+            pages = self.pages.get(chat_id_str)
+            if pages is None:
+                pages = render_filter_pages(self.get_chat_filters(chat_id))
+                self.pages[chat_id_str] = pages
+            return pages
+    
+    def count_loaded_filters(self):
+        """Number of filters held in memory across loaded chats"""
+        with self.lock:
+            return sum(len(chat_filters) for chat_filters in self.filters_data.values())
     
     def get_reply_for_trigger(self, chat_id, message_text):
         """Check if message contains a trigger and return reply"""
-        chat_filters = self.get_chat_filters(chat_id)
-        
-        # Check for exact match first
-        lower_text = message_text.lower()
-        for trigger, reply_data in chat_filters.items():
-            if trigger in lower_text:
-                return reply_data
+        return self.find_reply(chat_id, message_text)[1]
+    
+    def find_reply(self, chat_id, message_text):
+        """Return (trigger, reply record) for the winning trigger, or (None, None)"""
+        chat_id_str = str(chat_id)
+        # Read before matching: if the filters change meanwhile, the stored
+        # result is tagged with the old generation and never served
+        generation = self.generations.get(chat_id_str, 0)
+        cached = self.match_cache.get(chat_id_str, generation, message_text)
+        if cached is not None:
+            return cached
         
-        return None
+        result = None, None
+        chat_filters = self.get_chat_filters(chat_id)
+        if chat_filters:
+            # Earliest (then longest) trigger in the message wins, whatever its mode
+            text = message_text.lower()
+            trigger, start = self.get_chat_matcher(chat_id).search(text)
+            found = self.get_chat_patterns(chat_id).search(text)
+            if found is not None:
+                pattern_trigger, pattern_start, length = found
+                # An empty substring trigger is only a fallback and always loses
+                if not trigger or pattern_start < start or (pattern_start == start and length > len(trigger)):
+                    trigger = pattern_trigger
+            if trigger is not None:
+                result = trigger, chat_filters.get(trigger)
+        self.match_cache.put(chat_id_str, generation, message_text, result)
+        return result
 
 # Initialize the bot
 bot_instance = FilterBot()
 
+# Gauges and counters sampled when the metrics endpoint is scraped
+REGISTRY.gauge('bot_filter_chats_loaded', 'Chats whose filters are in memory',
+               function=lambda: len(bot_instance.filters_data))
+REGISTRY.gauge('bot_filters_loaded', 'Filters in memory across loaded chats',
+               function=lambda: bot_instance.count_loaded_filters())
+REGISTRY.gauge('bot_self_destruct_pending', 'Scheduled self-destruct deletions', function=deletion_scheduler.pending)
+REGISTRY.gauge('bot_outbound_pending', 'Bot API calls waiting in the outbound queue',
+               function=lambda: outbound_queue.pending())
+REGISTRY.gauge('bot_worker_queue_depth', 'Updates queued per chat worker', ('worker',),
+               function=lambda: {str(index): work_queue.qsize() for index, work_queue in enumerate(chat_executor.queues)})
+REGISTRY.counter('bot_worker_busy_seconds_total', 'Time each chat worker spent in handlers', ('worker',),
+                 function=lambda: {str(index): busy for index, busy in enumerate(chat_executor.busy_seconds)})
+REGISTRY.gauge('bot_tracked_messages', 'Replies held for edit tracking', function=lambda: len(original_messages))
+REGISTRY.gauge('bot_tracked_messages_bytes', 'Approximate memory held by the edit-tracking store',
+               function=original_messages.memory_usage)
+REGISTRY.gauge('bot_cooldown_slots', 'Active cooldown entries held in memory', ('kind',),
+               function=lambda: reply_cooldown.stats()["tracked"])
+REGISTRY.counter('bot_match_cache_lookups_total', 'Match result cache lookups', ('result',),
+                 function=lambda: {'hit': bot_instance.match_cache.hits, 'miss': bot_instance.match_cache.misses,
+                                   'stale': bot_instance.match_cache.stale})
+REGISTRY.gauge('bot_match_cache_entries', 'Match results cached across all chats',
+               function=lambda: len(bot_instance.match_cache))
+REGISTRY.counter('bot_admin_cache_lookups_total', 'Admin roster cache lookups', ('result',),
+                 function=lambda: {'hit': member_roster.hits, 'miss': member_roster.misses})
+
+def instrumented(callback):
+    """Record a handler's latency and exceptions in the metrics registry"""
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    def handler(update, context):
+        started = time.perf_counter()
+        error = None
+        try:
+            return callback(update, context)
+        except Exception as e:
+            error = type(e).__name__
+            HANDLER_ERRORS.inc(handler=name, error=error)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, handler=name)
+            chat = getattr(update, 'effective_chat', None)
+            # Failures are always logged; successful calls are sampled (LOG_SAMPLE_RATES)
+            event_log.emit("handler_error" if error else "handler", handler=name,
+                           chat_id=chat.id if chat else None, latency_ms=round(elapsed * 1000, 3), error=error)
+    return handler
+
 def start(update: Update, context: CallbackContext):
     """Start command handler"""
     welcome_message = (
@@ -172,10 +526,15 @@ def start(update: Update, context: CallbackContext):
         "Filters are case insensitive; every time someone says your trigger words, "
         "the bot will reply something else! Can be used to create your own commands.\n\n"
         "Commands:\n"
-        "- /filter &lt;trigger&gt; &lt;reply&gt;: Every time someone says \"trigger\", the bot will reply with \"sentence\". For multiple word filters, quote the trigger.\n"
+        "- /filter &lt;trigger&gt; &lt;reply&gt;: Every time someone says \"trigger\", the bot will reply with \"sentence\". For multiple word filters, quote the trigger. "
+        "Start with -word, -prefix or -regex to match whole words, word starts or a regular expression instead of any substring.\n"
         "- /filters: List all chat filters.\n"
         "- /stop &lt;trigger&gt;: Stop the bot from replying to \"trigger\".\n"
-        "- /stopall: Stop ALL filters in the current chat. This cannot be undone."
+        "- /stopall: Stop ALL filters in the current chat. This cannot be undone.\n"
+        "- /cooldown &lt;seconds&gt;: Reply at most once per period in this chat (see /cooldown for more).\n"
+        "- /settings: Show this chat's settings and set the self-destruct timer for replies.\n"
+        "- /exportfilters: Get this chat's filters as a file.\n"
+        "- /importfilters [merge|replace]: Reply to an exported file to add its filters here."
     )
     
     # Create inline keyboard with two buttons
@@ -185,7 +544,7 @@ def start(update: Update, context: CallbackContext):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    send(update.effective_chat.id, update.message.reply_text, welcome_message, reply_markup=reply_markup)
 
 def filter_command(update: Update, context: CallbackContext):
     """Handle /filter command to add new filters"""
@@ -223,12 +582,17 @@ def filter_command(update: Update, context: CallbackContext):
     args = command_text.split(' ', 1)
     
     if len(args) < 2:
-        update.message.reply_text("Usage: /filter &lt;trigger&gt; [reply text]\nReply to a media message or provide text after trigger.")
+        send(chat_id, update.message.reply_text, "Usage: /filter [-word|-prefix|-regex] &lt;trigger&gt; [reply text]\nReply to a media message or provide text after trigger.")
         return
     
-    # Parse trigger and optional reply text
+    # Parse optional match mode, trigger and optional reply text
     trigger_part = args[1]
     reply_text = ""
+    match = None
+    option = trigger_part.split(' ', 1)
+    if option[0][1:] in MATCH_MODES and option[0].startswith('-') and len(option) > 1:
+        match = option[0][1:]
+        trigger_part = option[1].lstrip()
     
     # Handle quoted triggers
     if trigger_part.startswith('"'):
@@ -237,7 +601,7 @@ def filter_command(update: Update, context: CallbackContext):
             trigger = trigger_part[1:end_quote]
             reply_text = trigger_part[end_quote+1:].lstrip()
         else:
-            update.message.reply_text("Invalid quoted trigger. Use: /filter \"trigger\" [reply text]")
+            send(chat_id, update.message.reply_text, "Invalid quoted trigger. Use: /filter \"trigger\" [reply text]")
             return
     else:
         # Split by first space to separate trigger from reply
@@ -247,30 +611,87 @@ def filter_command(update: Update, context: CallbackContext):
             reply_text = parts[1]
     
     # Add the filter
-    bot_instance.add_filter(chat_id, trigger, reply_text, media_type, file_id)
+    try:
+        bot_instance.add_filter(chat_id, trigger, reply_text, media_type, file_id, match)
+    except ValueError as e:
+        send(chat_id, update.message.reply_text, f"Filter not saved: {e}")
+        return
     
-    update.message.reply_text(f"filter saved on this {trigger}")
+    send(chat_id, update.message.reply_text, f"filter saved on this {trigger}")
+
+def format_filter_line(trigger, reply_data):
+    """One /filters line; long replies are shortened so a line always fits a page"""
+    mode = f' ({reply_data["match"]})' if reply_data.get("match") else ''
+    if reply_data["type"] == "media":
+        media_type = reply_data["media_type"]
+        caption = reply_data.get("caption", "")[:200]
+        return f'• "{trigger}"{mode} -> [{media_type.upper()} with caption: "{caption}"]\n'
+    content = reply_data["content"][:200]
+    return f'• "{trigger}"{mode} -> "{content}"\n'
+
+def render_filter_pages(chat_filters):
+    """Split a chat's filter list into pages below Telegram's message size limit
+
+    Sizes are counted in UTF-16 code units, as Telegram counts them.
+    """
+    pages = []
+    lines = []
+    size = 0
+    for trigger, reply_data in chat_filters.items():
+        line = format_filter_line(trigger, reply_data)
+        length = utf16_length(line)
+        if lines and (len(lines) >= FILTERS_PAGE_SIZE or size + length > FILTERS_PAGE_CHARS):
+            pages.append(''.join(lines))
+            lines, size = [], 0
+        lines.append(line)
+        size += length
+    if lines:
+        pages.append(''.join(lines))
+    return pages
+
+def filters_page(chat_id, page):
+    """Text and navigation keyboard for one /filters page, or (None, None) if empty"""
+    pages = bot_instance.get_filter_pages(chat_id)
+    if not pages:
+        return None, None
+    page = max(0, min(page, len(pages) - 1))
+    if len(pages) == 1:
+        return "Filters in this chat:\n\n" + pages[0], None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("« Prev", callback_data=f"filters_page:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{len(pages)}", callback_data=f"filters_page:{page}"))
+    if page < len(pages) - 1:
+        buttons.append(InlineKeyboardButton("Next »", callback_data=f"filters_page:{page + 1}"))
+    text = f"Filters in this chat (page {page + 1} of {len(pages)}):\n\n" + pages[page]
+    return text, InlineKeyboardMarkup([buttons])
 
 def filters_command(update: Update, context: CallbackContext):
-    """Handle /filters command to list all filters"""
+    """Handle /filters command to list all filters, one page at a time"""
     chat_id = update.effective_message.chat_id
-    chat_filters = bot_instance.get_chat_filters(chat_id)
+    reply_text, reply_markup = filters_page(chat_id, 0)
     
-    if not chat_filters:
-        update.message.reply_text("No filters in this chat.")
+    if reply_text is None:
+        send(chat_id, update.message.reply_text, "No filters in this chat.")
         return
     
-    reply_text = "Filters in this chat:\n\n"
-    for trigger, reply_data in chat_filters.items():
-        if reply_data["type"] == "media":
-            media_type = reply_data["media_type"]
-            caption = reply_data.get("caption", "")
-            reply_text += f'• "{trigger}" -> [{media_type.upper()} with caption: "{caption}"]\n'
-        else:
-            content = reply_data["content"]
-            reply_text += f'• "{trigger}" -> "{content}"\n'
+    send(chat_id, update.message.reply_text, reply_text, reply_markup=reply_markup)
+
+def filters_page_callback(update: Update, context: CallbackContext):
+    """Handle the prev/next buttons under a /filters listing"""
+    query = update.callback_query
+    chat_id = query.message.chat_id
+    # Answering a button press is not a message, so it skips the chat's rate limit
+    send(chat_id, query.answer, chat_limited=False)
     
-    update.message.reply_text(reply_text)
+    page = int(query.data.split(':', 1)[1])
+    reply_text, reply_markup = filters_page(chat_id, page)
+    if reply_text is None:
+        reply_text = "No filters in this chat."
+    if reply_text.rstrip() == (query.message.text or '').rstrip():
+        # Telegram rejects edits that change nothing (e.g. the page counter button)
+        return
+    send(chat_id, query.edit_message_text, text=reply_text, reply_markup=reply_markup)
 
 def stop_command(update: Update, context: CallbackContext):
     """Handle /stop command to remove a specific filter"""
@@ -280,7 +701,7 @@ def stop_command(update: Update, context: CallbackContext):
     args = message_text.split(' ', 1)
     
     if len(args) < 2:
-        update.message.reply_text("Usage: /stop &lt;trigger&gt;")
+        send(chat_id, update.message.reply_text, "Usage: /stop &lt;trigger&gt;")
         return
     
     trigger = args[1].strip('"')
@@ -292,18 +713,118 @@ def stop_command(update: Update, context: CallbackContext):
             trigger = parts[1]
     
     if bot_instance.remove_filter(chat_id, trigger):
-        update.message.reply_text(f'Removed filter: "{trigger}"')
+        send(chat_id, update.message.reply_text, f'Removed filter: "{trigger}"')
     else:
-        update.message.reply_text(f'Filter "{trigger}" not found.')
+        send(chat_id, update.message.reply_text, f'Filter "{trigger}" not found.')
 
 def stopall_command(update: Update, context: CallbackContext):
     """Handle /stopall command to remove all filters"""
     chat_id = update.effective_message.chat_id
     
     if bot_instance.remove_all_filters(chat_id):
-        update.message.reply_text("All filters removed from this chat.")
+        send(chat_id, update.message.reply_text, "All filters removed from this chat.")
     else:
-        update.message.reply_text("No filters to remove in this chat.")
+        send(chat_id, update.message.reply_text, "No filters to remove in this chat.")
+
+def cooldown_command(update: Update, context: CallbackContext):
+    """Handle /cooldown command to show or set this chat's reply cooldowns"""
+    chat_id = update.effective_message.chat_id
+    args = context.args or []
+    usage = ("Usage: /cooldown <chat seconds> [trigger seconds] [duplicate seconds], or /cooldown reset\n"
+             "chat: one reply per chat per period; trigger: one reply per trigger; "
+             "duplicate: repeated identical messages get a single reply.")
+    
+    try:
+        if args and args[0] == 'reset':
+            reply_cooldown.set_config(chat_id)
+        elif args:
+            values = [float(arg) for arg in args[:3]]
+            reply_cooldown.set_config(chat_id, **dict(zip(("chat", "trigger", "duplicate"), values)))
+    except ValueError as e:
+        send(chat_id, update.message.reply_text, f"Invalid cooldown: {e}\n{usage}")
+        return
+    
+    config = reply_cooldown.get_config(chat_id)
+    status = ", ".join(
+        f"{kind} {config[kind]:g}s" if config[kind] else f"{kind} off" for kind in ("chat", "trigger", "duplicate"))
+    reply_text = f"Reply cooldowns: {status}."
+    if not args:
+        reply_text += "\n" + usage
+    send(chat_id, update.message.reply_text, reply_text)
+
+def exportfilters_command(update: Update, context: CallbackContext):
+    """Handle /exportfilters command to send the chat's filters as a JSON file"""
+    chat_id = update.effective_message.chat_id
+    with bot_instance.lock:
+        items = list(bot_instance.get_chat_filters(chat_id).items())
+    
+    if not items:
+        send(chat_id, update.message.reply_text, "No filters to export in this chat.")
+        return
+    
+    # Bytes rather than a stream: a retried send must upload the same content again
+    send(chat_id, update.message.reply_document, document=dump_filters(items), filename=f"filters-{chat_id}.json",
+         caption=f"{len(items)} filters. Reply to this file with /importfilters to copy them to another chat.")
+
+def importfilters_command(update: Update, context: CallbackContext):
+    """Handle /importfilters command to load filters from a replied-to JSON file"""
+    chat_id = update.effective_message.chat_id
+    message = update.effective_message
+    usage = ("Usage: reply to a file made by /exportfilters with /importfilters [merge|replace]\n"
+             "merge (default) keeps existing filters, replace removes filters not in the file.")
+    
+    document = message.reply_to_message.document if message.reply_to_message else None
+    args = context.args or []
+    mode = args[0].lower() if args else 'merge'
+    if document is None or mode not in ('merge', 'replace'):
+        send(chat_id, update.message.reply_text, usage)
+        return
+    if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+        send(chat_id, update.message.reply_text, f"The file is too large (limit {MAX_IMPORT_BYTES // 1024} KB).")
+        return
+    
+    def downloadable(future):
+        """Continue on the chat's worker once the file is known; never wait for it here"""
+        if future.exception() is not None:
+            send(chat_id, update.message.reply_text, f"Could not fetch the file: {future.exception()}")
+            return
+        chat_executor.submit(chat_id, import_document, update, future.result(), mode)
+    
+    send(chat_id, context.bot.get_file, document.file_id).add_done_callback(downloadable)
+
+def import_document(update: Update, telegram_file, mode):
+    """Second half of /importfilters: download the file and apply its filters"""
+    chat_id = update.effective_message.chat_id
+    filters = {}
+    rejected = 0
+    try:
+        with tempfile.TemporaryFile() as raw:
+            telegram_file.download(out=raw)
+            raw.seek(0)
+            # Entries are parsed one at a time instead of loading the whole document
+            for entry in iter_entries(io.TextIOWrapper(raw, encoding='utf-8')):
+                if len(filters) >= MAX_IMPORT_FILTERS:
+                    rejected += 1
+                    continue
+                try:
+                    trigger, record = FilterBot.make_filter(**parse_entry(entry))
+                except ValueError:
+                    rejected += 1
+                    continue
+                filters[trigger] = record
+    except ValueError as e:
+        send(chat_id, update.message.reply_text, f"Could not read the file: {e}")
+        return
+    
+    if not filters:
+        send(chat_id, update.message.reply_text, f"No valid filters found ({rejected} rejected); nothing changed.")
+        return
+    
+    added, updated, removed = bot_instance.import_filters(chat_id, filters, replace=mode == 'replace')
+    summary = f"Imported filters: {added} added, {updated} updated, {rejected} rejected"
+    if mode == 'replace':
+        summary += f", {removed} removed"
+    send(chat_id, update.message.reply_text, summary + ".")
 
 def goodmorning_command(update: Update, context: CallbackContext):
     """Handle /goodmorning command to send good morning message with member mentions (excluding command user)"""
@@ -313,362 +834,459 @@ def goodmorning_command(update: Update, context: CallbackContext):
     
     # Only allow in group chats
     if update.effective_chat.type not in ['group', 'supergroup']:
-        update.message.reply_text("This command only works in group chats!")
+        send(chat_id, update.message.reply_text, "This command only works in group chats!")
         return
     
-    try:
-        # Get chat members - try multiple approaches to get more members
-        member_mentions = []
-        processed_user_ids = set()  # To avoid duplicates
-        
-        # Approach 1: Get chat administrators (always available)
-        try:
-            chat_admins = context.bot.get_chat_administrators(chat_id)
-            for admin in chat_admins:
-                user = admin.user
-                # Skip bots, command user, and duplicates
-                if not user.is_bot and user.id != command_user_id and user.id not in processed_user_ids:
-                    member_mentions.append(f"@{user.username}" if user.username else f"[{user.first_name}](tg://user?id={user.id})")
-                    processed_user_ids.add(user.id)
-        except Exception as admin_error:
-            print(f"Could not get chat administrators: {admin_error}")
+    member_roster.observe(chat_id, update.effective_user)
+    
+    def fallback(error):
+        """Greet without mentions; if that fails too, apologise"""
+        shayari_message = get_good_morning_shayari()
+        retried = send(chat_id, update.message.reply_text, f"Good morning {command_user_name}! 🌞\n\n{shayari_message}")
         
-        # Approach 2: Try to get recent message senders (if bot has access)
-        try:
-            # This is a workaround - get recent messages to identify active members
-            # Note: This requires the bot to have access to message history
-            updates = context.bot.get_updates(limit=50)
-            for update in updates:
-                if update.message and update.message.chat.id == chat_id:
-                    user = update.message.from_user
-                    if not user.is_bot and user.id != command_user_id and user.id not in processed_user_ids:
-                        member_mentions.append(f"@{user.username}" if user.username else f"[{user.first_name}](tg://user?id={user.id})")
-                        processed_user_ids.add(user.id)
-        except Exception as history_error:
-            print(f"Could not get message history: {history_error}")
+        def log_fallback(future):
+            fallback_error = future.exception()
+            if fallback_error is None:
+                event_log.emit("good_morning_sent", handler="goodmorning_command", chat_id=chat_id, mentions=0,
+                               error=type(error).__name__)
+                return
+            send(chat_id, update.message.reply_text, "Sorry, I couldn't send the good morning message right now.")
+            event_log.emit("good_morning_failed", handler="goodmorning_command", chat_id=chat_id,
+                           error=type(error).__name__, fallback_error=type(fallback_error).__name__)
         
-        # Approach 3: Mention common group roles (if applicable)
-        # This is a fallback for when we can't get specific members
+        retried.add_done_callback(log_fallback)
+    
+    try:
+        # Admins (cached) and recently active members, without waiting on the API
+        member_mentions = member_roster.mention_list(chat_id, context.bot, exclude_user_id=command_user_id)
         
         # Get the shayari
         shayari_message = get_good_morning_shayari()
         
         # Create message with mentions
         if member_mentions:
-            # Limit mentions to avoid spam and Telegram limits (max ~50 mentions per message)
-            limited_mentions = member_mentions[:8]  # Increased limit since we're getting more members
-            mention_text = " ".join(limited_mentions)
+            # mention_list caps mentions to avoid spam and Telegram limits
+            mention_text = " ".join(member_mentions)
             # Include the command user's name in the greeting
             full_message = f"Good morning {command_user_name}! 🌞\n\n{mention_text}\n\n{shayari_message}"
         else:
             # Fallback if no other members found
             full_message = f"Good morning {command_user_name}! 🌞\n\n{shayari_message}"
         
-        # Send the message
-        sent_message = update.message.reply_text(
-            full_message, 
-            parse_mode='Markdown'
-        )
-        print(f"Good morning message with mentions (excluding {command_user_name}) sent to chat {chat_id}")
-        
+        # Send the message; the outcome is handled when it has been sent
+        sent = send(chat_id, update.message.reply_text, full_message, parse_mode='Markdown')
     except Exception as e:
         # Fallback to simple message if mentions fail
-        try:
-            shayari_message = get_good_morning_shayari()
-            update.message.reply_text(f"Good morning {command_user_name}! 🌞\n\n{shayari_message}")
-            print(f"Good morning message sent without mentions to chat {chat_id}")
-        except Exception as fallback_error:
-            update.message.reply_text("Sorry, I couldn't send the good morning message right now.")
-            print(f"Error sending good morning message: {e}")
+        fallback(e)
+        return
+    
+    def log_sent(future):
+        if future.exception() is not None:
+            fallback(future.exception())
+            return
+        event_log.emit("good_morning_sent", handler="goodmorning_command", chat_id=chat_id,
+                       mentions=len(member_mentions))
+    
+    sent.add_done_callback(log_sent)
 
-def settings_command(update: Update, context: CallbackContext):
-    """Handle /settings command to show bot settings"""
-    global bot_settings
+def send_good_morning(bot, chat_id):
+    """Send the daily good morning message with member mentions to a group"""
+    def fallback(error):
+        """Send the greeting without mentions"""
+        shayari_message = get_good_morning_shayari()
+        retried = send(chat_id, bot.send_message, chat_id=chat_id, text=shayari_message, priority=PRIORITY_BACKGROUND)
+        
+        def log_fallback(future):
+            fallback_error = future.exception()
+            if fallback_error is None:
+                event_log.emit("good_morning_sent", handler="send_good_morning", chat_id=chat_id, mentions=0,
+                               error=type(error).__name__)
+            else:
+                event_log.emit("good_morning_failed", handler="send_good_morning", chat_id=chat_id,
+                               error=type(error).__name__, fallback_error=type(fallback_error).__name__)
+        
+        retried.add_done_callback(log_fallback)
+    
+    try:
+        # Admins (cached) and recently active members, without waiting on the API
+        member_mentions = member_roster.mention_list(chat_id, bot)
+        
+        # Get the shayari
+        shayari_message = get_good_morning_shayari()
+        
+        # Create message with mentions
+        if member_mentions:
+            mention_text = " ".join(member_mentions)
+            full_message = f"{mention_text}\n\n{shayari_message}"
+        else:
+            full_message = shayari_message
+        
+        # Send the message; the job thread does not wait for the outbound queue
+        sent = send(chat_id, bot.send_message, chat_id=chat_id, text=full_message, parse_mode='Markdown',
+                    priority=PRIORITY_BACKGROUND)
+    except Exception as e:
+        # Fallback to simple message
+        fallback(e)
+        return
     
-    # Get current settings
-    self_destruct_time = bot_settings.get("self_destruct_time", 0)
+    def log_sent(future):
+        if future.exception() is not None:
+            fallback(future.exception())
+            return
+        event_log.emit("good_morning_sent", handler="send_good_morning", chat_id=chat_id,
+                       mentions=len(member_mentions))
+    
+    sent.add_done_callback(log_sent)
+
+def goodmorning_window_command(update: Update, context: CallbackContext):
+    """Handle /goodmorningwindow command to set when the daily greeting is sent"""
+    chat_id = update.effective_message.chat_id
+    args = context.args or []
+    
+    if not args:
+        start_hour, end_hour, timezone = good_morning_scheduler.get_window(chat_id)
+        send(
+            chat_id, update.message.reply_text,
+            f"Good morning is sent between {start_hour}:00 and {end_hour}:00 ({timezone or 'server time'}).\n"
+            "Usage: /goodmorningwindow <start hour> <end hour> [timezone]"
+        )
+        return
+    
+    try:
+        start_hour, end_hour = int(args[0]), int(args[1])
+        timezone = args[2] if len(args) > 2 else None
+        good_morning_scheduler.set_window(chat_id, start_hour, end_hour, timezone)
+    except (IndexError, ValueError) as e:
+        send(chat_id, update.message.reply_text, f"Invalid window: {e}\nUsage: /goodmorningwindow <start hour> <end hour> [timezone]")
+        return
+    
+    send(chat_id, update.message.reply_text, f"Good morning window set to {start_hour}:00-{end_hour}:00.")
+
+def profile_command(update: Update, context: CallbackContext):
+    """Handle /profile command to profile handlers for N seconds or N updates"""
+    chat_id = update.effective_message.chat_id
+    
+    def reply(text):
+        # In a sharded deployment every shard gets /profile; only the chat's own shard answers
+        if owns_chat(BOT_SHARD, chat_id):
+            send(chat_id, update.message.reply_text, text)
+    
+    if update.effective_user.id not in BOT_ADMIN_IDS:
+        reply("Only bot admins can use /profile.")
+        return
+    
+    args = context.args or []
+    if args and args[0] == 'stop':
+        written = profiler.disable()
+        reply(f"Profiling stopped, {len(written)} profiles written.")
+        return
+    
+    # "/profile 60" profiles for 60 seconds, "/profile 500u" for 500 updates
+    seconds, updates = PROFILE_DEFAULT_SECONDS, None
+    if args:
+        try:
+            if args[0].endswith('u'):
+                seconds, updates = None, int(args[0][:-1])
+            else:
+                seconds = int(args[0])
+        except ValueError:
+            reply("Usage: /profile [seconds | <count>u | stop]")
+            return
+    
+    if profiler.enable(seconds=seconds, updates=updates):
+        reply(f"Profiling started, files go to {profiler.output_dir}/")
+    else:
+        reply("A profiling session is already running.")
+
+def settings_menu(chat_id):
+    """Main /settings text and keyboard for a chat"""
+    self_destruct_time = chat_settings.get(chat_id, "self_destruct_time", SELF_DESTRUCT_TIME)
     
     # Self-destruct status
     destruct_status = f"{self_destruct_time}s" if self_destruct_time > 0 else "Disabled"
     destruct_checkmark = "✅" if self_destruct_time > 0 else "⭕"
     
+    start_hour, end_hour, timezone = good_morning_scheduler.get_window(chat_id)
+    cooldowns = reply_cooldown.get_config(chat_id)
+    cooldown_status = ", ".join(
+        f"{kind} {cooldowns[kind]:g}s" for kind in ("chat", "trigger", "duplicate") if cooldowns[kind]) or "off"
+    
     message_text = (
         "Bot Settings\n\n"
         f"{destruct_checkmark} Self-Destruct ({destruct_status})\n"
-        "Auto-delete bot messages after set time"
+        "Auto-delete bot messages after set time\n\n"
+        f"Good morning: {start_hour}:00-{end_hour}:00 ({timezone or 'server time'}), change with /goodmorningwindow\n"
+        f"Reply cooldowns: {cooldown_status}, change with /cooldown"
     )
     
     # Create inline keyboard with self-destruct setting
     keyboard = [
         [InlineKeyboardButton("Self-Destruct", callback_data="toggle_self_destruct_menu")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+def self_destruct_menu(chat_id):
+    """Self-destruct timer text and adjustment keyboard for a chat"""
+    current_time = chat_settings.get(chat_id, "self_destruct_time", SELF_DESTRUCT_TIME)
+    status = f"{current_time}s" if current_time > 0 else "Disabled"
+    
+    message_text = f"Self-Destruct Timer\nCurrent: {status}\n\nAdjust the time for auto-deletion:"
     
-    update.message.reply_text(message_text, reply_markup=reply_markup)
+    # Create buttons for adjusting time
+    keyboard = [
+        [InlineKeyboardButton("-10s", callback_data="decrease_time_10"),
+         InlineKeyboardButton("-1s", callback_data="decrease_time_1"),
+         InlineKeyboardButton("Reset", callback_data="reset_time"),
+         InlineKeyboardButton("+1s", callback_data="increase_time_1"),
+         InlineKeyboardButton("+10s", callback_data="increase_time_10")],
+        [InlineKeyboardButton("Back to Settings", callback_data="back_to_settings")]
+    ]
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+def settings_command(update: Update, context: CallbackContext):
+    """Handle /settings command to show this chat's settings"""
+    chat_id = update.effective_chat.id
+    message_text, reply_markup = settings_menu(chat_id)
+    send(chat_id, update.message.reply_text, message_text, reply_markup=reply_markup)
 
 def handle_settings_callback(update: Update, context: CallbackContext):
     """Handle callback queries for settings buttons"""
-    global bot_settings
     query = update.callback_query
-    query.answer()
+    chat_id = query.message.chat_id
+    # Answering a button press is not a message, so it skips the chat's rate limit
+    send(chat_id, query.answer, chat_limited=False)
     
     callback_data = query.data
-    user_id = query.from_user.id
-    chat_id = query.message.chat_id
-    message_id = query.message.message_id
     
-    if callback_data == "start_settings":
-        # Handle settings button from start command - show main settings
-        self_destruct_time = bot_settings.get("self_destruct_time", 0)
-        
-        # Self-destruct status
-        destruct_status = f"{self_destruct_time}s" if self_destruct_time > 0 else "Disabled"
-        destruct_checkmark = "✅" if self_destruct_time > 0 else "⭕"
-        
-        message_text = (
-            "Bot Settings\n\n"
-            f"{destruct_checkmark} Self-Destruct ({destruct_status})\n"
-            "Auto-delete bot messages after set time"
-        )
-        
-        # Create inline keyboard with self-destruct setting
-        keyboard = [
-            [InlineKeyboardButton("Self-Destruct", callback_data="toggle_self_destruct_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.edit_message_text(text=message_text, reply_markup=reply_markup)
-        
+    if callback_data in ("start_settings", "back_to_settings"):
+        message_text, reply_markup = settings_menu(chat_id)
+    
     elif callback_data == "toggle_self_destruct_menu":
         # Show self-destruct time adjustment menu
-        current_time = bot_settings.get("self_destruct_time", 0)
-        status = f"{current_time}s" if current_time > 0 else "Disabled"
-        
-        message_text = f"Self-Destruct Timer\nCurrent: {status}\n\nAdjust the time for auto-deletion:"
-        
-        # Create buttons for adjusting time
-        keyboard = [
-            [InlineKeyboardButton("-10s", callback_data="decrease_time_10"),
-             InlineKeyboardButton("-1s", callback_data="decrease_time_1"),
-             InlineKeyboardButton("Reset", callback_data="reset_time"),
-             InlineKeyboardButton("+1s", callback_data="increase_time_1"),
-             InlineKeyboardButton("+10s", callback_data="increase_time_10")],
-            [InlineKeyboardButton("Back to Settings", callback_data="back_to_settings")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.edit_message_text(text=message_text, reply_markup=reply_markup)
+        message_text, reply_markup = self_destruct_menu(chat_id)
     
     elif callback_data.startswith("increase_time_") or callback_data.startswith("decrease_time_") or callback_data == "reset_time":
         # Handle time adjustments
-        current_time = bot_settings.get("self_destruct_time", 0)
+        current_time = chat_settings.get(chat_id, "self_destruct_time", SELF_DESTRUCT_TIME)
         
-        if callback_data == "increase_time_1":
-            current_time += 1
-        elif callback_data == "increase_time_10":
-            current_time += 10
-        elif callback_data == "decrease_time_1":
-            current_time = max(0, current_time - 1)  # Prevent negative values
-        elif callback_data == "decrease_time_10":
-            current_time = max(0, current_time - 10)  # Prevent negative values
-        elif callback_data == "reset_time":
+        if callback_data == "reset_time":
             current_time = 0  # Disable self-destruct
+        else:
+            step = int(callback_data.rsplit("_", 1)[1])
+            current_time += step if callback_data.startswith("increase") else -step
         
-        # Update settings
-        bot_settings["self_destruct_time"] = current_time
-        save_settings(bot_settings)
+        # Only the in-memory value changes here; the file write is debounced, so
+        # a run of presses is saved once
+        chat_settings.update(chat_id, self_destruct_time=min(max(current_time, 0), 86400))
         
         # Refresh the self-destruct menu
-        status = f"{current_time}s" if current_time > 0 else "Disabled"
-        message_text = f"Self-Destruct Timer\nCurrent: {status}\n\nAdjust the time for auto-deletion:"
-        
-        # Create buttons for adjusting time
-        keyboard = [
-            [InlineKeyboardButton("-10s", callback_data="decrease_time_10"),
-             InlineKeyboardButton("-1s", callback_data="decrease_time_1"),
-             InlineKeyboardButton("Reset", callback_data="reset_time"),
-             InlineKeyboardButton("+1s", callback_data="increase_time_1"),
-             InlineKeyboardButton("+10s", callback_data="increase_time_10")],
-            [InlineKeyboardButton("Back to Settings", callback_data="back_to_settings")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.edit_message_text(text=message_text, reply_markup=reply_markup)
-    
-    elif callback_data == "back_to_settings":
-        # Go back to main settings
-        self_destruct_time = bot_settings.get("self_destruct_time", 0)
-        
-        # Self-destruct status
-        destruct_status = f"{self_destruct_time}s" if self_destruct_time > 0 else "Disabled"
-        destruct_checkmark = "✅" if self_destruct_time > 0 else "⭕"
-        
-        message_text = (
-            "Bot Settings\n\n"
-            f"{destruct_checkmark} Self-Destruct ({destruct_status})\n"
-            "Auto-delete bot messages after set time"
-        )
-        
-        # Create inline keyboard with self-destruct setting
-        keyboard = [
-            [InlineKeyboardButton("Self-Destruct", callback_data="toggle_self_destruct_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.edit_message_text(text=message_text, reply_markup=reply_markup)
-
-def should_send_good_morning(chat_id):
-    """Check if we should send good morning message (once per day, morning hours)"""
-    current_time = time.time()
-    last_time = last_good_morning.get(chat_id, 0)
+        message_text, reply_markup = self_destruct_menu(chat_id)
     
-    # Check if 24 hours have passed
-    if current_time - last_time < 24 * 3600:
-        return False
-    
-    # Check if it's morning time (6 AM to 10 AM)
-    current_hour = time.localtime().tm_hour
-    if current_hour < 6 or current_hour > 10:
-        return False
+    else:
+        return
     
-    return True
-
+    send(chat_id, query.edit_message_text, text=message_text, reply_markup=reply_markup)
 
 def handle_message(update: Update, context: CallbackContext):
     """Handle incoming messages and check for triggers"""
     chat_id = update.effective_message.chat_id
     message_text = update.effective_message.text
     
-    # Check for auto good morning (only in group chats)
+    # Track group members and enrol the chat for the daily good morning
     if update.effective_chat.type in ['group', 'supergroup']:
-        if should_send_good_morning(chat_id):
-            try:
-                # Get chat members - try multiple approaches
-                member_mentions = []
-                processed_user_ids = set()
-                
-                # Approach 1: Get chat administrators
-                try:
-                    chat_admins = context.bot.get_chat_administrators(chat_id)
-                    for admin in chat_admins:
-                        user = admin.user
-                        if not user.is_bot and user.id not in processed_user_ids:
-                            member_mentions.append(f"@{user.username}" if user.username else f"[{user.first_name}](tg://user?id={user.id})")
-                            processed_user_ids.add(user.id)
-                except Exception as admin_error:
-                    print(f"Could not get chat administrators: {admin_error}")
-                
-                # Approach 2: Try to get recent message senders
-                try:
-                    updates = context.bot.get_updates(limit=50)
-                    for update in updates:
-                        if update.message and update.message.chat.id == chat_id:
-                            user = update.message.from_user
-                            if not user.is_bot and user.id not in processed_user_ids:
-                                member_mentions.append(f"@{user.username}" if user.username else f"[{user.first_name}](tg://user?id={user.id})")
-                                processed_user_ids.add(user.id)
-                except Exception as history_error:
-                    print(f"Could not get message history: {history_error}")
-                
-                # Get the shayari
-                shayari_message = get_good_morning_shayari()
-                
-                # Create message with mentions
-                if member_mentions:
-                    limited_mentions = member_mentions[:8]  # Increased limit for auto messages too
-                    mention_text = " ".join(limited_mentions)
-                    full_message = f"{mention_text}\n\n{shayari_message}"
-                else:
-                    full_message = shayari_message
-                
-                # Send the message
-                context.bot.send_message(
-                    chat_id=chat_id, 
-                    text=full_message,
-                    parse_mode='Markdown'
-                )
-                last_good_morning[chat_id] = time.time()
-                print(f"Sent good morning message with mentions to chat {chat_id}")
-            except Exception as e:
-                # Fallback to simple message
-                try:
-                    shayari_message = get_good_morning_shayari()
-                    context.bot.send_message(chat_id=chat_id, text=shayari_message)
-                    print(f"Sent good morning message without mentions to chat {chat_id}")
-                except Exception as fallback_error:
-                    print(f"Could not send good morning message: {e}")
+        member_roster.observe(chat_id, update.effective_user)
+        # Greeting itself runs later on the job queue, off this handler; a
+        # scheduling failure must not cost the message its filter reply
+        try:
+            good_morning_scheduler.register(chat_id)
+        except Exception as e:
+            event_log.emit("good_morning_failed", handler="handle_message", chat_id=chat_id, error=type(e).__name__)
     
     if not message_text:
         return
     
-    reply_data = bot_instance.get_reply_for_trigger(chat_id, message_text)
-    
-    if reply_data:
-        if reply_data["type"] == "media":
-            # Send media with caption
-            media_type = reply_data["media_type"]
-            file_id = reply_data["file_id"]
-            caption = reply_data.get("caption", "")
-            
-            if media_type == "photo":
-                sent_message = update.message.reply_photo(photo=file_id, caption=caption)
-            elif media_type == "video":
-                sent_message = update.message.reply_video(video=file_id, caption=caption)
-            elif media_type == "document":
-                sent_message = update.message.reply_document(document=file_id, caption=caption)
-            elif media_type == "audio":
-                sent_message = update.message.reply_audio(audio=file_id, caption=caption)
-            elif media_type == "voice":
-                sent_message = update.message.reply_voice(voice=file_id, caption=caption)
-            elif media_type == "sticker":
-                sent_message = update.message.reply_sticker(sticker=file_id)
-        else:
-            # Send text reply
-            sent_message = update.message.reply_text(reply_data["content"])
+    trigger, reply_data = bot_instance.find_reply(chat_id, message_text)
+    FILTER_MATCHES.inc(result='hit' if reply_data else 'miss')
+    
+    if not reply_data:
+        return
+    
+    # Floods of the same trigger get one reply per cooldown instead of one per message
+    suppressed = reply_cooldown.allow(chat_id, trigger, message_text)
+    event_log.emit("filter_hit", handler="handle_message", chat_id=chat_id, trigger=trigger,
+                   reply_type=reply_data["type"], suppressed=suppressed)
+    if suppressed is not None:
+        return
+    
+    sent = None
+    if reply_data["type"] == "media":
+        # Send media with caption
+        media_type = reply_data["media_type"]
+        file_id = reply_data["file_id"]
+        caption = reply_data.get("caption", "")
+        
+        if media_type == "photo":
+            sent = send(chat_id, update.message.reply_photo, photo=file_id, caption=caption)
+        elif media_type == "video":
+            sent = send(chat_id, update.message.reply_video, video=file_id, caption=caption)
+        elif media_type == "document":
+            sent = send(chat_id, update.message.reply_document, document=file_id, caption=caption)
+        elif media_type == "audio":
+            sent = send(chat_id, update.message.reply_audio, audio=file_id, caption=caption)
+        elif media_type == "voice":
+            sent = send(chat_id, update.message.reply_voice, voice=file_id, caption=caption)
+        elif media_type == "sticker":
+            sent = send(chat_id, update.message.reply_sticker, sticker=file_id)
+    else:
+        # Send text reply
+        sent = send(chat_id, update.message.reply_text, reply_data["content"])
+    
+    if sent is None:
+        return
+    user_id = update.effective_user.id
+    
+    def track_reply(future):
+        """Track the reply once the outbound queue has actually sent it"""
+        if future.exception() is not None:
+            return
+        sent_message = future.result()
         
         # Store the original message ID for edit tracking
-        if 'sent_message' in locals() and sent_message:
-            original_messages[sent_message.message_id] = {
-                "chat_id": chat_id,
-                "user_id": update.effective_user.id
-            }
-            
-            # Schedule self-destruct with default time (disabled)
-            self_destruct_time = 0  # Self-destruct disabled by default
-            if self_destruct_time > 0:
-                schedule_self_destruct(context, chat_id, sent_message.message_id, self_destruct_time)
+        original_messages.add(chat_id, sent_message.message_id, user_id)
+        
+        # Chats choose their own time in /settings; a memory lookup, no I/O
+        self_destruct_time = chat_settings.get(chat_id, "self_destruct_time", SELF_DESTRUCT_TIME)
+        if self_destruct_time > 0:
+            schedule_self_destruct(None, chat_id, sent_message.message_id, self_destruct_time)
+    
+    sent.add_done_callback(track_reply)
 
 # Edit checker feature removed as requested
 
+def run_webhook(updater):
+    """Receive updates on the local webhook endpoint instead of polling"""
+    secret = os.getenv('WEBHOOK_SECRET')
+    server = WebhookServer(
+        updater.dispatcher.update_queue.put,
+        decode=lambda data: Update.de_json(data, updater.bot),
+        host=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+        port=int(os.getenv('WEBHOOK_PORT', '8443')),
+        path=os.getenv('WEBHOOK_PATH', '/telegram'),
+        secret=secret,
+        queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000')),
+    )
+    
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+    server.start()
+    REGISTRY.counter('bot_webhook_requests_total', 'Webhook requests by outcome', ('result',),
+                     function=lambda: {'accepted': server.received, 'rejected': server.rejected,
+                                       'bad_request': server.bad_requests})
+    REGISTRY.gauge('bot_webhook_queue_depth', 'Webhook updates waiting for the dispatcher',
+                   function=lambda: server.queue.qsize())
+    REGISTRY.gauge('bot_webhook_queue_max_depth', 'Deepest the webhook queue has been',
+                   function=lambda: server.max_depth)
+    REGISTRY.gauge('bot_webhook_queue_capacity', 'Webhook updates buffered before answering 503',
+                   function=lambda: server.queue.maxsize)
+    
+    # Register the public URL with Telegram unless it is managed elsewhere
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        updater.bot.set_webhook(url=webhook_url, api_kwargs={'secret_token': secret} if secret else None)
+    
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+    stop_event.wait()
+    
+    server.stop()
+    updater.dispatcher.stop()
+    updater.job_queue.stop()
+
+
 def main():
     """Main function to run the bot"""
+    # Warnings and worker tracebacks go to stderr; stdout is the event log
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s',
+                        level=os.getenv('LOG_LEVEL', 'WARNING').upper())
+    
     # Get token from environment variable
     token = os.getenv('TELEGRAM_BOT_TOKEN')
     
     if not token:
-        print("Error: TELEGRAM_BOT_TOKEN environment variable not set!")
+        logger.error("TELEGRAM_BOT_TOKEN environment variable not set!")
         return
     
-    updater = Updater(token, use_context=True)
+    # TELEGRAM_API_BASE_URL points the bot at another Bot API server, e.g. a
+    # local one or the fake server of soak_test.py ("http://127.0.0.1:8081/bot")
+    updater = Updater(token, base_url=os.getenv('TELEGRAM_API_BASE_URL') or None, use_context=True)
     dp = updater.dispatcher
     
+    # Handlers run on per-chat workers: parallel across chats, ordered within one
+    def run(callback):
+        return chat_executor.wrap(instrumented(profiler.wrap(callback)))
+    
     # Register command handlers
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("filter", filter_command))
-    dp.add_handler(CommandHandler("filters", filters_command))
-    dp.add_handler(CommandHandler("stop", stop_command))
-    dp.add_handler(CommandHandler("stopall", stopall_command))
-    dp.add_handler(CommandHandler("goodmorning", goodmorning_command))
+    dp.add_handler(CommandHandler("start", run(start)))
+    dp.add_handler(CommandHandler("filter", run(filter_command)))
+    dp.add_handler(CommandHandler("filters", run(filters_command)))
+    dp.add_handler(CommandHandler("stop", run(stop_command)))
+    dp.add_handler(CommandHandler("stopall", run(stopall_command)))
+    dp.add_handler(CommandHandler("cooldown", run(cooldown_command)))
+    dp.add_handler(CommandHandler("exportfilters", run(exportfilters_command)))
+    dp.add_handler(CommandHandler("importfilters", run(importfilters_command)))
+    dp.add_handler(CommandHandler("goodmorning", run(goodmorning_command)))
+    dp.add_handler(CommandHandler("goodmorningwindow", run(goodmorning_window_command)))
+    dp.add_handler(CommandHandler("profile", run(profile_command)))
+    dp.add_handler(CommandHandler("settings", run(settings_command)))
+    
+    # Prev/next buttons of the /filters listing
+    dp.add_handler(CallbackQueryHandler(run(filters_page_callback), pattern=r'^filters_page:\d+$'))
     
-    # No callback handlers needed
+    # /settings buttons
+    dp.add_handler(CallbackQueryHandler(
+        run(handle_settings_callback),
+        pattern=r'^(start_settings|back_to_settings|toggle_self_destruct_menu|reset_time|(increase|decrease)_time_\d+)$'))
     
     # Register message handlers
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, run(handle_message)))
+    
+    metrics_port = int(os.getenv('METRICS_PORT', '9095'))
+    if metrics_port:
+        start_http_server(metrics_port, os.getenv('METRICS_ADDR', '127.0.0.1'))
+    
+    for path in bot_instance.storage.watch_paths:
+        file_watcher.watch(path, bot_instance.check_for_changes)
+    file_watcher.watch(SETTINGS_FILE, chat_settings.reload)
+    file_watcher.start()
+    chat_settings.on_change = good_morning_scheduler.reschedule
+    chat_settings.start()
+    
+    event_log.start()
+    start_self_destruct_scheduler(updater.bot)
+    good_morning_scheduler.start(
+        updater.job_queue,
+        lambda bot, chat_id: profiler.call('send_good_morning', chat_id, send_good_morning, bot, chat_id))
+    
+    # SIGUSR1 profiles handlers for PROFILE_DEFAULT_SECONDS
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.enable(seconds=PROFILE_DEFAULT_SECONDS))
     
     # Start the bot
-    print("Bot is starting...")
-    updater.start_polling()
-    updater.idle()
+    logger.info("Bot is starting...")
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        run_webhook(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+    file_watcher.stop()
+    chat_executor.stop()
+    deletion_scheduler.stop()
+    good_morning_scheduler.stop()
+    outbound_queue.stop(OUTBOUND_STOP_TIMEOUT)
+    bot_instance.close()
+    chat_settings.stop()
+    event_log.stop()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
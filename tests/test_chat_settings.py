@@ -0,0 +1,18 @@
+import json
+import os
+
+import pytest
+
+from chat_settings import ChatSettings
+
+
+def test_failed_write_is_retried_by_the_next_flush(tmp_path):
+    state_dir = tmp_path / "state"
+    settings = ChatSettings(str(state_dir / "chat_settings.json"))
+    settings.update(42, cooldown_chat=30)
+    with pytest.raises(OSError):
+        settings.flush()
+    os.mkdir(state_dir)
+    settings.stop()
+    with open(state_dir / "chat_settings.json") as f:
+        assert json.load(f) == {"42": {"cooldown_chat": 30}}
@@ -0,0 +1,101 @@
+from filter_journal import read_journaled_snapshot
+from filter_record import make_record
+from filter_storage import JournalStorage
+
+
+def reply(text):
+    return make_record("text", None, None, None, text, None)
+
+
+def open_storage(path):
+    # No background syncs or compactions; the test drives them
+    return JournalStorage(str(path), fsync_interval=3600, compact_every=10 ** 9)
+
+
+def test_compaction_keeps_other_writers_journal_entries(tmp_path):
+    path = tmp_path / "chat_filters.json"
+    first = open_storage(path)
+    second = open_storage(path)
+    try:
+        first.put_filter("1", "hi", reply("from first"))
+        second.put_filter("2", "hey", reply("from second"))
+        first.journal.sync()
+        second.journal.sync()
+
+        # Buffered in the second writer while the first one compacts
+        second.put_filter("2", "yo", reply("unsynced"))
+        first.compact()
+        second.journal.sync()
+
+        data, _ = read_journaled_snapshot(str(path))
+        assert data["1"]["hi"] == reply("from first")
+        assert data["2"]["hey"] == reply("from second")
+        assert data["2"]["yo"] == reply("unsynced")
+        # The compacting writer adopted what it folded in
+        assert first.data["2"]["hey"] == reply("from second")
+    finally:
+        second.close()
+        first.close()
+
+    data, replayed = read_journaled_snapshot(str(path))
+    assert replayed == 0
+    assert set(data) == {"1", "2"}
+    assert set(data["2"]) == {"hey", "yo"}
+
+
+def test_compaction_after_the_other_writer_compacted(tmp_path):
+    path = tmp_path / "chat_filters.json"
+    first = open_storage(path)
+    second = open_storage(path)
+    try:
+        first.put_filter("1", "hi", reply("one"))
+        first.compact()
+        second.put_filter("2", "hey", reply("two"))
+        # The snapshot changed under the second writer, which merges it first
+        second.compact()
+        first.put_filter("1", "bye", reply("three"))
+        first.compact()
+    finally:
+        second.close()
+        first.close()
+
+    data, _ = read_journaled_snapshot(str(path))
+    assert set(data["1"]) == {"hi", "bye"}
+    assert set(data["2"]) == {"hey"}
+
+
+def test_entries_after_a_torn_line_survive(tmp_path):
+    path = tmp_path / "chat_filters.json"
+    # A crash cut the only journal entry short
+    with open(str(path) + ".journal", "w") as f:
+        f.write('{"op": "set", "chat": "1", "trig')
+
+    restarted = open_storage(path)
+    restarted.put_filter("1", "bye", reply("after the restart"))
+    restarted.journal.sync()
+    data, _ = read_journaled_snapshot(str(path))
+    assert set(data["1"]) == {"bye"}
+    restarted.close()
+
+
+def test_check_for_changes_applies_the_other_writers_journal_entries(tmp_path):
+    path = tmp_path / "chat_filters.json"
+    first = open_storage(path)
+    second = open_storage(path)
+    reloaded = []
+    first.on_change = reloaded.append
+    try:
+        first.put_filter("1", "hi", reply("mine"))
+        first.journal.sync()
+        assert first.journal.check_for_changes() == set()
+
+        second.put_filter("2", "hey", reply("theirs"))
+        second.delete_filter("1", "hi")
+        second.journal.sync()
+        assert first.journal.check_for_changes() == {"1", "2"}
+        assert reloaded == [{"1", "2"}]
+        assert first.data["2"]["hey"] == reply("theirs")
+        assert "hi" not in first.data["1"]
+    finally:
+        second.close()
+        first.close()
@@ -0,0 +1,48 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from member_roster import MemberRoster
+
+
+def user(user_id, username, is_bot=False):
+    return SimpleNamespace(id=user_id, username=username, first_name=username, is_bot=is_bot)
+
+
+class FakeBot:
+    def get_chat_administrators(self, chat_id):
+        return [SimpleNamespace(user=user(1, "owner")), SimpleNamespace(user=user(2, "helper", is_bot=True))]
+
+
+def test_admins_are_fetched_through_send_and_cached():
+    calls = []
+    pending = []
+
+    def send(chat_id, func, *args, **kwargs):
+        calls.append((chat_id, func.__name__, args, kwargs))
+        future = Future()
+        pending.append((future, func, args))
+        return future
+
+    roster = MemberRoster(send)
+    bot = FakeBot()
+    assert roster.get_admins(-100, bot) == []
+    assert roster.get_admins(-100, bot) == []
+    assert calls == [(-100, "get_chat_administrators", (-100,), {"chat_limited": False})]
+    future, func, args = pending.pop()
+    future.set_result(func(*args))
+    assert roster.get_admins(-100, bot) == [(1, "owner", "owner")]
+    assert roster.stats()["admin_cache_hits"] == 1
+
+
+def test_failed_admin_lookup_is_retried():
+    failed = Future()
+    failed.set_exception(RuntimeError("chat not found"))
+    futures = [failed]
+    roster = MemberRoster(lambda *args, **kwargs: futures.pop())
+    assert roster.get_admins(-100, FakeBot()) == []
+    assert not futures
+    done = Future()
+    done.set_result([])
+    futures.append(done)
+    roster.get_admins(-100, FakeBot())
+    assert not futures
@@ -0,0 +1,75 @@
+import re
+
+import pytest
+
+from trigger_matcher import PatternMatcher, TriggerMatcher, pattern_source, validate_regex
+
+
+def test_earliest_then_longest_trigger_wins():
+    matcher = TriggerMatcher(["he", "hello", "llo world"])
+    assert matcher.search("oh hello world") == ("hello", 3)
+    assert matcher.find("say he") == "he"
+    assert matcher.find("nothing to see") is None
+
+
+def test_empty_trigger_only_matches_as_a_fallback():
+    matcher = TriggerMatcher(["", "hi"])
+    assert matcher.search("hi there") == ("hi", 0)
+    assert matcher.search("bye") == ("", 0)
+
+
+def test_remove_and_state_round_trip():
+    matcher = TriggerMatcher(["cat", "category", "dog"])
+    matcher.remove("category")
+    assert "category" not in matcher
+    assert matcher.find("categoryless dog") == "cat"
+    restored = TriggerMatcher.from_state(matcher.export_state())
+    assert len(restored) == 2
+    assert restored.find("hotdog") == "dog"
+
+
+@pytest.mark.parametrize("pattern", ["colou?r", r"\bgm\b", "(foo|bar)baz", r"\d{3}-\d{4}", "[a-z]+!"])
+def test_accepted_regexes_compile_as_embedded(pattern):
+    validate_regex(pattern)
+    re.compile(f"(?P<t0>{pattern_source(pattern, 'regex')})", re.IGNORECASE)
+
+
+@pytest.mark.parametrize("pattern", [
+    "(?i)abc",      # global flag, not at the start once wrapped
+    "(?s)foo",
+    "(a+)+b",       # nested quantifier
+    "(a|aa)*c",     # overlapping alternatives under a repeat
+    "(a?)*b",       # nullable repeat body
+    ".*.*.*z",      # adjacent unbounded quantifiers
+    r"(a)\1",       # backreference
+    "(?P<x>a)",     # named group
+    "a{1000}",      # repeat count over the limit
+    "a*",           # matches an empty message
+    "(",            # does not parse
+    "x" * 201,      # too long
+])
+def test_rejected_regexes(pattern):
+    with pytest.raises(ValueError):
+        validate_regex(pattern)
+
+
+def test_pattern_matcher_modes():
+    matcher = PatternMatcher([("hi", "word"), ("deploy", "prefix"), ("colou?r", "regex")])
+    assert matcher.search("this is it") is None
+    assert matcher.search("well hi!") == ("hi", 5, 2)
+    assert matcher.search("Deployment done") == ("deploy", 0, 6)
+    assert matcher.search("nice COLOR") == ("colou?r", 5, 5)
+
+
+def test_pattern_matcher_skips_a_trigger_that_does_not_compile():
+    matcher = PatternMatcher([("(?i)abc", "regex"), ("hi", "word")])
+    assert matcher.search("oh hi") == ("hi", 3, 2)
+    assert matcher.search("abc") is None
+
+
+def test_slow_search_quarantines_only_regex_triggers():
+    matcher = PatternMatcher([("hi", "word"), ("x+y", "regex")], time_budget=-1)
+    assert matcher.search("xxy") == ("x+y", 0, 3)
+    assert matcher.quarantined
+    assert matcher.search("xxy") is None
+    assert matcher.search("hi") == ("hi", 0, 2)
@@ -0,0 +1,431 @@
+import logging
+import re
+import time
+from collections import deque
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+# Match modes stored in a filter record's "match" field; no field means substring
+MATCH_MODES = ("word", "prefix", "regex")
+
+# Limits for user-supplied regex triggers
+MAX_REGEX_LENGTH = 200
+MAX_REGEX_REPEAT = 100
+
+logger = logging.getLogger(__name__)
+
+
+class TriggerMatcher:
+    """Aho-Corasick automaton that finds a chat's triggers in one pass over a message
+
+    When several triggers match, the one starting earliest in the message wins;
+    ties are broken by the longest trigger. An empty trigger matches every
+    message but only when nothing else does.
+    """
+
+    def __init__(self, triggers=()):
+        # Trie nodes are stored column-wise: goto edges, terminal trigger, links
+        self._goto = [{}]
+        self._term = [None]
+        self._fail = [0]
+        self._best = [None]
+        self._triggers = set()
+        self._dead_nodes = 0
+        self._dirty = False
+        self.max_length = 0
+        for trigger in triggers:
+            self.add(trigger)
+
+    def __len__(self):
+        return len(self._triggers)
+
+    def __contains__(self, trigger):
+        return trigger in self._triggers
+
+    def add(self, trigger):
+        """Insert a (lower-cased) trigger; failure links are rebuilt lazily"""
+        if trigger in self._triggers:
+            return
+        self._triggers.add(trigger)
+        if not trigger:
+            return
+        node = 0
+        for char in trigger:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._term.append(None)
+                self._fail.append(0)
+                self._best.append(None)
+            node = nxt
+        self._term[node] = trigger
+        self.max_length = max(self.max_length, len(trigger))
+        self._dirty = True
+
+    def remove(self, trigger):
+        """Drop a trigger; the trie is compacted once too many nodes are dead"""
+        if trigger not in self._triggers:
+            return
+        self._triggers.discard(trigger)
+        if not trigger:
+            return
+        node = 0
+        for char in trigger:
+            node = self._goto[node][char]
+        self._term[node] = None
+        self._dead_nodes += len(trigger)
+        if self._dead_nodes > len(self._goto) // 2:
+            self._rebuild()
+        else:
+            if len(trigger) == self.max_length:
+                self.max_length = max((len(t) for t in self._triggers), default=0)
+            self._dirty = True
+
+    def export_state(self):
+        """The linked automaton as plain lists and dicts (marshal-able); see from_state"""
+        if self._dirty:
+            self._link()
+        return (self._goto, self._term, self._fail, self._best, sorted(self._triggers),
+                self._dead_nodes, self.max_length)
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a matcher from export_state() output without relinking"""
+        matcher = cls()
+        (matcher._goto, matcher._term, matcher._fail, matcher._best, triggers,
+         matcher._dead_nodes, matcher.max_length) = state
+        matcher._triggers = set(triggers)
+        return matcher
+
+    def _rebuild(self):
+        """Rebuild the trie from scratch, dropping nodes of removed triggers"""
+        triggers = self._triggers
+        self._goto, self._term = [{}], [None]
+        self._fail, self._best = [0], [None]
+        self._triggers = set()
+        self._dead_nodes = 0
+        self.max_length = 0
+        for trigger in triggers:
+            self.add(trigger)
+
+    def _link(self):
+        """Compute failure links and the best (longest) output per node"""
+        goto, fail, term, best = self._goto, self._fail, self._term, self._best
+        queue = deque()
+        for child in goto[0].values():
+            fail[child] = 0
+            best[child] = term[child]
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                # The node's own trigger is always the longest one ending here
+                best[child] = term[child] if term[child] is not None else best[fail[child]]
+                queue.append(child)
+        self._dirty = False
+
+    def find(self, text):
+        """Return the winning trigger contained in (lower-cased) text, or None"""
+        return self.search(text)[0]
+
+    def search(self, text):
+        """Return (winning trigger, start index) for (lower-cased) text, or (None, None)"""
+        if self._dirty:
+            self._link()
+        goto, fail, best = self._goto, self._fail, self._best
+        match = None
+        match_start = len(text)
+        state = 0
+        for index, char in enumerate(text):
+            # No match found later can start before the current one
+            if match is not None and index - self.max_length >= match_start:
+                break
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found = best[state]
+            if found is None:
+                continue
+            start = index - len(found) + 1
+            if match is None or start < match_start or (start == match_start and len(found) > len(match)):
+                match = found
+                match_start = start
+        if match is None:
+            return ('', 0) if '' in self._triggers else (None, None)
+        return match, match_start
+
+
+# Characters the complexity checks reason about, besides the ones a pattern
+# names itself: Latin-1 plus a few from other scripts, enough to tell apart
+# the classes people use (\d, \s, \w, [a-z], ...)
+_BASE_SAMPLE = frozenset(map(chr, range(256))) | frozenset('ёЖя中٣\u2003\u2028')
+_CATEGORY_SOURCES = {
+    'CATEGORY_DIGIT': r'\d', 'CATEGORY_NOT_DIGIT': r'\D',
+    'CATEGORY_SPACE': r'\s', 'CATEGORY_NOT_SPACE': r'\S',
+    'CATEGORY_WORD': r'\w', 'CATEGORY_NOT_WORD': r'\W',
+}
+_REPEATS = tuple(op for op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                               getattr(sre_parse, 'POSSESSIVE_REPEAT', None)) if op is not None)
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+
+def _cased(char):
+    return {variant for variant in (char, char.lower(), char.upper()) if len(variant) == 1}
+
+
+class _Complexity:
+    """Static checks that reject regexes whose backtracking can blow up
+
+    Python's `re` cannot be interrupted, so a slow pattern has to be refused
+    before it is ever run. Character sets are approximated over a sample of
+    characters (the base sample plus every character the pattern mentions).
+    """
+
+    def __init__(self, parsed):
+        named = set()
+        self._collect(parsed.data, named)
+        self.sample = frozenset(_BASE_SAMPLE | named)
+        self.categories = {name: frozenset(char for char in self.sample if re.fullmatch(source, char))
+                           for name, source in _CATEGORY_SOURCES.items()}
+
+    def _collect(self, items, named):
+        for op, value in items:
+            if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL):
+                named.update(_cased(chr(value)))
+            elif op == sre_parse.RANGE:
+                named.update(_cased(chr(value[0])) | _cased(chr(value[1])))
+            elif op == sre_parse.IN:
+                self._collect(value, named)
+            elif op in _REPEATS:
+                self._collect(value[2], named)
+            elif op == sre_parse.SUBPATTERN:
+                self._collect(value[-1], named)
+            elif op == sre_parse.BRANCH:
+                for branch in value[1]:
+                    self._collect(branch, named)
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                self._collect(value[1], named)
+            elif op is _ATOMIC_GROUP:
+                self._collect(value, named)
+
+    def class_chars(self, items):
+        """Sample characters matched by the items of a [...] class"""
+        chars = set()
+        negate = False
+        for op, value in items:
+            if op == sre_parse.NEGATE:
+                negate = True
+            elif op == sre_parse.LITERAL:
+                chars |= _cased(chr(value))
+            elif op == sre_parse.RANGE:
+                low, high = value
+                chars |= {char for char in self.sample if any(low <= ord(v) <= high for v in _cased(char))}
+            elif op == sre_parse.CATEGORY:
+                # Other categories (line breaks) count as anything
+                chars |= self.categories.get(str(value), self.sample)
+        return self.sample - chars if negate else frozenset(chars)
+
+    def info(self, items):
+        """(first chars, all chars, nullable, chars under an unbounded repeat) of a sequence
+
+        "Nullable" means the sequence can match the empty string.
+        """
+        first, chars, star = set(), set(), set()
+        nullable = True
+        for op, value in items:
+            if op == sre_parse.LITERAL:
+                matched = frozenset(_cased(chr(value)))
+                item = (matched, matched, False, frozenset())
+            elif op == sre_parse.NOT_LITERAL:
+                matched = self.sample - _cased(chr(value))
+                item = (matched, matched, False, frozenset())
+            elif op == sre_parse.ANY:
+                matched = self.sample - {'\n'}
+                item = (matched, matched, False, frozenset())
+            elif op == sre_parse.IN:
+                matched = self.class_chars(value)
+                item = (matched, matched, False, frozenset())
+            elif op == sre_parse.SUBPATTERN:
+                item = self.info(value[-1])
+            elif op is _ATOMIC_GROUP:
+                item = self.info(value)
+            elif op == sre_parse.BRANCH:
+                branches = [self.info(branch) for branch in value[1]]
+                item = tuple(frozenset().union(*(b[n] for b in branches)) for n in (0, 1)) + (
+                    any(b[2] for b in branches), frozenset().union(*(b[3] for b in branches)))
+            elif op in _REPEATS:
+                low, high, sub = value
+                sub_first, sub_chars, sub_nullable, sub_star = self.info(sub)
+                item = (sub_first, sub_chars, low == 0 or sub_nullable,
+                        sub_chars if high == sre_parse.MAXREPEAT else sub_star)
+            else:
+                # Anchors and lookarounds consume nothing
+                item = (frozenset(), frozenset(), True, frozenset())
+            if nullable:
+                first |= item[0]
+            chars |= item[1]
+            star |= item[3]
+            nullable = nullable and item[2]
+        return frozenset(first), frozenset(chars), nullable, frozenset(star)
+
+    def check_repeat_body(self, sub):
+        """Reject repeated bodies that can split the same text in many ways"""
+        if self.info(sub)[2]:
+            raise ValueError("a repeated part must not be able to match nothing, as in (a?)*")
+        for op, value in sub:
+            if op == sre_parse.SUBPATTERN:
+                self.check_repeat_body(value[-1])
+            elif op == sre_parse.BRANCH:
+                seen = frozenset()
+                for branch in value[1]:
+                    first, _, nullable, _ = self.info(branch)
+                    if nullable or first & seen:
+                        raise ValueError("repeated alternatives must not overlap, as in (a|aa)*")
+                    seen |= first
+
+    def walk(self, items, inside_repeat=False):
+        """Check a sequence and everything nested in it; raises ValueError"""
+        # Characters an earlier unbounded repeat in this sequence could still take
+        pending = frozenset()
+        for op, value in items:
+            if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+                raise ValueError("backreferences are not allowed")
+            _, chars, nullable, star = self.info([(op, value)])
+            if star & pending:
+                raise ValueError("quantifiers that can take the same text one after another, "
+                                 "as in .*.* or .*a.*, are not allowed")
+            if nullable:
+                # May match nothing, leaving the earlier repeat next to what follows
+                pending |= star
+            elif star:
+                pending = star
+            elif not chars <= pending:
+                pending = frozenset()
+            if op in _REPEATS:
+                low, high, sub = value
+                if high != sre_parse.MAXREPEAT and high > MAX_REGEX_REPEAT:
+                    raise ValueError(f"repeat counts above {MAX_REGEX_REPEAT} are not allowed")
+                repeats = high == sre_parse.MAXREPEAT or high > 1
+                if repeats and inside_repeat:
+                    raise ValueError("nested quantifiers such as (a+)+ are not allowed")
+                if repeats:
+                    self.check_repeat_body(sub)
+                self.walk(sub, inside_repeat or repeats)
+            elif op == sre_parse.BRANCH:
+                for branch in value[1]:
+                    self.walk(branch, inside_repeat)
+            elif op == sre_parse.SUBPATTERN:
+                self.walk(value[-1], inside_repeat)
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                self.walk(value[1], inside_repeat)
+            elif op is _ATOMIC_GROUP:
+                self.walk(value, inside_repeat)
+
+
+def validate_regex(pattern):
+    """Check an untrusted regex trigger against the length and complexity limits
+
+    Raises ValueError with a user-facing reason when the pattern is rejected.
+    """
+    if len(pattern) > MAX_REGEX_LENGTH:
+        raise ValueError(f"regex is longer than {MAX_REGEX_LENGTH} characters")
+    try:
+        parsed = sre_parse.parse(pattern, re.IGNORECASE)
+    except re.error as e:
+        raise ValueError(f"invalid regex: {e}") from None
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.groupdict:
+        raise ValueError("named groups are not allowed")
+    _Complexity(parsed).walk(parsed.data)
+    try:
+        # Compiled the way PatternMatcher embeds it; inline flags such as (?i)
+        # parse on their own but are rejected once wrapped in a group
+        re.compile(pattern_source(pattern, "regex"), re.IGNORECASE)
+    except re.error as e:
+        raise ValueError(f"invalid regex: {e}") from None
+    if re.fullmatch(pattern, '', re.IGNORECASE):
+        raise ValueError("regex must not match an empty message")
+
+
+def pattern_source(trigger, mode):
+    """Regex source for one trigger in the given match mode"""
+    if mode == "word":
+        return r"(?<!\w)" + re.escape(trigger) + r"(?!\w)"
+    if mode == "prefix":
+        return r"(?<!\w)" + re.escape(trigger)
+    return f"(?:{trigger})"
+
+
+class PatternMatcher:
+    """A chat's word, prefix and regex triggers compiled into one alternation
+
+    Each trigger becomes a named group of a single case-insensitive pattern, so a
+    message is scanned once however many such triggers the chat has. Python's
+    `re` cannot be interrupted, so the time budget is enforced after the fact:
+    only the first `max_text` characters are scanned, and a search slower than
+    `time_budget` seconds quarantines the chat's regex triggers (word and prefix
+    triggers cannot backtrack and stay active) until the matcher is rebuilt.
+    """
+
+    def __init__(self, entries=(), time_budget=0.05, max_text=4096):
+        # Longest first so that among alternatives starting at the same index
+        # the longest trigger is tried first
+        self._entries = sorted(entries, key=lambda entry: (-len(entry[0]), entry))
+        self.time_budget = time_budget
+        self.max_text = max_text
+        self.quarantined = False
+        self._compile(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _compile(self, entries):
+        try:
+            self._regex = self._join(entries)
+        except re.error:
+            # A trigger stored before validation caught it; drop it, not the chat
+            usable = []
+            for entry in entries:
+                try:
+                    re.compile(pattern_source(*entry), re.IGNORECASE)
+                except re.error as e:
+                    logger.warning("Ignoring %s trigger %r that does not compile: %s", entry[1], entry[0], e)
+                else:
+                    usable.append(entry)
+            self._regex = self._join(usable)
+
+    def _join(self, entries):
+        self._names = {}
+        parts = []
+        for index, (trigger, mode) in enumerate(entries):
+            name = f"t{index}"
+            self._names[name] = trigger
+            parts.append(f"(?P<{name}>{pattern_source(trigger, mode)})")
+        return re.compile("|".join(parts), re.IGNORECASE) if parts else None
+
+    def search(self, text):
+        """Return (trigger, start, length) of the earliest match in text, or None"""
+        if self._regex is None:
+            return None
+        names = self._names
+        started = time.perf_counter()
+        match = self._regex.search(text, 0, self.max_text)
+        elapsed = time.perf_counter() - started
+        if elapsed > self.time_budget and not self.quarantined:
+            self.quarantined = True
+            self._compile([entry for entry in self._entries if entry[1] != "regex"])
+            logger.warning("Regex triggers disabled after a %.0fms search; "
+                           "they are re-enabled when the chat's filters change", elapsed * 1000)
+        if match is None:
+            return None
+        # Group names of the pattern that matched, not of its quarantined rebuild
+        return names[match.lastgroup], match.start(), match.end() - match.start()
@@ -0,0 +1,193 @@
+import asyncio
+import hmac
+import json
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY_BYTES = 1024 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+class WebhookServer:
+    """Minimal asyncio HTTP endpoint that receives Telegram webhook updates
+
+    Each POST to `path` must carry the secret token header (when a secret is set)
+    and a JSON update body. Accepted updates go onto a bounded queue; when it is
+    full the server answers 503 so Telegram retries later instead of the process
+    buffering without limit. A pump thread decodes queued updates with `decode`
+    and hands them to `sink` (e.g. the dispatcher's update_queue.put).
+    """
+
+    def __init__(self, sink, decode=None, host='0.0.0.0', port=8443, path='/telegram',
+                 secret=None, queue_size=1000):
+        self.sink = sink
+        self.decode = decode or (lambda data: data)
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.received = 0
+        self.rejected = 0
+        self.bad_requests = 0
+        self.max_depth = 0
+        self._loop = None
+        self._server = None
+        self._ready = threading.Event()
+        self._threads = []
+        self._writers = set()
+
+    def stats(self):
+        """Backpressure counters: accepted, rejected (queue full), bad, queue depth"""
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "bad_requests": self.bad_requests,
+            "queue_depth": self.queue.qsize(),
+            "queue_max_depth": self.max_depth,
+            "queue_capacity": self.queue.maxsize,
+        }
+
+    def start(self):
+        """Start the HTTP server and the pump thread in the background"""
+        for target, name in ((self._serve_forever, 'webhook-http'), (self._pump, 'webhook-pump')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._ready.wait()
+
+    def stop(self):
+        """Stop accepting requests and drain what is already queued"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._close)
+        self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _close(self):
+        """Close the listening socket and idle keep-alive connections"""
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+
+    def _serve_forever(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Webhook server listening on %s:%s%s", self.host, self.port, self.path)
+        self._ready.set()
+        try:
+            self._loop.run_until_complete(self._server.wait_closed())
+        finally:
+            self._loop.close()
+
+    def _pump(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            try:
+                update = self.decode(data)
+                if update is not None:
+                    self.sink(update)
+            except Exception:
+                logger.exception("Could not dispatch webhook update")
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                keep_alive = await self._handle_request(reader, writer)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        """Serve one request; returns whether the connection stays open"""
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        method, target, version = request_line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        if length > MAX_BODY_BYTES:
+            self.bad_requests += 1
+            await self._respond(writer, 413, False)
+            return False
+        body = await reader.readexactly(length) if length else b''
+        status = self._accept(method, target, headers, body)
+        await self._respond(writer, status, keep_alive)
+        return keep_alive
+
+    def _accept(self, method, target, headers, body):
+        """Validate a request and enqueue its update; returns the HTTP status"""
+        if target.split('?', 1)[0] != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if self.secret and not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret):
+            self.bad_requests += 1
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.bad_requests += 1
+            return 400
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.rejected += 1
+            return 503
+        self.received += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return 200
+
+    @staticmethod
+    async def _respond(writer, status, keep_alive):
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            "Content-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1'))
+        await writer.drain()
+
+
+if __name__ == '__main__':
+    # Local testing without Telegram: print every update POSTed to the endpoint, e.g.
+    #   curl -H 'X-Telegram-Bot-Api-Secret-Token: test' -d @update.json localhost:8443/telegram
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Run the webhook endpoint with a printing sink")
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--path', default='/telegram')
+    parser.add_argument('--secret', default='test')
+    args = parser.parse_args()
+
+    server = WebhookServer(lambda update: print(json.dumps(update)), port=args.port,
+                           path=args.path, secret=args.secret)
+    server.start()
+    try:
+        while True:
+            time.sleep(10)
+            print(server.stats())
+    except KeyboardInterrupt:
+        server.stop()